@@ -1,23 +1,144 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
+import os
+
+# Concurrency model: 'threading' (a thread per request/socket), or 'gevent' /
+# 'eventlet' (green threads, thousands of idle sockets per process). Green
+# modes must patch the standard library before anything else is imported.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, request, jsonify, send_file, render_template, abort, Response, g
+import click
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 import jwt
-import os
 import json
 from datetime import datetime, timedelta
 from functools import wraps
 import sqlite3
 import uuid
+import base64
+import atexit
+import threading
+import time
+from db import ConnectionPool, DBExecutor, migrate, query_plan, find_scans
+from presence import PresenceRegistry, ContactCache, TypingThrottle
+from auth import TokenCache, PasswordHasher, HasherBusy, HasherUnavailable
+from ingest import MessageIngestor
+from receipts import ReceiptBuffer
+from pubsub import socketio_queue_options
+from images import ImageStore, HotFileCache, InvalidImage, RenderUnavailable, VARIANTS, variant_filename
+from metrics import Registry, SamplingProfiler, SIZE_BUCKETS
+from archive import MessageArchive, enable_incremental_vacuum, CHAT_MONTHS_SQL
+from transfer import export_all, export_user, import_ndjson, restore_deferred_schema
+from chatlist import ChatListCache
+import wire
+from werkzeug.security import safe_join
+import mimetypes
+import re
+import zlib
+import hmac
+import itertools
+from stat import S_ISREG
 
 app = Flask(__name__)
+app.json = wire.FastJSONProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this'
 app.config['UPLOAD_FOLDER'] = 'uploads/images'
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 2))
+app.config['IMAGE_QUALITY'] = 80
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 3600  # image files never change once written
+app.config['IMAGE_CACHE_BYTES'] = 64 * 1024 * 1024  # in-memory hot image budget, 0 disables
+app.config['IMAGE_CACHE_MAX_FILE'] = 512 * 1024  # larger files are always streamed from disk
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'  # behind nginx/Apache
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['TOKEN_CACHE_SIZE'] = 10000  # verified JWTs kept in memory
+# Password hashing runs in its own processes: at most PASSWORD_HASH_WORKERS
+# hashes at once (plus as many queued), and signup/login answer 429 after
+# waiting PASSWORD_HASH_QUEUE_TIMEOUT for a slot. Stored hashes made with
+# another method are replaced on the next successful login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+app.config['PASSWORD_HASH_QUEUE_TIMEOUT'] = 2.0
+app.config['CHAT_LIST_CACHE_BYTES'] = int(os.environ.get('CHAT_LIST_CACHE_BYTES', 32 * 1024 * 1024))  # 0 disables
+app.config['CHAT_LIST_CACHE_TTL'] = 5.0  # seconds, clustered only: other workers' writes aren't seen
+# Bearer token required to scrape /metrics; unset leaves it open (bind the
+# app to a private interface then). The profiler endpoint always needs it.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Emitted JSON payloads are measured for chat_emit_bytes_total one emit in
+# this many (serializing every one just to count it costs more than the
+# metric is worth)
+app.config['EMIT_SIZE_SAMPLE'] = 32
+app.config['DATABASE'] = os.environ.get('CHAT_DB', 'chat_app.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 16))
+app.config['DB_POOL_TIMEOUT'] = 30.0  # seconds to wait for a free connection
+app.config['DB_BUSY_TIMEOUT'] = 5000  # ms SQLite waits on a locked database
+app.config['ASYNC_MODE'] = ASYNC_MODE
+# OS threads that run SQLite calls in the green modes, so a query never
+# blocks the event loop; unused in threading mode
+app.config['DB_EXECUTOR_THREADS'] = int(os.environ.get('DB_EXECUTOR_THREADS', 8))
+
+app.config['PRESENCE_FLUSH_INTERVAL'] = 5.0  # seconds between last_seen batches
+app.config['PRESENCE_OFFLINE_GRACE'] = 5.0  # reconnects within this aren't announced
+# Clustered, presence is flushed every second instead, and an offline user
+# is only announced if no other live worker has them: a reconnect that
+# landed on another worker within the grace period is visible by then
+# A worker that hasn't flushed presence for this long is presumed dead and
+# its users' sessions are dropped (clustered)
+app.config['PRESENCE_WORKER_TIMEOUT'] = 30.0
+# Typing indicators: a sender silent this long gets an automatic "stopped",
+# and a steady typer's "typing" is re-sent at most once per refresh
+app.config['TYPING_TIMEOUT'] = 6.0
+app.config['TYPING_REFRESH'] = 3.0
+# 'commit': /api/messages/send answers once the message is on disk.
+# 'enqueue': answer as soon as it is queued (faster, may lose the last few
+# milliseconds of messages on a crash).
+app.config['MESSAGE_DURABILITY'] = os.environ.get('MESSAGE_DURABILITY', 'commit')
+app.config['MESSAGE_BATCH_INTERVAL'] = 0.005  # seconds a group commit collects for
+app.config['MESSAGE_BATCH_MAX'] = 500
+app.config['MESSAGE_COMMIT_TIMEOUT'] = 10.0
+app.config['SYNC_MAX_CHANGES'] = 1000  # change log rows answered by one /api/sync
+app.config['SYNC_RETENTION'] = 7 * 24 * 3600  # seconds of change log kept; older cursors resync
+app.config['SYNC_TRIM_INTERVAL'] = 3600.0
+# Compaction: purge messages deleted on both sides and move ones older than
+# ARCHIVE_AFTER_DAYS (0 keeps everything hot) into per-month archive files
+app.config['ARCHIVE_DIR'] = os.environ.get(
+    'ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])), 'archive'))
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+app.config['COMPACTION_INTERVAL'] = float(os.environ.get('COMPACTION_INTERVAL', 24 * 3600))  # 0 disables
+
+# Socket encodings clients may negotiate at connect (auth={'encodings':
+# [...]}) instead of plain JSON events; empty turns that off. Off by
+# default behind a message queue: a worker can't see which encodings the
+# other workers' sockets use, so each emit would be published once more
+# per enabled encoding whether anyone negotiated it or not
+app.config['COMPACT_ENCODINGS'] = [encoding for encoding in
+                                   os.environ.get('COMPACT_ENCODINGS',
+                                                  '' if os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+                                                  else ','.join(wire.ENCODINGS)).split(',')
+                                   if encoding in wire.ENCODINGS]
+# JSON responses at least this big are sent gzip/brotli compressed to
+# clients that accept it
+app.config['COMPRESS_MIN_SIZE'] = 1024
+
+MAX_PAGE_SIZE = 200  # most messages returned by one history request
+SEARCH_LIMIT = 20  # users returned by one search
+
+# Pub/sub backend that links Socket.IO workers so room emits reach users
+# connected to any of them: local:// (one process, tests), tcp:// or
+# unix:// (broker started by launcher.py), or redis://, amqp://, kafka://.
+# Unset means a single worker.
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+CLUSTERED = bool(app.config['SOCKETIO_MESSAGE_QUEUE'])
 
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25)
+socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25,
+                    async_mode=app.config['ASYNC_MODE'],
+                    **socketio_queue_options(app.config['SOCKETIO_MESSAGE_QUEUE']))
 
 # --- FIX: Moved home() function here and added the route ---
 @app.route('/')
@@ -27,11 +148,25 @@ def home():
 # Create uploads folder if not exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Uploaded images: content-addressed thumb/preview/full variants
+image_store = ImageStore(app.config['UPLOAD_FOLDER'],
+                         workers=app.config['IMAGE_WORKERS'],
+                         quality=app.config['IMAGE_QUALITY'])
+atexit.register(image_store.shutdown)
+hot_images = HotFileCache(app.config['IMAGE_CACHE_BYTES'], app.config['IMAGE_CACHE_MAX_FILE'])
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect('chat_app.db')
+    conn = sqlite3.connect(app.config['DATABASE'])
     c = conn.cursor()
     
+    # Only takes effect on a new database; `flask compact --vacuum` converts
+    # an existing one so compaction can hand freed pages back to the OS
+    c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    
+    # WAL is persistent in the file, so readers no longer block the writer
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id TEXT PRIMARY KEY,
@@ -80,15 +215,664 @@ def init_db():
     )''')
     
     conn.commit()
+    
+    # Indexes and triggers an interrupted bulk import left dropped
+    restore_deferred_schema(conn)
+    migrate(conn, MIGRATIONS)
+    
+    # Presence lives in memory; nobody is online until they reconnect.
+    # Workers of a cluster share the flags, so launcher.py resets them once.
+    if not CLUSTERED:
+        reset_presence(conn)
     conn.close()
 
+def reset_presence(conn):
+    conn.execute('DELETE FROM presence_sessions')
+    conn.execute('DELETE FROM presence_workers')
+    conn.execute('UPDATE user_status SET online = 0 WHERE online != 0')
+    conn.commit()
+
+# Schema migrations, applied in order on top of the tables above.
+# Append new entries; never edit one that has shipped.
+MIGRATIONS = [
+    # 1: secondary indexes for the message history and chat list queries
+    [
+        # get_messages: newest visible messages of a chat. Rows deleted for
+        # everyone are never read, so they are left out of the index, and the
+        # per-user "delete for me" flags are carried in it so hidden rows are
+        # skipped without touching the table.
+        '''CREATE INDEX IF NOT EXISTS idx_messages_chat_visible
+           ON messages(chat_id, timestamp, sender_id, receiver_id,
+                       deleted_for_sender, deleted_for_receiver)
+           WHERE deleted_for_everyone = 0''',
+        # get_chats: a user's chats, most recent first
+        '''CREATE INDEX IF NOT EXISTS idx_chats_user_time
+           ON chats(user_id, last_message_time)''',
+    ],
+    # 2: add id to the history index so (timestamp, id) keyset cursors are
+    # resolved from the index alone
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_messages_chat_cursor
+           ON messages(chat_id, timestamp, id, sender_id, receiver_id,
+                       deleted_for_sender, deleted_for_receiver)
+           WHERE deleted_for_everyone = 0''',
+        'DROP INDEX IF EXISTS idx_messages_chat_visible',
+    ],
+    # 3: username search. Prefix matches use a NOCASE index, substring
+    # matches a trigram FTS5 index over users.username kept in sync by
+    # triggers (external content keyed by users.rowid).
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_users_username_nocase
+           ON users(username COLLATE NOCASE)''',
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+               username, content='users', content_rowid='rowid',
+               tokenize='trigram')''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_ai AFTER INSERT ON users BEGIN
+               INSERT INTO users_search(rowid, username) VALUES (new.rowid, new.username);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_ad AFTER DELETE ON users BEGIN
+               INSERT INTO users_search(users_search, rowid, username)
+               VALUES ('delete', old.rowid, old.username);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_au AFTER UPDATE OF username ON users BEGIN
+               INSERT INTO users_search(users_search, rowid, username)
+               VALUES ('delete', old.rowid, old.username);
+               INSERT INTO users_search(rowid, username) VALUES (new.rowid, new.username);
+           END''',
+        "INSERT INTO users_search(users_search) VALUES ('rebuild')",
+    ],
+    # 4: reverse chat lookup, for fanning presence out to a user's contacts
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_chats_chat_user
+           ON chats(chat_user_id)''',
+    ],
+    # 5: read/delivered receipts as per-(user, chat) watermarks: user_id has
+    # read (received) everything chat_user_id sent them up to this timestamp.
+    # Seeded from the per-message 'read' statuses written so far.
+    [
+        'ALTER TABLE chats ADD COLUMN read_up_to BIGINT NOT NULL DEFAULT 0',
+        'ALTER TABLE chats ADD COLUMN delivered_up_to BIGINT NOT NULL DEFAULT 0',
+        '''UPDATE chats SET read_up_to = COALESCE((
+               SELECT MAX(m.timestamp) FROM messages m
+               WHERE m.chat_id = min(chats.user_id, chats.chat_user_id) || '_' ||
+                                 max(chats.user_id, chats.chat_user_id)
+                 AND m.deleted_for_everyone = 0
+                 AND m.receiver_id = chats.user_id
+                 AND m.status = 'read'), 0)''',
+        'UPDATE chats SET delivered_up_to = read_up_to',
+    ],
+    # 6: unread counter per (user, chat), kept up to date by the message
+    # ingestor and read receipts so the chat list needs no per-chat count.
+    # Backfilled from messages past each chat's read watermark.
+    [
+        'ALTER TABLE chats ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE chats SET unread_count = (
+               SELECT COUNT(*) FROM messages m
+               WHERE m.chat_id = min(chats.user_id, chats.chat_user_id) || '_' ||
+                                 max(chats.user_id, chats.chat_user_id)
+                 AND m.deleted_for_everyone = 0
+                 AND m.timestamp > chats.read_up_to
+                 AND m.sender_id = chats.chat_user_id
+                 AND m.receiver_id = chats.user_id
+                 AND m.deleted_for_receiver = 0)
+           WHERE last_message_time > read_up_to''',
+    ],
+    # 7: per-user change log for /api/sync. Triggers append a row for every
+    # change a user's devices have to catch up on, in the same transaction
+    # as the change, so seq order is commit order. kind is 'message' (new),
+    # 'delete' (hidden from user_id), 'status' (chat_user_id's read/delivered
+    # watermark moved) or 'chat' (chat row created or its unread reset).
+    [
+        '''CREATE TABLE IF NOT EXISTS changes (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id TEXT NOT NULL,
+               kind TEXT NOT NULL,
+               chat_user_id TEXT NOT NULL,
+               message_id TEXT,
+               created_at BIGINT NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS idx_changes_user_seq
+           ON changes(user_id, seq)''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_message_ai AFTER INSERT ON messages BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, message_id, created_at)
+               VALUES (new.sender_id, 'message', new.receiver_id, new.id, new.timestamp),
+                      (new.receiver_id, 'message', new.sender_id, new.id, new.timestamp);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_message_deleted AFTER UPDATE OF deleted_for_everyone ON messages
+           WHEN new.deleted_for_everyone AND NOT old.deleted_for_everyone BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, message_id, created_at)
+               VALUES (new.sender_id, 'delete', new.receiver_id, new.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)),
+                      (new.receiver_id, 'delete', new.sender_id, new.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_message_deleted_sender AFTER UPDATE OF deleted_for_sender ON messages
+           WHEN new.deleted_for_sender AND NOT old.deleted_for_sender BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, message_id, created_at)
+               VALUES (new.sender_id, 'delete', new.receiver_id, new.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_message_deleted_receiver AFTER UPDATE OF deleted_for_receiver ON messages
+           WHEN new.deleted_for_receiver AND NOT old.deleted_for_receiver BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, message_id, created_at)
+               VALUES (new.receiver_id, 'delete', new.sender_id, new.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_chat_ai AFTER INSERT ON chats BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, created_at)
+               VALUES (new.user_id, 'chat', new.chat_user_id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_chat_receipts AFTER UPDATE OF read_up_to, delivered_up_to ON chats
+           WHEN new.read_up_to > old.read_up_to OR new.delivered_up_to > old.delivered_up_to BEGIN
+               INSERT INTO changes (user_id, kind, chat_user_id, created_at)
+               VALUES (new.chat_user_id, 'status', new.user_id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));
+               INSERT INTO changes (user_id, kind, chat_user_id, created_at)
+               SELECT new.user_id, 'chat', new.chat_user_id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)
+               WHERE new.unread_count != old.unread_count;
+           END''',
+    ],
+    # 8: presence per worker. A user is online while any live worker has a
+    # session for them; presence_workers holds each worker's heartbeat.
+    [
+        '''CREATE TABLE IF NOT EXISTS presence_workers (
+               worker_id TEXT PRIMARY KEY,
+               heartbeat BIGINT NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS presence_sessions (
+               user_id TEXT NOT NULL,
+               worker_id TEXT NOT NULL,
+               PRIMARY KEY (user_id, worker_id)) WITHOUT ROWID''',
+        '''CREATE INDEX IF NOT EXISTS idx_presence_sessions_worker
+           ON presence_sessions(worker_id)''',
+    ],
+    # 9: logged-out tokens, so every worker (and a restarted one) rejects
+    # them until they expire; see TokenCache.sync
+    [
+        '''CREATE TABLE IF NOT EXISTS revoked_tokens (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               digest BLOB NOT NULL,
+               expires_at REAL NOT NULL)''',
+    ],
+    # 10: chat rows that read receipts created for chats without messages
+    # (receipts now only update existing rows)
+    [
+        'DELETE FROM chats WHERE last_message_time IS NULL',
+    ],
+    # 11: which archive months hold each chat (month = year * 100 + month),
+    # so history pages only open those files; see MessageArchive.chat_months
+    [
+        '''CREATE TABLE IF NOT EXISTS archived_chats (
+               chat_id TEXT NOT NULL,
+               month INTEGER NOT NULL,
+               PRIMARY KEY (chat_id, month)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS archived_months (
+               month INTEGER PRIMARY KEY)''',
+    ],
+]
+
 init_db()
 
+# Metrics, served in Prometheus format on /metrics
+metrics = Registry()
+http_request_seconds = metrics.histogram(
+    'chat_http_request_seconds', 'HTTP request latency by route', ('method', 'route', 'status'))
+socket_event_seconds = metrics.histogram(
+    'chat_socket_event_seconds', 'Socket.IO event handler latency', ('event',))
+db_query_seconds = metrics.histogram(
+    'chat_db_query_seconds', 'SQLite statement latency', ('statement',))
+emits_total = metrics.counter(
+    'chat_emits_total', 'Server-initiated Socket.IO emits', ('event',))
+emit_recipients_total = metrics.counter(
+    'chat_emit_recipients_total', 'Sockets on this worker reached by emits', ('event',))
+emit_bytes_total = metrics.counter(
+    'chat_emit_bytes_total', 'Payload bytes sent by emits, times recipients (JSON payloads '
+    'estimated from a sample)', ('event',))
+emit_size_samples = itertools.count()
+upload_bytes = metrics.histogram(
+    'chat_upload_bytes', 'Size of uploaded images', buckets=SIZE_BUCKETS)
+profiler = SamplingProfiler()
+
+def statement_label(sql):
+    # Hot queries by name; anything else by its first words
+    name = QUERY_NAMES.get(sql)
+    if name is None:
+        name = ' '.join(sql.split())[:60]
+    return name
+
+def record_query(sql, seconds):
+    db_query_seconds.observe(seconds, (statement_label(sql),))
+
 # Database helper functions
+db_executor = DBExecutor(app.config['ASYNC_MODE'], max_workers=app.config['DB_EXECUTOR_THREADS'])
+db_pool = ConnectionPool(app.config['DATABASE'],
+                         max_size=app.config['DB_POOL_SIZE'],
+                         timeout=app.config['DB_POOL_TIMEOUT'],
+                         busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                         executor=db_executor,
+                         on_query=record_query)
+
 def get_db():
-    conn = sqlite3.connect('chat_app.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Pooled connection; conn.close() returns it to the pool
+    return db_pool.connect()
+
+@app.teardown_appcontext
+def release_db(exc):
+    # Hand back connections left checked out by a handler that raised
+    db_pool.release_current()
+
+# Presence registry; dirty last_seen values are flushed in batches
+presence = PresenceRegistry(worker_timeout=app.config['PRESENCE_WORKER_TIMEOUT'])
+presence_task_lock = threading.Lock()
+presence_task = None
+typing_throttle = TypingThrottle(timeout=app.config['TYPING_TIMEOUT'],
+                                 refresh=app.config['TYPING_REFRESH'])
+
+def load_watchers(user_id):
+    conn = get_db()
+    try:
+        rows = conn.execute('SELECT user_id FROM chats WHERE chat_user_id = ?', (user_id,))
+        return [row['user_id'] for row in rows]
+    finally:
+        conn.close()
+
+# Who hears about a user's presence: people who have them in their chats.
+# Other workers can add chats too, so clustered entries also expire.
+contacts = ContactCache(load_watchers, ttl=60 if CLUSTERED else None)
+
+def announce_presence(user_id, event, payload):
+    watchers = contacts.watchers(user_id)
+    if 'last_seen' in payload:
+        # Cached chat lists keep it for after presence forgets the user
+        chat_lists.contact_changed(watchers, user_id, online=0, last_seen=payload['last_seen'])
+    for watcher_id in watchers:
+        # A watcher may be connected to another worker
+        if CLUSTERED or presence.is_online(watcher_id):
+            emit_to(event, payload, watcher_id)
+
+def flush_presence():
+    conn = get_db()
+    try:
+        presence.flush(conn)
+    finally:
+        conn.close()
+
+def retire_presence():
+    # Clean shutdown: write last_seen, then give up this worker's sessions
+    conn = get_db()
+    try:
+        presence.flush(conn)
+        presence.retire(conn)
+    finally:
+        conn.close()
+
+def offline_elsewhere(due):
+    # Drop users another live worker has a session for (clustered)
+    if not due:
+        return due
+    conn = get_db()
+    try:
+        online = presence.online_elsewhere(conn, [user_id for user_id, _ in due])
+    finally:
+        conn.close()
+    return [(user_id, last_seen) for user_id, last_seen in due if user_id not in online]
+
+def presence_loop():
+    # Announce offline users once their grace period is over, persist
+    # last_seen every PRESENCE_FLUSH_INTERVAL, read receipts every tick and
+    # a "stopped typing" for anyone who went quiet
+    last_flush = datetime.now().timestamp()
+    last_trim = 0
+    while True:
+        socketio.sleep(1)
+        now = datetime.now().timestamp()
+        grace = int(app.config['PRESENCE_OFFLINE_GRACE'] * 1000)
+        try:
+            if CLUSTERED:
+                # One tick for the other worker's flush, one for loop jitter
+                due = offline_elsewhere(presence.due_offline(int(now * 1000), grace + 2000))
+            else:
+                due = presence.due_offline(int(now * 1000), grace)
+            for user_id, last_seen in due:
+                announce_presence(user_id, 'user_offline',
+                                  {'user_id': user_id, 'last_seen': last_seen})
+            if CLUSTERED or now - last_flush >= app.config['PRESENCE_FLUSH_INTERVAL']:
+                last_flush = now
+                flush_presence()
+        except Exception as e:
+            print(f'Presence update failed: {e}')
+        try:
+            flush_receipts()
+        except Exception as e:
+            print(f'Receipt flush failed: {e}')
+        if CLUSTERED:
+            try:
+                sync_revoked_tokens()
+            except Exception as e:
+                print(f'Revoked token sync failed: {e}')
+        if now - last_trim >= app.config['SYNC_TRIM_INTERVAL']:
+            last_trim = now
+            try:
+                trim_changes(int((now - app.config['SYNC_RETENTION']) * 1000))
+            except Exception as e:
+                print(f'Change log trim failed: {e}')
+            try:
+                trim_revoked_tokens()
+            except Exception as e:
+                print(f'Revoked token trim failed: {e}')
+        try:
+            for sender_id, receiver_id in typing_throttle.expire():
+                emit_to('user_typing', {'user_id': sender_id, 'typing': False}, receiver_id)
+        except Exception as e:
+            print(f'Typing expiry failed: {e}')
+
+def start_presence_task():
+    global presence_task
+    if presence_task is not None:
+        return
+    with presence_task_lock:
+        if presence_task is None:
+            presence_task = socketio.start_background_task(presence_loop)
+            if app.config['COMPACTION_INTERVAL']:
+                socketio.start_background_task(compaction_loop)
+
+# Old and dead messages leave the hot table in a background job; one worker
+# of a cluster runs it per COMPACTION_INTERVAL (see MessageArchive.lock)
+archive = MessageArchive(app.config['ARCHIVE_DIR'], busy_timeout=app.config['DB_BUSY_TIMEOUT'] / 1000)
+
+def compact_messages(archive_after_days=None):
+    days = app.config['ARCHIVE_AFTER_DAYS'] if archive_after_days is None else archive_after_days
+    older_than = int((datetime.now().timestamp() - days * 24 * 3600) * 1000) if days else None
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['DB_BUSY_TIMEOUT'] / 1000)
+    try:
+        return archive.compact(conn, older_than)
+    finally:
+        conn.close()
+
+def compaction_loop():
+    socketio.sleep(60)
+    while True:
+        handle = archive.lock(app.config['COMPACTION_INTERVAL'])
+        if handle is not None:
+            try:
+                # One long job on an executor thread in the green modes
+                print(f'Compaction: {db_executor.run(compact_messages)}')
+            except Exception as e:
+                print(f'Compaction failed: {e}')
+            finally:
+                MessageArchive.finished(handle)
+        socketio.sleep(min(app.config['COMPACTION_INTERVAL'], 3600))
+
+atexit.register(retire_presence)
+
+# Read/delivered watermarks, coalesced per chat and written by presence_loop
+receipts = ReceiptBuffer()
+
+def flush_receipts():
+    conn = get_db()
+    try:
+        receipts.flush(conn)
+    finally:
+        conn.close()
+
+atexit.register(flush_receipts)
+
+def chat_watermarks(conn, user_id, chat_user_id):
+    # {user: (read_up_to, delivered_up_to)} for both sides of a chat,
+    # including receipts that are not flushed yet
+    watermarks = {user_id: (0, 0), chat_user_id: (0, 0)}
+    for row in conn.execute(CHAT_WATERMARKS_SQL, (user_id, chat_user_id, chat_user_id, user_id)):
+        watermarks[row['user_id']] = (row['read_up_to'], row['delivered_up_to'])
+    for reader, sender in ((user_id, chat_user_id), (chat_user_id, user_id)):
+        read_up_to, delivered_up_to = receipts.pending(reader, sender)
+        stored_read, stored_delivered = watermarks[reader]
+        watermarks[reader] = (max(read_up_to, stored_read), max(delivered_up_to, stored_delivered))
+    return watermarks
+
+def apply_receipts(messages, watermarks):
+    # A message's status follows its receiver's watermarks; never downgrade
+    for message in messages:
+        read_up_to, delivered_up_to = watermarks.get(message['receiver_id'], (0, 0))
+        if message['timestamp'] <= read_up_to:
+            message['status'] = 'read'
+        elif message['timestamp'] <= delivered_up_to and message['status'] == 'sent':
+            message['status'] = 'delivered'
+
+def record_receipt(reader_id, sender_id, read_up_to=0, delivered_up_to=0):
+    # One coalesced status event to the sender instead of one per message
+    now = int(datetime.now().timestamp() * 1000)
+    read_up_to, delivered_up_to = receipts.add(reader_id, sender_id,
+                                               min(read_up_to, now), min(delivered_up_to, now))
+    chat_lists.read(reader_id, sender_id, read_up_to)
+    emit_to('messages_status', {
+        'chat_user_id': reader_id,
+        'read_up_to': read_up_to,
+        'delivered_up_to': delivered_up_to
+    }, sender_id)
+    return read_up_to, delivered_up_to
+
+def trim_changes(before, batch=10000):
+    # Drop the log up to its first row newer than `before`, from the front
+    # and in batches to keep each write short. Always a prefix, so a cursor
+    # is either fully covered by the log or older than all of it.
+    conn = get_db()
+    try:
+        row = conn.execute('SELECT seq FROM changes WHERE created_at >= ? ORDER BY seq LIMIT 1',
+                           (before,)).fetchone()
+        if row is None:
+            row = conn.execute('SELECT MAX(seq) + 1 AS seq FROM changes').fetchone()
+        end = row['seq']
+        while end is not None:
+            cursor = conn.execute('DELETE FROM changes WHERE seq < MIN(?, (SELECT MIN(seq) FROM changes) + ?)',
+                                  (end, batch))
+            conn.commit()
+            if cursor.rowcount < batch:
+                break
+    finally:
+        conn.close()
+
+def messages_committing(messages):
+    # Chat lists loading while the batch commits must not be cached
+    return chat_lists.cancel_loads(*{user_id for message in messages
+                                     for user_id in (message['sender_id'], message['receiver_id'])})
+
+def messages_committed(messages, since=None):
+    # A batch may have created chat rows, i.e. new presence watchers; the
+    # cached chat lists of both sides get the new last message
+    for message in messages:
+        contacts.invalidate(message['sender_id'], message['receiver_id'])
+        last_message = message['text'] if message['text'] else '📷 Image'
+        chat_lists.message(message['sender_id'], message['receiver_id'],
+                           last_message, message['timestamp'], since=since)
+        chat_lists.message(message['receiver_id'], message['sender_id'],
+                           last_message, message['timestamp'], incoming=True, since=since)
+
+# New messages are written behind the request and group-committed
+ingestor = MessageIngestor(db_pool.connect,
+                           batch_interval=app.config['MESSAGE_BATCH_INTERVAL'],
+                           max_batch=app.config['MESSAGE_BATCH_MAX'],
+                           before_commit=messages_committing,
+                           after_commit=messages_committed)
+atexit.register(ingestor.stop)
+
+# Hot-path queries. Everything in HOT_QUERIES is checked by
+# `flask check-query-plans`, which fails if any of them needs a full SCAN.
+# Entries are SQL, or (SQL, sample params) when the plan depends on them.
+GET_CHATS_SQL = '''SELECT c.chat_user_id, c.last_message, c.last_message_time,
+                     c.unread_count, c.read_up_to, u.username, u.profile_image, u.bio,
+                     s.online, s.last_seen
+                 FROM chats c
+                 JOIN users u ON c.chat_user_id = u.id
+                 LEFT JOIN user_status s ON c.chat_user_id = s.user_id
+                 WHERE c.user_id = ?
+                 ORDER BY c.last_message_time DESC'''
+
+GET_MESSAGES_SQL = '''SELECT * FROM messages 
+                 WHERE chat_id = ? 
+                 AND deleted_for_everyone = 0
+                 AND ((sender_id = ? AND deleted_for_sender = 0) 
+                      OR (receiver_id = ? AND deleted_for_receiver = 0))
+                 ORDER BY timestamp DESC, id DESC
+                 LIMIT ?'''
+
+# Older page: everything strictly before the (timestamp, id) cursor
+GET_MESSAGES_BEFORE_SQL = '''SELECT * FROM messages 
+                 WHERE chat_id = ? 
+                 AND deleted_for_everyone = 0
+                 AND ((sender_id = ? AND deleted_for_sender = 0) 
+                      OR (receiver_id = ? AND deleted_for_receiver = 0))
+                 AND (timestamp, id) < (?, ?)
+                 ORDER BY timestamp DESC, id DESC
+                 LIMIT ?'''
+
+# Catch-up page: everything strictly after the cursor, oldest first
+GET_MESSAGES_AFTER_SQL = '''SELECT * FROM messages 
+                 WHERE chat_id = ? 
+                 AND deleted_for_everyone = 0
+                 AND ((sender_id = ? AND deleted_for_sender = 0) 
+                      OR (receiver_id = ? AND deleted_for_receiver = 0))
+                 AND (timestamp, id) > (?, ?)
+                 ORDER BY timestamp ASC, id ASC
+                 LIMIT ?'''
+
+CHAT_WATERMARKS_SQL = '''SELECT user_id, read_up_to, delivered_up_to FROM chats
+                 WHERE (user_id = ? AND chat_user_id = ?)
+                    OR (user_id = ? AND chat_user_id = ?)'''
+
+SYNC_CHANGES_SQL = '''SELECT seq, kind, chat_user_id, message_id FROM changes
+                 WHERE user_id = ? AND seq > ?
+                 ORDER BY seq
+                 LIMIT ?'''
+
+GET_USER_SQL = '''SELECT u.id, u.username, u.profile_image, u.bio,
+                     s.online, s.last_seen
+                 FROM users u
+                 LEFT JOIN user_status s ON u.id = s.user_id
+                 WHERE u.id = ?'''
+
+SEARCH_USERS_PREFIX_SQL = '''SELECT u.id, u.username, u.profile_image, u.bio,
+                     s.online, s.last_seen
+                 FROM users u
+                 LEFT JOIN user_status s ON u.id = s.user_id
+                 WHERE u.username LIKE ? ESCAPE '\\' AND u.id != ?
+                 LIMIT ?'''
+
+SEARCH_USERS_SUBSTRING_SQL = '''SELECT u.id, u.username, u.profile_image, u.bio,
+                     s.online, s.last_seen
+                 FROM users_search f
+                 JOIN users u ON u.rowid = f.rowid
+                 LEFT JOIN user_status s ON u.id = s.user_id
+                 WHERE users_search MATCH ? AND u.id != ?
+                 LIMIT ?'''
+
+HOT_QUERIES = {
+    'login': 'SELECT * FROM users WHERE email = ?',
+    'profile': 'SELECT id, email, username, profile_image, bio FROM users WHERE id = ?',
+    'username_taken': 'SELECT id FROM users WHERE username = ? AND id != ?',
+    'get_user': GET_USER_SQL,
+    'search_users_prefix': (SEARCH_USERS_PREFIX_SQL, ('ab%', '', SEARCH_LIMIT)),
+    'search_users_substring': SEARCH_USERS_SUBSTRING_SQL,
+    'get_chats': GET_CHATS_SQL,
+    'chat_exists': 'SELECT * FROM chats WHERE user_id = ? AND chat_user_id = ?',
+    'presence_watchers': 'SELECT user_id FROM chats WHERE chat_user_id = ?',
+    'get_messages': GET_MESSAGES_SQL,
+    'get_messages_before': GET_MESSAGES_BEFORE_SQL,
+    'get_messages_after': GET_MESSAGES_AFTER_SQL,
+    'get_message': 'SELECT * FROM messages WHERE id = ?',
+    'delete_for_everyone': 'UPDATE messages SET deleted_for_everyone = 1 WHERE id = ?',
+    'chat_watermarks': CHAT_WATERMARKS_SQL,
+    'sync_changes': SYNC_CHANGES_SQL,
+    'archived_chat_months': CHAT_MONTHS_SQL,
+}
+
+# Statement labels for chat_db_query_seconds
+QUERY_NAMES = {query[0] if isinstance(query, tuple) else query: name
+               for name, query in HOT_QUERIES.items()}
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Print EXPLAIN QUERY PLAN for every hot query; exit 1 on any SCAN."""
+    conn = get_db()
+    try:
+        for name, query in HOT_QUERIES.items():
+            click.echo(f'{name}:')
+            plan = query_plan(conn, *query) if isinstance(query, tuple) else query_plan(conn, query)
+            for line in plan:
+                click.echo(f'    {line}')
+        scans = find_scans(conn, HOT_QUERIES)
+    finally:
+        conn.close()
+    
+    if scans:
+        click.echo(f"Full scans in: {', '.join(sorted(scans))}", err=True)
+        raise SystemExit(1)
+    click.echo('OK: no hot query scans a table')
+
+@app.cli.command('export-ndjson')
+@click.option('--user', 'user_id', help='Export one user (no password hash) instead of everything.')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+def export_ndjson(user_id, output):
+    """Write users, chats and messages as newline-delimited JSON."""
+    lines = export_user(get_db, user_id, archive=archive) if user_id else export_all(get_db, archive=archive)
+    for line in lines:
+        output.write(line)
+
+@app.cli.command('import-ndjson')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--batch-size', default=10000, show_default=True)
+@click.option('--commit-rows', default=500000, show_default=True)
+def import_ndjson_command(source, batch_size, commit_rows):
+    """Bulk-load an export-ndjson file; stop the app first."""
+    conn = sqlite3.connect(app.config['DATABASE'])
+    try:
+        started = time.perf_counter()
+        counts = import_ndjson(conn, source, batch_size, commit_rows)
+    finally:
+        conn.close()
+    for kind, (inserted, skipped) in counts.items():
+        click.echo(f'{kind}: {inserted} inserted, {skipped} skipped')
+    click.echo(f'{time.perf_counter() - started:.1f}s')
+
+@app.cli.command('compact')
+@click.option('--archive-after-days', type=int, help='Override ARCHIVE_AFTER_DAYS (0: archive nothing).')
+@click.option('--vacuum', is_flag=True,
+              help='First switch the database to incremental vacuum (one full VACUUM; stop the app).')
+def compact_command(archive_after_days, vacuum):
+    """Purge dead messages, archive old ones and free their pages."""
+    if vacuum:
+        conn = sqlite3.connect(app.config['DATABASE'])
+        try:
+            converted = enable_incremental_vacuum(conn)
+        finally:
+            conn.close()
+        click.echo('Converted to auto_vacuum=INCREMENTAL' if converted else 'Already incremental')
+    click.echo(json.dumps(compact_messages(archive_after_days)))
+
+# Verified tokens are cached until they expire or are revoked
+token_cache = TokenCache(app.config['SECRET_KEY'], algorithms=['HS256'],
+                         max_entries=app.config['TOKEN_CACHE_SIZE'])
+
+def sync_revoked_tokens():
+    # Logouts handled by other workers (and, at startup, before a restart)
+    conn = get_db()
+    try:
+        token_cache.sync(conn)
+    finally:
+        conn.close()
+
+def trim_revoked_tokens():
+    conn = get_db()
+    try:
+        TokenCache.trim(conn)
+    finally:
+        conn.close()
+
+sync_revoked_tokens()
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 queue_timeout=app.config['PASSWORD_HASH_QUEUE_TIMEOUT'])
+atexit.register(password_hasher.shutdown)
+
+def hasher_busy():
+    return jsonify({'error': 'Too many sign-ins right now, try again shortly'}), 429, {'Retry-After': '1'}
+
+def hasher_unavailable():
+    # A timed out or crashed hashing worker: the fault is ours, not load
+    return jsonify({'error': 'Sign-in is temporarily unavailable, try again shortly'}), 503, {'Retry-After': '1'}
 
 # JWT token decorator
 def token_required(f):
@@ -102,15 +886,37 @@ def token_required(f):
         try:
             if token.startswith('Bearer '):
                 token = token[7:]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            data = token_cache.verify(token)
             current_user_id = data['user_id']
         except:
             return jsonify({'error': 'Token is invalid'}), 401
         
+        if CLUSTERED:
+            # The background task picks up other workers' logouts, also on
+            # a worker that only serves REST
+            start_presence_task()
+        
         return f(current_user_id, *args, **kwargs)
     
     return decorated
 
+def has_metrics_token():
+    expected = app.config['METRICS_TOKEN']
+    return bool(expected) and hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                  f'Bearer {expected}')
+
+def operator_required(f):
+    # Debug endpoints: Authorization: Bearer <METRICS_TOKEN>, not a user token
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not app.config['METRICS_TOKEN']:
+            return jsonify({'error': 'Set METRICS_TOKEN to use debug endpoints'}), 403
+        if not has_metrics_token():
+            return jsonify({'error': 'Token is invalid'}), 401
+        return f(*args, **kwargs)
+    
+    return decorated
+
 # Auth Routes
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
@@ -132,7 +938,14 @@ def signup():
     
     # Create user
     user_id = str(uuid.uuid4())
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except HasherBusy:
+        conn.close()
+        return hasher_busy()
+    except HasherUnavailable:
+        conn.close()
+        return hasher_unavailable()
     
     c.execute('INSERT INTO users (id, email, password) VALUES (?, ?, ?)',
               (user_id, email, hashed_password))
@@ -142,6 +955,7 @@ def signup():
     # Generate token
     token = jwt.encode({
         'user_id': user_id,
+        'iat': datetime.utcnow(),
         'exp': datetime.utcnow() + timedelta(days=30)
     }, app.config['SECRET_KEY'])
     
@@ -167,12 +981,30 @@ def login():
     user = c.fetchone()
     conn.close()
     
-    if not user or not check_password_hash(user['password'], password):
+    try:
+        valid = user is not None and password_hasher.verify(user['password'], password)
+    except HasherBusy:
+        return hasher_busy()
+    except HasherUnavailable:
+        return hasher_unavailable()
+    
+    if not valid:
         return jsonify({'error': 'Invalid credentials'}), 401
     
+    # Bring hashes made with older parameters up to date; the condition
+    # keeps a password change that happened meanwhile
+    new_hash = password_hasher.upgrade(user['password'], password)
+    if new_hash:
+        conn = get_db()
+        conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                     (new_hash, user['id'], user['password']))
+        conn.commit()
+        conn.close()
+    
     # Generate token
     token = jwt.encode({
         'user_id': user['id'],
+        'iat': datetime.utcnow(),
         'exp': datetime.utcnow() + timedelta(days=30)
     }, app.config['SECRET_KEY'])
     
@@ -185,6 +1017,20 @@ def login():
         'bio': user['bio']
     }), 200
 
+@app.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user_id):
+    token = request.headers.get('Authorization')
+    if token.startswith('Bearer '):
+        token = token[7:]
+    conn = get_db()
+    try:
+        token_cache.revoke(token, conn)
+    finally:
+        conn.close()
+    
+    return jsonify({'message': 'Logged out successfully'}), 200
+
 @app.route('/api/auth/profile', methods=['GET', 'POST'])
 @token_required
 def profile(current_user_id):
@@ -226,6 +1072,9 @@ def profile(current_user_id):
         conn.commit()
         conn.close()
         
+        chat_lists.contact_changed(contacts.watchers(current_user_id), current_user_id,
+                                   username=username, profile_image=profile_image, bio=bio)
+        
         return jsonify({
             'message': 'Profile updated successfully',
             'username': username,
@@ -243,29 +1092,11 @@ def search_users(current_user_id):
         return jsonify({'users': []}), 200
     
     conn = get_db()
-    c = conn.cursor()
-    
-    c.execute('''SELECT id, username, profile_image, bio 
-                 FROM users 
-                 WHERE username LIKE ? AND id != ? AND username IS NOT NULL
-                 LIMIT 20''',
-              (f'%{query}%', current_user_id))
-    
-    users = [dict(row) for row in c.fetchall()]
+    users = find_users(conn, query, current_user_id, SEARCH_LIMIT)
+    conn.close()
     
-    # Get online status for each user
     for user in users:
-        c.execute('SELECT online, last_seen FROM user_status WHERE user_id = ?', 
-                  (user['id'],))
-        status = c.fetchone()
-        if status:
-            user['online'] = bool(status['online'])
-            user['last_seen'] = status['last_seen']
-        else:
-            user['online'] = False
-            user['last_seen'] = int(datetime.now().timestamp() * 1000)
-    
-    conn.close()
+        apply_status(user)
     
     return jsonify({'users': users}), 200
 
@@ -275,56 +1106,84 @@ def get_user(current_user_id, user_id):
     conn = get_db()
     c = conn.cursor()
     
-    c.execute('SELECT id, username, profile_image, bio FROM users WHERE id = ?', 
-              (user_id,))
+    c.execute(GET_USER_SQL, (user_id,))
     user = c.fetchone()
+    conn.close()
     
     if not user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
     
-    user_data = dict(user)
-    
-    # Get status
-    c.execute('SELECT online, last_seen FROM user_status WHERE user_id = ?', (user_id,))
-    status = c.fetchone()
-    if status:
-        user_data['online'] = bool(status['online'])
-        user_data['last_seen'] = status['last_seen']
-    else:
-        user_data['online'] = False
-        user_data['last_seen'] = int(datetime.now().timestamp() * 1000)
+    return jsonify(apply_status(dict(user))), 200
+
+def find_users(conn, query, exclude_user_id, limit):
+    # Prefix matches first (NOCASE index range), then fill up with substring
+    # matches from the trigram index. Trigrams need at least 3 characters.
+    c = conn.cursor()
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    c.execute(SEARCH_USERS_PREFIX_SQL, (pattern, exclude_user_id, limit))
+    users = [dict(row) for row in c.fetchall()]
     
-    conn.close()
+    if len(users) < limit and len(query) >= 3:
+        seen = {user['id'] for user in users}
+        phrase = '"' + query.replace('"', '""') + '"'
+        c.execute(SEARCH_USERS_SUBSTRING_SQL, (phrase, exclude_user_id, limit + len(users)))
+        for row in c.fetchall():
+            if row['id'] not in seen and len(users) < limit:
+                users.append(dict(row))
     
-    return jsonify(user_data), 200
+    return users
+
+def apply_status(user):
+    # Live presence comes from memory; the joined user_status row supplies
+    # last_seen for users not seen by this process (and, in a cluster, the
+    # online flag other workers have flushed)
+    online, last_seen = presence.status(user['id'], user['last_seen'],
+                                        CLUSTERED and user['online'])
+    user['online'] = online
+    user['last_seen'] = last_seen if last_seen is not None else int(datetime.now().timestamp() * 1000)
+    return user
 
 # Chat Routes
+# Chat lists are served from memory and patched by the write paths; a
+# client holding the current ETag gets a 304 without a query or a body
+chat_lists = ChatListCache(app.config['CHAT_LIST_CACHE_BYTES'],
+                           ttl=app.config['CHAT_LIST_CACHE_TTL'] if CLUSTERED else None)
+# ETags carry this so versions from an earlier process never match
+CHAT_LIST_EPOCH = uuid.uuid4().hex[:8]
+
+def load_chat_list(user_id):
+    conn = get_db()
+    try:
+        return conn.execute(GET_CHATS_SQL, (user_id,)).fetchall()
+    finally:
+        conn.close()
+
 @app.route('/api/chats', methods=['GET'])
 @token_required
 def get_chats(current_user_id):
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute('''SELECT c.chat_user_id, c.last_message, c.last_message_time,
-                     u.username, u.profile_image, u.bio,
-                     s.online, s.last_seen
-                 FROM chats c
-                 JOIN users u ON c.chat_user_id = u.id
-                 LEFT JOIN user_status s ON c.chat_user_id = s.user_id
-                 WHERE c.user_id = ?
-                 ORDER BY c.last_message_time DESC''',
-              (current_user_id,))
-    
-    chats = []
-    for row in c.fetchall():
-        chat = dict(row)
-        chat['online'] = bool(chat['online']) if chat['online'] is not None else False
-        chats.append(chat)
-    
-    conn.close()
-    
-    return jsonify({'chats': chats}), 200
+    version, rows = chat_lists.get(current_user_id, load_chat_list)
+    chats = [chat_entry(current_user_id, row) for row in rows]
+    
+    # The version covers the stored rows; presence and unflushed read
+    # receipts are applied per request, so they are part of the ETag too
+    overlay = repr([(chat['online'], chat['last_seen'], chat['unread_count']) for chat in chats])
+    etag = f'{CHAT_LIST_EPOCH}-{version:x}-{zlib.crc32(overlay.encode()):08x}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    
+    return jsonify({'chats': chats}), 200, headers
+
+def chat_entry(user_id, row):
+    chat = dict(row)
+    chat.pop('read_up_to', None)
+    online, chat['last_seen'] = presence.status(chat['chat_user_id'], chat['last_seen'],
+                                                CLUSTERED and chat['online'])
+    chat['online'] = online
+    # A read receipt still waiting for its flush clears the badge now
+    if receipts.pending(user_id, chat['chat_user_id'])[0] >= (chat['last_message_time'] or 0):
+        chat['unread_count'] = 0
+    return chat
 
 @app.route('/api/chats/create', methods=['POST'])
 @token_required
@@ -345,47 +1204,243 @@ def create_chat(current_user_id):
     if not c.fetchone():
         timestamp = int(datetime.now().timestamp() * 1000)
         
-        # Create chat for both users
-        c.execute('''INSERT INTO chats (user_id, chat_user_id, last_message, last_message_time)
+        # Create chat for both users; the other side's row may already exist
+        c.execute('''INSERT OR IGNORE INTO chats (user_id, chat_user_id, last_message, last_message_time)
                      VALUES (?, ?, ?, ?)''',
                   (current_user_id, chat_user_id, '', timestamp))
         
-        c.execute('''INSERT INTO chats (user_id, chat_user_id, last_message, last_message_time)
+        c.execute('''INSERT OR IGNORE INTO chats (user_id, chat_user_id, last_message, last_message_time)
                      VALUES (?, ?, ?, ?)''',
                   (chat_user_id, current_user_id, '', timestamp))
         
         conn.commit()
+        contacts.invalidate(current_user_id, chat_user_id)
+        chat_lists.invalidate(current_user_id, chat_user_id)
     
     conn.close()
     
     return jsonify({'message': 'Chat created successfully'}), 201
 
+# Incremental sync for reconnecting clients
+@app.route('/api/sync', methods=['GET'])
+@token_required
+def sync(current_user_id):
+    # Everything that changed for this user after the `since` cursor, as
+    # current state: new messages, deleted message ids, changed chat rows
+    # and the peers' read/delivered watermarks. Without a cursor, or with
+    # one older than the retained log, the answer is reset=true plus a
+    # fresh cursor: refetch /api/chats and open conversations, then sync.
+    since = request.args.get('since')
+    limit = app.config['SYNC_MAX_CHANGES']
+    
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute('SELECT MIN(seq) AS first, (SELECT seq FROM sqlite_sequence WHERE name = ?) AS latest FROM changes',
+                  ('changes',))
+        bounds = c.fetchone()
+        latest = bounds['latest'] or 0
+        first = bounds['first'] if bounds['first'] is not None else latest + 1
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        if since is None or since < first - 1 or since > latest:
+            return jsonify({'reset': True, 'cursor': str(latest)}), 200
+        
+        c.execute(SYNC_CHANGES_SQL, (current_user_id, since, limit))
+        changes = c.fetchall()
+        cursor = changes[-1]['seq'] if changes else since
+        
+        # Collapse the log: each message, chat and watermark is sent once
+        message_ids, deleted, chat_ids, status_ids = [], set(), set(), set()
+        for change in changes:
+            kind = change['kind']
+            if kind == 'message':
+                message_ids.append(change['message_id'])
+                chat_ids.add(change['chat_user_id'])
+            elif kind == 'delete':
+                deleted.add(change['message_id'])
+                chat_ids.add(change['chat_user_id'])
+            elif kind == 'status':
+                status_ids.add(change['chat_user_id'])
+            else:
+                chat_ids.add(change['chat_user_id'])
+        
+        messages = []
+        if message_ids:
+            placeholders = ','.join('?' * len(message_ids))
+            c.execute(f'''SELECT * FROM messages WHERE id IN ({placeholders})
+                          AND deleted_for_everyone = 0
+                          AND ((sender_id = ? AND deleted_for_sender = 0)
+                               OR (receiver_id = ? AND deleted_for_receiver = 0))
+                          ORDER BY timestamp, id''',
+                      message_ids + [current_user_id, current_user_id])
+            messages = [dict(row) for row in c.fetchall()]
+        
+        chats = []
+        if chat_ids:
+            placeholders = ','.join('?' * len(chat_ids))
+            c.execute(GET_CHATS_SQL.replace('WHERE c.user_id = ?',
+                                            f'WHERE c.user_id = ? AND c.chat_user_id IN ({placeholders})'),
+                      [current_user_id] + list(chat_ids))
+            chats = [chat_entry(current_user_id, row) for row in c.fetchall()]
+        
+        # Watermarks for every chat the delta touches: the peer's, for
+        # statuses, and this user's, for the status of received messages
+        peers = chat_ids | status_ids
+        watermarks = {}
+        if peers:
+            placeholders = ','.join('?' * len(peers))
+            c.execute(f'''SELECT user_id, chat_user_id, read_up_to, delivered_up_to FROM chats
+                          WHERE (user_id = ? AND chat_user_id IN ({placeholders}))
+                             OR (chat_user_id = ? AND user_id IN ({placeholders}))''',
+                      [current_user_id, *peers, current_user_id, *peers])
+            for row in c.fetchall():
+                watermarks[(row['user_id'], row['chat_user_id'])] = (row['read_up_to'],
+                                                                     row['delivered_up_to'])
+    finally:
+        conn.close()
+    
+    for key in list(watermarks):
+        read_up_to, delivered_up_to = receipts.pending(*key)
+        stored_read, stored_delivered = watermarks[key]
+        watermarks[key] = (max(read_up_to, stored_read), max(delivered_up_to, stored_delivered))
+    for message in messages:
+        apply_receipts([message], {message['receiver_id']: watermarks.get(
+            (message['receiver_id'], message['sender_id']), (0, 0))})
+    
+    statuses = []
+    for peer in sorted(status_ids):
+        read_up_to, delivered_up_to = watermarks.get((peer, current_user_id), (0, 0))
+        statuses.append({'chat_user_id': peer, 'read_up_to': read_up_to,
+                         'delivered_up_to': delivered_up_to})
+    
+    return jsonify({
+        'reset': False,
+        'cursor': str(cursor),
+        'has_more': len(changes) == limit,
+        'messages': messages,
+        'deleted': sorted(deleted),
+        'chats': chats,
+        'statuses': statuses
+    }), 200
+
+# Data export: the user's profile, chats and messages as NDJSON, streamed
+# page by page so memory stays flat however long the history is
+@app.route('/api/export', methods=['GET'])
+@token_required
+def export_data(current_user_id):
+    response = Response(export_user(get_db, current_user_id, archive=archive), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename=chat-export-{current_user_id}.ndjson'
+    return response
+
 # Message Routes
 @app.route('/api/messages/<chat_user_id>', methods=['GET'])
 @token_required
 def get_messages(current_user_id, chat_user_id):
-    limit = int(request.args.get('limit', 50))
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    # A negative LIMIT means no limit to SQLite
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    before = request.args.get('before')
+    after = request.args.get('after')
+    
+    if before and after:
+        return jsonify({'error': 'Use either before or after, not both'}), 400
+    
+    try:
+        cursor = decode_cursor(before or after) if (before or after) else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
     
     conn = get_db()
     c = conn.cursor()
     
     chat_id = get_chat_id(current_user_id, chat_user_id)
+    params = (chat_id, current_user_id, current_user_id)
     
-    c.execute('''SELECT * FROM messages 
-                 WHERE chat_id = ? 
-                 AND deleted_for_everyone = 0
-                 AND ((sender_id = ? AND deleted_for_sender = 0) 
-                      OR (receiver_id = ? AND deleted_for_receiver = 0))
-                 ORDER BY timestamp DESC
-                 LIMIT ?''',
-              (chat_id, current_user_id, current_user_id, limit))
+    # Fetch one extra row to learn whether another page exists
+    if after:
+        c.execute(GET_MESSAGES_AFTER_SQL, params + cursor + (limit + 1,))
+    elif before:
+        c.execute(GET_MESSAGES_BEFORE_SQL, params + cursor + (limit + 1,))
+    else:
+        c.execute(GET_MESSAGES_SQL, params + (limit + 1,))
     
-    messages = [dict(row) for row in c.fetchall()]
-    messages.reverse()
+    messages = with_archived(conn, [dict(row) for row in c.fetchall()],
+                             chat_id, current_user_id, cursor, bool(after), limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
     
+    watermarks = chat_watermarks(conn, current_user_id, chat_user_id)
     conn.close()
+    apply_receipts(messages, watermarks)
+    
+    # prev_cursor pages back into older history, next_cursor catches up on
+    # anything newer than this page
+    if messages:
+        prev_cursor = encode_cursor(messages[0]['timestamp'], messages[0]['id'])
+        next_cursor = encode_cursor(messages[-1]['timestamp'], messages[-1]['id'])
+    else:
+        prev_cursor = before
+        next_cursor = after
+    
+    # How far the other user has received and read this user's messages
+    peer_read_up_to, peer_delivered_up_to = watermarks[chat_user_id]
     
-    return jsonify({'messages': messages}), 200
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        'prev_cursor': prev_cursor,
+        'next_cursor': next_cursor,
+        'read_up_to': peer_read_up_to,
+        'delivered_up_to': peer_delivered_up_to
+    }), 200
+
+def with_archived(conn, messages, chat_id, user_id, cursor, after, limit):
+    # Add archived messages to a history page that reaches back past the
+    # hot table. Archived rows are all older than archive.horizon(); the
+    # page merges both sources so a half-finished compaction (a row in
+    # both, or old rows not moved yet) still pages correctly. Only the
+    # archive months that hold this chat are opened.
+    horizon = archive.horizon()
+    if not horizon:
+        return messages
+    if after:
+        needed = cursor[0] < horizon
+    else:
+        needed = len(messages) < limit or messages[-1]['timestamp'] < horizon
+    if not needed:
+        return messages
+    months = archive.chat_months(conn, chat_id)
+    if not months:
+        return messages
+    merged = {m['id']: m for m in db_executor.run(archive.page, chat_id, user_id, cursor, after, limit,
+                                                   months)}
+    merged.update((m['id'], m) for m in messages)
+    return sorted(merged.values(), key=lambda m: (m['timestamp'], m['id']), reverse=not after)[:limit]
+
+@app.route('/api/chats/<chat_user_id>/receipts', methods=['POST'])
+@token_required
+def post_receipts(current_user_id, chat_user_id):
+    # Batched receipts: everything chat_user_id sent up to these timestamps
+    # has been received / read
+    data = request.get_json() or {}
+    try:
+        read_up_to = int(data.get('read_up_to') or 0)
+        delivered_up_to = int(data.get('delivered_up_to') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'read_up_to and delivered_up_to must be timestamps'}), 400
+    
+    start_presence_task()
+    read_up_to, delivered_up_to = record_receipt(current_user_id, chat_user_id,
+                                                 read_up_to, delivered_up_to)
+    return jsonify({'read_up_to': read_up_to, 'delivered_up_to': delivered_up_to}), 200
 
 @app.route('/api/messages/send', methods=['POST'])
 @token_required
@@ -398,48 +1453,39 @@ def send_message(current_user_id):
     if not receiver_id or (not text and not image_url):
         return jsonify({'error': 'receiver_id and message content required'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    message_id = str(uuid.uuid4())
-    chat_id = get_chat_id(current_user_id, receiver_id)
-    timestamp = int(datetime.now().timestamp() * 1000)
-    
-    # Insert message
-    c.execute('''INSERT INTO messages 
-                 (id, chat_id, sender_id, receiver_id, text, image_url, timestamp, status)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (message_id, chat_id, current_user_id, receiver_id, text, image_url, timestamp, 'sent'))
-    
-    # Update last message in chats
-    last_msg = text if text else '📷 Image'
-    c.execute('''INSERT OR REPLACE INTO chats (user_id, chat_user_id, last_message, last_message_time)
-                 VALUES (?, ?, ?, ?)''',
-              (current_user_id, receiver_id, last_msg, timestamp))
+    message, ticket = queue_message(current_user_id, receiver_id, text, image_url)
     
-    c.execute('''INSERT OR REPLACE INTO chats (user_id, chat_user_id, last_message, last_message_time)
-                 VALUES (?, ?, ?, ?)''',
-              (receiver_id, current_user_id, last_msg, timestamp))
-    
-    conn.commit()
-    conn.close()
+    if app.config['MESSAGE_DURABILITY'] == 'commit':
+        try:
+            ticket.wait(app.config['MESSAGE_COMMIT_TIMEOUT'])
+        except Exception:
+            return jsonify({'error': 'Message could not be saved'}), 500
     
+    return jsonify(message), 201
+
+def queue_message(sender_id, receiver_id, text, image_url, client_id=None):
+    # Shared by the REST endpoint and the send_message socket event
     message = {
-        'id': message_id,
-        'chat_id': chat_id,
-        'sender_id': current_user_id,
+        'id': str(uuid.uuid4()),
+        'chat_id': get_chat_id(sender_id, receiver_id),
+        'sender_id': sender_id,
         'receiver_id': receiver_id,
         'text': text,
         'image_url': image_url,
-        'timestamp': timestamp,
+        'timestamp': int(datetime.now().timestamp() * 1000),
         'status': 'sent'
     }
     
-    # Emit via WebSocket
-    socketio.emit('new_message', message, room=receiver_id)
-    socketio.emit('new_message', message, room=current_user_id)
+    # Queue the message and chat-list update for the next group commit
+    ticket = ingestor.submit(message)
     
-    return jsonify(message), 201
+    # Emit via WebSocket; client_id lets the sender's other tabs match up
+    # their optimistic copy
+    payload = dict(message, client_id=client_id) if client_id else message
+    emit_to('new_message', payload, receiver_id)
+    emit_to('new_message', payload, sender_id)
+    
+    return message, ticket
 
 @app.route('/api/messages/<message_id>/delete', methods=['POST'])
 @token_required
@@ -450,9 +1496,12 @@ def delete_message(current_user_id, message_id):
     conn = get_db()
     c = conn.cursor()
     
-    # Get message
+    # Get message; old ones may have moved to the archive
     c.execute('SELECT * FROM messages WHERE id = ?', (message_id,))
     message = c.fetchone()
+    archived_month = None
+    if not message:
+        archived_month, message = db_executor.run(archive.find, message_id)
     
     if not message:
         conn.close()
@@ -463,17 +1512,43 @@ def delete_message(current_user_id, message_id):
         return jsonify({'error': 'You can only delete your own messages for everyone'}), 403
     
     if delete_type == 'everyone':
-        c.execute('UPDATE messages SET deleted_for_everyone = 1 WHERE id = ?', (message_id,))
-        socketio.emit('message_deleted', {'message_id': message_id, 'type': 'everyone'}, 
-                      room=message['receiver_id'])
+        column, hidden_from = 'deleted_for_everyone', (message['sender_id'], message['receiver_id'])
+        emit_to('message_deleted', {'message_id': message_id, 'type': 'everyone'},
+                message['receiver_id'])
+    elif message['sender_id'] == current_user_id:
+        column, hidden_from = 'deleted_for_sender', (message['sender_id'],)
+    else:
+        column, hidden_from = 'deleted_for_receiver', (message['receiver_id'],)
+    
+    if archived_month is None:
+        c.execute(f'UPDATE messages SET {column} = 1 WHERE id = ?', (message_id,))
     else:
-        if message['sender_id'] == current_user_id:
-            c.execute('UPDATE messages SET deleted_for_sender = 1 WHERE id = ?', (message_id,))
-        else:
-            c.execute('UPDATE messages SET deleted_for_receiver = 1 WHERE id = ?', (message_id,))
+        db_executor.run(archive.set_flag, archived_month, message_id, column)
+        # The sync change log triggers only watch the hot table
+        if not message[column]:
+            now = int(datetime.now().timestamp() * 1000)
+            c.executemany('''INSERT INTO changes (user_id, kind, chat_user_id, message_id, created_at)
+                             VALUES (?, 'delete', ?, ?, ?)''',
+                          [(user_id, message['receiver_id'] if user_id == message['sender_id']
+                            else message['sender_id'], message_id, now)
+                           for user_id in hidden_from])
+    
+    # An unread message the receiver can no longer see leaves their count
+    hidden_from_receiver = delete_type == 'everyone' or message['sender_id'] != current_user_id
+    unread_removed = (hidden_from_receiver and not message['deleted_for_everyone']
+                      and not message['deleted_for_receiver'])
+    if unread_removed:
+        c.execute('''UPDATE chats SET unread_count = unread_count - 1
+                     WHERE user_id = ? AND chat_user_id = ?
+                       AND unread_count > 0 AND read_up_to < ?''',
+                  (message['receiver_id'], message['sender_id'], message['timestamp']))
+        mark = chat_lists.cancel_loads(message['receiver_id'])
     
     conn.commit()
     conn.close()
+    if unread_removed:
+        chat_lists.unread_removed(message['receiver_id'], message['sender_id'], message['timestamp'],
+                                  since=mark)
     
     return jsonify({'message': 'Message deleted successfully'}), 200
 
@@ -490,113 +1565,450 @@ def upload_image(current_user_id):
         return jsonify({'error': 'No selected file'}), 400
     
     if file:
-        filename = secure_filename(f"{uuid.uuid4()}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Decoding and re-encoding happens in the image process pool
+        data = file.read()
+        upload_bytes.observe(len(data))
+        try:
+            key = image_store.store(data)
+        except InvalidImage:
+            return jsonify({'error': 'Unsupported or corrupt image'}), 400
+        except RenderUnavailable as e:
+            print(f'Image upload failed: {e}')
+            return jsonify({'error': 'Image processing unavailable, try again'}), 503, {'Retry-After': '1'}
         
-        image_url = f"/api/images/{filename}"
+        # image_url stays the full-size variant for older clients; others
+        # pick the smallest variant that fits where they render it
+        variants = {variant: f"/api/images/{variant_filename(key, variant)}"
+                    for variant in VARIANTS}
         
-        return jsonify({'image_url': image_url}), 200
+        return jsonify({
+            'image_url': variants['full'],
+            'variants': variants,
+            'sizes': VARIANTS
+        }), 200
 
 @app.route('/api/images/<filename>')
 def get_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Image filenames are content hashes (or uuids for older uploads), so a
+    # file never changes: strong ETag, immutable caching, Range support.
+    cached = hot_images.get(filename)
+    if cached is None:
+        # Resolve against the working directory, like the upload side does
+        path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        if stat is None or not S_ISREG(stat.st_mode):
+            abort(404)
+        etag = image_etag(filename, stat)
+        
+        if not hot_images.accepts(stat.st_size):
+            # Streamed by the server (sendfile under gunicorn, or X-Sendfile)
+            response = send_file(path, etag=etag, conditional=True)
+            response.headers['Cache-Control'] = image_cache_control()
+            return response
+        
+        with open(path, 'rb') as f:
+            cached = (f.read(), etag)
+        hot_images.put(filename, *cached)
+    
+    data, etag = cached
+    response = Response(data, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                        headers={'ETag': f'"{etag}"', 'Cache-Control': image_cache_control()})
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+def image_cache_control():
+    return f"public, max-age={app.config['IMAGE_MAX_AGE']}, immutable"
+
+CONTENT_ADDRESSED = re.compile(r'^([0-9a-f]{64})_')
+
+def image_etag(filename, stat):
+    # The content hash is the best validator; older uploads fall back to
+    # mtime and size
+    match = CONTENT_ADDRESSED.match(filename)
+    if match:
+        return match.group(1)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+@app.route('/api/debug/db-pool', methods=['GET'])
+@operator_required
+def db_pool_stats():
+    return jsonify(dict(db_pool.stats(), executor=db_executor.stats())), 200
+
+@app.route('/api/debug/token-cache', methods=['GET'])
+@operator_required
+def token_cache_stats():
+    return jsonify(token_cache.stats()), 200
+
+@app.route('/api/debug/chat-cache', methods=['GET'])
+@operator_required
+def chat_cache_stats():
+    return jsonify(chat_lists.stats()), 200
+
+@app.route('/api/debug/password-hasher', methods=['GET'])
+@operator_required
+def password_hasher_stats():
+    return jsonify(password_hasher.stats()), 200
+
+@app.route('/api/debug/ingest', methods=['GET'])
+@operator_required
+def ingest_stats():
+    return jsonify(ingestor.stats()), 200
+
+# Metrics endpoints
+def room_size(room, namespace='/'):
+    # Sockets in a room on this worker
+    return len(socketio.server.manager.rooms.get(namespace, {}).get(room, ()))
+
+def emit_to(event, payload, room):
+    # Server-initiated emits go through here so fan-out is measured.
+    # Sockets that negotiated a compact encoding are in "<room>#<encoding>"
+    # and get the payload packed once per encoding.
+    socketio.emit(event, payload, room=room)
+    recipients = room_size(room)
+    emits_total.inc((event,))
+    sample = app.config['EMIT_SIZE_SAMPLE']
+    measure = next(emit_size_samples) % sample == 0
+    if recipients:
+        emit_recipients_total.inc((event,), recipients)
+        if measure:
+            emit_bytes_total.inc((event,), sample * recipients * emitted_size(payload))
+    for encoding in app.config['COMPACT_ENCODINGS']:
+        compact_room = f'{room}#{encoding}'
+        compact_recipients = room_size(compact_room)
+        # Members may be on other workers (only when COMPACT_ENCODINGS
+        # was set explicitly for a cluster)
+        if compact_recipients or CLUSTERED:
+            data = wire.pack(payload, encoding)
+            socketio.emit(event, data, room=compact_room)
+            if compact_recipients:
+                emit_recipients_total.inc((event,), compact_recipients)
+                if isinstance(data, bytes):
+                    emit_bytes_total.inc((event,), compact_recipients * len(data))
+                elif measure:
+                    emit_bytes_total.inc((event,), sample * compact_recipients * emitted_size(data))
+
+def emitted_size(payload):
+    return len(app.json.dumps(payload))
+
+# sid -> compact encoding the socket negotiated; plain JSON sockets aren't here
+socket_encodings = {}
+
+def user_room(user_id):
+    # The personal room the current socket joins for user_id's events
+    encoding = socket_encodings.get(request.sid)
+    return f'{user_id}#{encoding}' if encoding else user_id
+
+def instrumented(event):
+    # Record the latency of a Socket.IO event handler
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                socket_event_seconds.observe(time.perf_counter() - started, (event,))
+        return decorated
+    return decorator
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def compress_response(response):
+    # Large JSON bodies (message pages, chat lists, sync) only; streamed
+    # responses and files are left alone
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 304)):
+        return response
+    coding = wire.content_coding(request.accept_encodings)
+    data = response.get_data()
+    response.vary.add('Accept-Encoding')
+    if coding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(wire.compress(data, coding))
+    response.headers['Content-Encoding'] = coding
+    # The validator belongs to the uncompressed body
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started,
+                                     (request.method, route, str(response.status_code)))
+    return response
+
+metrics.gauge('chat_socket_connections', 'Open Engine.IO connections on this worker',
+              lambda: len(socketio.server.eio.sockets))
+metrics.gauge('chat_socket_rooms', 'Socket.IO rooms on this worker, including per-socket rooms',
+              lambda: len(socketio.server.manager.rooms.get('/', {})))
+metrics.gauge('chat_users_online', 'Users with at least one authenticated socket on this worker',
+              lambda: presence.online_count())
+metrics.gauge('chat_db_pool_connections', 'Pooled SQLite connections by state',
+              lambda: {('in_use',): db_pool.stats()['in_use'], ('idle',): db_pool.stats()['idle']},
+              ('state',))
+metrics.gauge('chat_db_pool_waits_total', 'Checkouts that had to wait for a connection',
+              lambda: db_pool.stats()['waits'], kind='counter')
+metrics.gauge('chat_ingest_queue_depth', 'Messages waiting for the next group commit',
+              lambda: ingestor.stats()['queue_depth'])
+metrics.gauge('chat_token_cache_hits_total', 'Verified-token cache hits',
+              lambda: token_cache.stats()['hits'], kind='counter')
+metrics.gauge('chat_token_cache_misses_total', 'Verified-token cache misses',
+              lambda: token_cache.stats()['misses'], kind='counter')
+metrics.gauge('chat_password_hashes_total', 'Password hash and check calls by outcome',
+              lambda: {('accepted',): password_hasher.stats()['calls'],
+                       ('rejected',): password_hasher.stats()['rejected']},
+              ('outcome',), kind='counter')
+metrics.gauge('chat_password_hashes_in_flight', 'Password hashes running or queued in the pool',
+              lambda: password_hasher.stats()['in_flight'])
+metrics.gauge('chat_list_cache_hits_total', 'Chat lists served from memory',
+              lambda: chat_lists.stats()['hits'], kind='counter')
+metrics.gauge('chat_list_cache_misses_total', 'Chat lists loaded from the database',
+              lambda: chat_lists.stats()['misses'], kind='counter')
+metrics.gauge('chat_list_cache_bytes', 'Estimated memory held by cached chat lists',
+              lambda: chat_lists.stats()['bytes'])
+def typing_event_counts():
+    stats = typing_throttle.stats()
+    return {('start', 'forwarded'): stats['start_forwarded'],
+            ('start', 'dropped'): stats['start_dropped'],
+            ('stop', 'forwarded'): stats['stop_forwarded'],
+            ('stop', 'dropped'): stats['stop_dropped'],
+            ('stop', 'expired'): stats['expired']}
+
+metrics.gauge('chat_typing_events_total', 'Typing events from clients, and expiry stops, by outcome',
+              typing_event_counts, ('kind', 'outcome'), kind='counter')
+metrics.gauge('chat_typing_active', 'Sender/receiver pairs currently shown as typing',
+              lambda: typing_throttle.stats()['active'])
+metrics.gauge('chat_profiler_running', '1 while the sampling profiler is on',
+              lambda: int(profiler.running))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if app.config['METRICS_TOKEN'] and not has_metrics_token():
+        return jsonify({'error': 'Token is invalid'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/debug/profiler', methods=['GET', 'POST'])
+@operator_required
+def sampling_profiler():
+    # POST {"enabled": true, "interval": 0.005} starts sampling, {"enabled":
+    # false} stops it, {"reset": true} drops what was collected. GET returns
+    # the top functions, or ?format=collapsed for flamegraph input.
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        if data.get('reset'):
+            profiler.reset()
+        if data.get('enabled') is True:
+            try:
+                profiler.start(data.get('interval'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        elif data.get('enabled') is False:
+            profiler.stop()
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    return jsonify(profiler.report(request.args.get('limit', 30, type=int))), 200
 
 # WebSocket events
 @socketio.on('connect')
-def handle_connect():
+@instrumented('connect')
+def handle_connect(auth=None):
+    start_presence_task()
+    encoding = wire.negotiate((auth or {}).get('encodings') if isinstance(auth, dict) else None,
+                              app.config['COMPACT_ENCODINGS'])
+    if encoding:
+        socket_encodings[request.sid] = encoding
     print('Client connected')
 
 @socketio.on('disconnect')
+@instrumented('disconnect')
 def handle_disconnect():
+    # Closing the user's last socket takes them offline; contacts are told
+    # after PRESENCE_OFFLINE_GRACE unless they reconnect first
+    timestamp = int(datetime.now().timestamp() * 1000)
+    presence.disconnect(request.sid, timestamp)
+    socket_encodings.pop(request.sid, None)
     print('Client disconnected')
 
 @socketio.on('authenticate')
+@instrumented('authenticate')
 def handle_authenticate(data):
     token = data.get('token')
     
     try:
         if token.startswith('Bearer '):
             token = token[7:]
-        user_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        user_data = token_cache.verify(token)
         user_id = user_data['user_id']
-        
-        # Join user's personal room
-        join_room(user_id)
-        
-        # Update online status
-        conn = get_db()
-        c = conn.cursor()
-        timestamp = int(datetime.now().timestamp() * 1000)
-        
-        c.execute('''INSERT OR REPLACE INTO user_status (user_id, online, last_seen)
-                     VALUES (?, ?, ?)''',
-                  (user_id, 1, timestamp))
-        conn.commit()
-        conn.close()
-        
-        # Notify others
-        socketio.emit('user_online', {'user_id': user_id, 'online': True}, broadcast=True)
-        
-        emit('authenticated', {'user_id': user_id})
     except:
         emit('auth_error', {'error': 'Invalid token'})
+        return
+    
+    # Join user's personal room
+    join_room(user_room(user_id))
+    
+    # Update online status; other tabs of the same user keep it online
+    timestamp = int(datetime.now().timestamp() * 1000)
+    if presence.connect(user_id, request.sid, timestamp):
+        # Notify contacts
+        announce_presence(user_id, 'user_online', {'user_id': user_id, 'online': True})
+    
+    # Always plain JSON; tells a compact client what it got
+    encoding = socket_encodings.get(request.sid)
+    if encoding:
+        emit('authenticated', {'user_id': user_id, 'encoding': encoding, 'keys': wire.KEYS})
+    else:
+        emit('authenticated', {'user_id': user_id})
 
 @socketio.on('user_offline')
+@instrumented('user_offline')
 def handle_user_offline(data):
-    user_id = data.get('user_id')
+    # Only the calling socket goes away; the user stays online while
+    # another of their sockets is connected
+    timestamp = int(datetime.now().timestamp() * 1000)
+    user_id, _ = presence.disconnect(request.sid, timestamp)
     
     if user_id:
-        conn = get_db()
-        c = conn.cursor()
-        timestamp = int(datetime.now().timestamp() * 1000)
-        
-        c.execute('''UPDATE user_status 
-                     SET online = 0, last_seen = ?
-                     WHERE user_id = ?''',
-                  (timestamp, user_id))
-        conn.commit()
-        conn.close()
-        
-        leave_room(user_id)
-        socketio.emit('user_offline', {'user_id': user_id, 'last_seen': timestamp}, broadcast=True)
+        leave_room(user_room(user_id))
+
+@socketio.on('send_message')
+@instrumented('send_message')
+def handle_send_message(data):
+    # Same as POST /api/messages/send, over the already authenticated socket.
+    # The return value is the ack: the server id/timestamp for client_id.
+    sender_id = presence.user_for(request.sid)
+    if not sender_id:
+        return {'error': 'Not authenticated'}
+    
+    data = data or {}
+    client_id = data.get('client_id')
+    receiver_id = data.get('receiver_id')
+    text = data.get('text', '')
+    image_url = data.get('image_url', '')
+    
+    if not receiver_id or (not text and not image_url):
+        return {'client_id': client_id, 'error': 'receiver_id and message content required'}
+    
+    message, ticket = queue_message(sender_id, receiver_id, text, image_url, client_id)
+    
+    if app.config['MESSAGE_DURABILITY'] == 'commit':
+        try:
+            ticket.wait(app.config['MESSAGE_COMMIT_TIMEOUT'])
+        except Exception:
+            return {'client_id': client_id, 'error': 'Message could not be saved'}
+    
+    return {
+        'client_id': client_id,
+        'id': message['id'],
+        'chat_id': message['chat_id'],
+        'timestamp': message['timestamp'],
+        'status': message['status']
+    }
 
 @socketio.on('typing')
+@instrumented('typing')
 def handle_typing(data):
     receiver_id = data.get('receiver_id')
-    sender_id = data.get('sender_id')
+    sender_id = presence.user_for(request.sid) or data.get('sender_id')
     is_typing = data.get('typing', False)
+    if not sender_id or not receiver_id:
+        return
     
-    socketio.emit('user_typing', {
+    # Clients send this on every keystroke; only the first "typing", a
+    # periodic refresh and one "stopped" reach the receiver
+    if is_typing:
+        forward = typing_throttle.start(sender_id, receiver_id)
+    else:
+        forward = typing_throttle.stop(sender_id, receiver_id)
+    if not forward:
+        return
+    emit_to('user_typing', {
         'user_id': sender_id,
         'typing': is_typing
-    }, room=receiver_id)
+    }, receiver_id)
 
 @socketio.on('message_read')
+@instrumented('message_read')
 def handle_message_read(data):
+    # Single-message receipt from older clients: advances the reader's
+    # watermark to this message instead of updating its row
+    reader_id = presence.user_for(request.sid)
+    if not reader_id:
+        return
     message_id = data.get('message_id')
-    reader_id = data.get('reader_id')
     
     conn = get_db()
     c = conn.cursor()
-    
-    c.execute('UPDATE messages SET status = ? WHERE id = ?', ('read', message_id))
-    c.execute('SELECT sender_id FROM messages WHERE id = ?', (message_id,))
+    c.execute('SELECT sender_id, receiver_id, timestamp FROM messages WHERE id = ?', (message_id,))
     result = c.fetchone()
+    conn.close()
     
-    if result:
-        sender_id = result['sender_id']
-        socketio.emit('message_status', {
-            'message_id': message_id,
-            'status': 'read'
-        }, room=sender_id)
+    if not result or reader_id != result['receiver_id']:
+        return
     
-    conn.commit()
-    conn.close()
+    record_receipt(result['receiver_id'], result['sender_id'], read_up_to=result['timestamp'])
+    emit_to('message_status', {
+        'message_id': message_id,
+        'status': 'read'
+    }, result['sender_id'])
+
+def handle_receipt(data, kind):
+    reader_id = presence.user_for(request.sid)
+    if not reader_id:
+        return {'error': 'Not authenticated'}
+    data = data or {}
+    chat_user_id = data.get('chat_user_id')
+    try:
+        up_to = int(data.get('up_to'))
+    except (TypeError, ValueError):
+        return {'error': 'chat_user_id and up_to required'}
+    if not chat_user_id:
+        return {'error': 'chat_user_id and up_to required'}
+    
+    if kind == 'read':
+        read_up_to, delivered_up_to = record_receipt(reader_id, chat_user_id, read_up_to=up_to)
+    else:
+        read_up_to, delivered_up_to = record_receipt(reader_id, chat_user_id, delivered_up_to=up_to)
+    return {'chat_user_id': chat_user_id, 'read_up_to': read_up_to,
+            'delivered_up_to': delivered_up_to}
+
+@socketio.on('messages_read')
+@instrumented('messages_read')
+def handle_messages_read(data):
+    # Everything chat_user_id sent this user up to data['up_to'] was read
+    return handle_receipt(data, 'read')
+
+@socketio.on('messages_delivered')
+@instrumented('messages_delivered')
+def handle_messages_delivered(data):
+    # Everything chat_user_id sent this user up to data['up_to'] arrived
+    return handle_receipt(data, 'delivered')
 
 # Helper function
 def get_chat_id(uid1, uid2):
     return f"{min(uid1, uid2)}_{max(uid1, uid2)}"
 
+# Message history cursors are an opaque url-safe encoding of "timestamp,id"
+def encode_cursor(timestamp, message_id):
+    raw = f"{timestamp},{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split(',', 1)
+        return int(timestamp), message_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
 if __name__ == '__main__':
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,357 @@
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, run one worker
+    fcntl = None
+
+MONTH_FILE = re.compile(r'^messages-(\d{4})-(\d{2})\.db$')
+
+# Rows deleted on both sides are never shown to anyone again
+PURGEABLE = 'deleted_for_everyone = 1 OR (deleted_for_sender = 1 AND deleted_for_receiver = 1)'
+
+# Archived months a chat has rows in, as year * 100 + month. compact()
+# records them in archived_chats in the main database; archived_months
+# lists the months whose chats are all recorded there.
+CHAT_MONTHS_SQL = 'SELECT month FROM archived_chats WHERE chat_id = ?'
+
+VISIBLE = '''chat_id = ?
+             AND deleted_for_everyone = 0
+             AND ((sender_id = ? AND deleted_for_sender = 0)
+                  OR (receiver_id = ? AND deleted_for_receiver = 0))'''
+
+
+def month_of(timestamp):
+    moment = datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+    return moment.year, moment.month
+
+
+def month_start(month):
+    year, number = month
+    return int(datetime(year, number, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def next_month(month):
+    year, number = month
+    return (year + 1, 1) if number == 12 else (year, number + 1)
+
+
+def month_key(month):
+    year, number = month
+    return year * 100 + number
+
+
+class MessageArchive:
+    """Messages past the hot window, in one SQLite file per UTC month.
+
+    compact() moves them out of the main database; page() and find() read
+    them back for history requests that scroll past what is still hot.
+    Archive files are opened per call (read-only for reads), so nothing
+    is held open between requests.
+    """
+
+    def __init__(self, directory, busy_timeout=5.0):
+        self.directory = directory
+        self.busy_timeout = busy_timeout
+        self._months = None  # (marker file identity, months)
+
+    def path(self, month):
+        return os.path.join(self.directory, 'messages-%04d-%02d.db' % month)
+
+    def _marker(self):
+        return os.path.join(self.directory, '.months')
+
+    def months(self):
+        """Archived months, oldest first.
+
+        The list is kept in memory. Compaction replaces the .months marker
+        file whenever it adds a month, before moving any rows there, so one
+        stat() tells every process when to list the directory again.
+        """
+        try:
+            stat = os.stat(self._marker())
+            identity = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            identity = None
+        cached = self._months
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        found = (MONTH_FILE.match(name) for name in names)
+        months = tuple(sorted((int(match.group(1)), int(match.group(2))) for match in found if match))
+        self._months = (identity, months)
+        return months
+
+    def _months_changed(self):
+        marker = self._marker()
+        tmp = f'{marker}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(datetime.now(timezone.utc).isoformat() + '\n')
+        os.replace(tmp, marker)
+        self._months = None
+
+    def horizon(self):
+        """Every archived message is older than this (ms); 0 if none are."""
+        months = self.months()
+        return month_start(next_month(months[-1])) if months else 0
+
+    def connect(self, month, readonly=True):
+        if readonly:
+            conn = sqlite3.connect(f'file:{self.path(month)}?mode=ro', uri=True,
+                                   timeout=self.busy_timeout)
+        else:
+            conn = sqlite3.connect(self.path(month), timeout=self.busy_timeout)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def chat_months(self, conn, chat_id):
+        """Archived months that may hold chat_id's messages, oldest first.
+
+        conn is a main database connection. Months compacted before
+        archived_chats existed are included until compact() records them.
+        """
+        months = self.months()
+        if not months:
+            return ()
+        indexed = {row[0] for row in conn.execute('SELECT month FROM archived_months')}
+        found = {row[0] for row in conn.execute(CHAT_MONTHS_SQL, (chat_id,))}
+        return tuple(month for month in months
+                     if month_key(month) in found or month_key(month) not in indexed)
+
+    def page(self, chat_id, user_id, cursor=None, after=False, limit=50, months=None):
+        """Up to limit visible archived messages next to a (timestamp, id) cursor.
+
+        Newest first before the cursor (or from the newest without one),
+        oldest first after it; months (all by default, else those from
+        chat_months()) are read in that order until limit rows are found.
+        """
+        months = self.months() if months is None else months
+        if after:
+            months = [month for month in months if cursor is None or month >= month_of(cursor[0])]
+            condition, order = 'AND (timestamp, id) > (?, ?)', 'ASC'
+        else:
+            months = [month for month in reversed(months)
+                      if cursor is None or month <= month_of(cursor[0])]
+            condition, order = 'AND (timestamp, id) < (?, ?)', 'DESC'
+        rows = []
+        for month in months:
+            params = (chat_id, user_id, user_id) + (tuple(cursor) if cursor else ())
+            conn = self.connect(month)
+            try:
+                rows += [dict(row) for row in conn.execute(
+                    f'''SELECT * FROM messages WHERE {VISIBLE} {condition if cursor else ''}
+                        ORDER BY timestamp {order}, id {order} LIMIT ?''',
+                    params + (limit - len(rows),))]
+            finally:
+                conn.close()
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def find(self, message_id):
+        """(month, message dict) for an archived message, or (None, None)."""
+        for month in reversed(self.months()):
+            conn = self.connect(month)
+            try:
+                row = conn.execute('SELECT * FROM messages WHERE id = ?', (message_id,)).fetchone()
+            finally:
+                conn.close()
+            if row is not None:
+                return month, dict(row)
+        return None, None
+
+    def set_flag(self, month, message_id, column):
+        """Set a deleted_for_* flag on an archived message."""
+        conn = self.connect(month, readonly=False)
+        try:
+            conn.execute(f'UPDATE messages SET {column} = 1 WHERE id = ?', (message_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Compaction
+
+    def _attach(self, conn, month, attached):
+        alias = 'archive_%04d_%02d' % month
+        if alias in attached:
+            return alias
+        if len(attached) >= 8:  # SQLite attaches at most 10 by default
+            for name in attached:
+                conn.execute(f'DETACH DATABASE {name}')
+            attached.clear()
+        os.makedirs(self.directory, exist_ok=True)
+        new = not os.path.exists(self.path(month))
+        conn.execute(f'ATTACH DATABASE ? AS {alias}', (self.path(month),))
+        conn.execute(f'PRAGMA {alias}.journal_mode=WAL')
+        conn.execute(f'PRAGMA {alias}.synchronous=FULL')
+        # Same columns as the live table, plus the history lookup index
+        schema = conn.execute("SELECT sql FROM main.sqlite_master WHERE name = 'messages'").fetchone()[0]
+        conn.execute(schema.replace('CREATE TABLE messages', f'CREATE TABLE IF NOT EXISTS {alias}.messages', 1))
+        conn.execute(f'''CREATE INDEX IF NOT EXISTS {alias}.idx_archive_chat
+                         ON messages(chat_id, timestamp, id)''')
+        if new:
+            # Empty so far: _move records each chat it adds
+            conn.execute('INSERT OR IGNORE INTO main.archived_months (month) VALUES (?)',
+                         (month_key(month),))
+        conn.commit()
+        if new:
+            self._months_changed()
+        columns = [row[1] for row in conn.execute(f'PRAGMA {alias}.table_info(messages)')]
+        attached[alias] = ', '.join(columns)
+        return alias
+
+    def _move(self, conn, month, rowids, attached):
+        alias = self._attach(conn, month, attached)
+        columns = attached[alias]
+        marks = ','.join('?' * len(rowids))
+        # Two commits, archive first: in WAL mode a transaction spanning
+        # attached files is not atomic across them, and a crash in between
+        # must leave a duplicate (skipped next run) rather than a lost row.
+        # The archive side is synchronous=FULL, so its copy is on disk
+        # before the delete can be.
+        conn.execute(f'''INSERT OR IGNORE INTO {alias}.messages ({columns})
+                         SELECT {columns} FROM main.messages WHERE rowid IN ({marks})''', rowids)
+        conn.commit()
+        conn.execute(f'''INSERT OR IGNORE INTO main.archived_chats (chat_id, month)
+                         SELECT DISTINCT chat_id, ? FROM main.messages WHERE rowid IN ({marks})''',
+                     (month_key(month),) + tuple(rowids))
+        conn.execute(f'DELETE FROM main.messages WHERE rowid IN ({marks})', rowids)
+        conn.commit()
+
+    def _record_chats(self, conn):
+        # Months archived before archived_chats existed: list their chats once
+        indexed = {row[0] for row in conn.execute('SELECT month FROM archived_months')}
+        for month in self.months():
+            if month_key(month) in indexed:
+                continue
+            archive = self.connect(month)
+            try:
+                chats = [(row[0], month_key(month)) for row in
+                         archive.execute('SELECT DISTINCT chat_id FROM messages')]
+            except sqlite3.OperationalError:
+                chats = []  # created, but no table yet
+            finally:
+                archive.close()
+            conn.executemany('INSERT OR IGNORE INTO archived_chats (chat_id, month) VALUES (?, ?)', chats)
+            conn.execute('INSERT OR IGNORE INTO archived_months (month) VALUES (?)', (month_key(month),))
+            conn.commit()
+
+    def compact(self, conn, older_than=None, batch=5000, vacuum_pages=2000):
+        """Purge dead rows, archive rows older than older_than (ms), free pages.
+
+        Walks messages in rowid ranges of batch rows, each range in short
+        transactions, so writers wait at most one batch. conn must be a
+        dedicated connection (it attaches archive files). Each moved chat
+        is recorded in archived_chats with the delete. Returns counts.
+        """
+        stats = {'purged': 0, 'archived': 0, 'archive_purged': 0, 'freed_pages': 0}
+        started = time.perf_counter()
+        attached = {}
+        # Like the pool's connections; the archive files stay FULL
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._record_chats(conn)
+        try:
+            top = conn.execute('SELECT MAX(rowid) FROM messages').fetchone()[0] or 0
+            last = 0
+            while last < top:
+                upto = last + batch
+                stats['purged'] += conn.execute(
+                    f'DELETE FROM messages WHERE rowid > ? AND rowid <= ? AND ({PURGEABLE})',
+                    (last, upto)).rowcount
+                conn.commit()
+                if older_than:
+                    months = {}
+                    for rowid, timestamp in conn.execute(
+                            'SELECT rowid, timestamp FROM messages WHERE rowid > ? AND rowid <= ? AND timestamp < ?',
+                            (last, upto, older_than)):
+                        months.setdefault(month_of(timestamp), []).append(rowid)
+                    for month, rowids in sorted(months.items()):
+                        self._move(conn, month, rowids, attached)
+                        stats['archived'] += len(rowids)
+                last = upto
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            for name in attached:
+                conn.execute(f'DETACH DATABASE {name}')
+
+        # Archived rows get deleted later too
+        for month in self.months():
+            archive = self.connect(month, readonly=False)
+            try:
+                stats['archive_purged'] += archive.execute(f'DELETE FROM messages WHERE {PURGEABLE}').rowcount
+                archive.commit()
+            finally:
+                archive.close()
+
+        stats['freed_pages'] = incremental_vacuum(conn, vacuum_pages)
+        stats['seconds'] = round(time.perf_counter() - started, 2)
+        return stats
+
+    def lock(self, interval):
+        """Claim this compaction run across worker processes.
+
+        Returns an open lock file, or None if another process is compacting
+        or one finished less than interval seconds ago (the lock file's
+        mtime). Close the file when done.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '.compaction.lock')
+        handle = open(path, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return None
+        if interval and os.path.getsize(path) and time.time() - os.path.getmtime(path) < interval:
+            handle.close()
+            return None
+        return handle
+
+    @staticmethod
+    def finished(handle):
+        handle.truncate(0)
+        handle.write(datetime.now(timezone.utc).isoformat() + '\n')
+        handle.close()
+
+
+def incremental_vacuum(conn, pages_per_step=2000):
+    """Return free pages to the filesystem a step at a time; 0 unless auto_vacuum=INCREMENTAL."""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    start = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    free = start
+    while free:
+        # Frees one page per step of the statement; executescript steps it
+        # to the end, where execute() would stop after the first page
+        conn.executescript(f'PRAGMA incremental_vacuum({pages_per_step});')
+        remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if remaining >= free:
+            break
+        free = remaining
+    return start - free
+
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to auto_vacuum=INCREMENTAL with one full VACUUM.
+
+    Blocks all writers while it runs. VACUUM may renumber the rowids of
+    tables without an INTEGER PRIMARY KEY, which the users_search FTS
+    index is keyed on, so that index is rebuilt afterwards.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_search'").fetchone():
+        conn.execute("INSERT INTO users_search(users_search) VALUES ('rebuild')")
+        conn.commit()
+    return True
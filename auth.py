@@ -0,0 +1,247 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import jwt
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from workers import init_worker
+
+
+class TokenCache:
+    """Bounded LRU of verified JWTs, keyed by the token's SHA-256 digest.
+
+    A hit skips the HMAC check and claim parsing; entries expire with the
+    token's own exp claim. revoke() (logout) makes an already-issued token
+    fail even though its signature is still valid.
+
+    The denylist is per process. Revocations are also written to
+    revoked_tokens, and sync() (every second, from the background task)
+    loads the ones other workers made, so a logout reaches every worker
+    of a cluster within about a second, and survives a restart.
+    """
+
+    def __init__(self, secret, algorithms=('HS256',), max_entries=10000):
+        self.secret = secret
+        self.algorithms = list(algorithms)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> (claims, expires_at)
+        self._revoked = {}  # digest -> expires_at
+        self._synced_seq = 0  # last revoked_tokens row loaded
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def verify(self, token):
+        """Return the token's claims; raises jwt.InvalidTokenError."""
+        digest = self._digest(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                claims, expires_at = entry
+                if now < expires_at:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return claims
+                del self._entries[digest]
+            self.misses += 1
+            if digest in self._revoked:
+                raise jwt.InvalidTokenError('Token has been revoked')
+
+        claims = jwt.decode(token, self.secret, algorithms=self.algorithms)
+
+        with self._lock:
+            if digest in self._revoked:
+                raise jwt.InvalidTokenError('Token has been revoked')
+            # Tokens without exp are re-verified at least once a day
+            self._entries[digest] = (claims, claims.get('exp', now + 86400))
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def _deny(self, digest, expires_at, now):
+        # Callers hold the lock
+        self._entries.pop(digest, None)
+        self._revoked[digest] = expires_at
+        # Keep the denylist from growing without bound
+        if len(self._revoked) > self.max_entries:
+            self._prune(now)
+
+    def _prune(self, now):
+        for key, until in list(self._revoked.items()):
+            if until <= now:
+                del self._revoked[key]
+
+    def revoke(self, token, conn=None):
+        """Invalidate one token (logout) until it would have expired anyway.
+
+        With conn, the revocation is also recorded for the other workers.
+        """
+        digest = self._digest(token)
+        now = time.time()
+        try:
+            expires_at = jwt.decode(token, options={'verify_signature': False}).get('exp', now + 86400)
+        except jwt.InvalidTokenError:
+            expires_at = now + 86400
+        with self._lock:
+            self._deny(digest, expires_at, now)
+        if conn is not None:
+            conn.execute('INSERT INTO revoked_tokens (digest, expires_at) VALUES (?, ?)',
+                         (digest, expires_at))
+            conn.commit()
+
+    def sync(self, conn):
+        """Load revocations recorded since the last call; drop expired ones."""
+        now = time.time()
+        rows = conn.execute('''SELECT seq, digest, expires_at FROM revoked_tokens
+                               WHERE seq > ? AND expires_at > ? ORDER BY seq''',
+                            (self._synced_seq, now)).fetchall()
+        with self._lock:
+            for seq, digest, expires_at in rows:
+                self._deny(digest, expires_at, now)
+                self._synced_seq = seq
+            self._prune(now)
+        return len(rows)
+
+    @staticmethod
+    def trim(conn, now=None):
+        """Delete revocations of tokens that have expired anyway."""
+        conn.execute('DELETE FROM revoked_tokens WHERE expires_at <= ?',
+                     (time.time() if now is None else now,))
+        conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'revoked': len(self._revoked),
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class HasherBusy(Exception):
+    """No password hashing slot freed up within the queue timeout."""
+
+
+class HasherUnavailable(Exception):
+    """A password hashing call timed out or lost its worker process."""
+
+
+class PasswordHasher:
+    """Password hashing and checking in a small process pool.
+
+    The KDF is deliberately slow (tens of ms of CPU per call), and run on
+    the request worker a login burst would hold every worker, or in the
+    green modes block the event loop outright. Here at most max_concurrent
+    calls are in the pool at a time; others wait up to queue_timeout for a
+    slot and then fail with HasherBusy, so a storm is shed instead of
+    queued behind. A call that times out or loses its worker raises
+    HasherUnavailable. workers=0 hashes on the calling thread without a
+    cap, as before the pool (for comparison).
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', workers=1, max_concurrent=None,
+                 queue_timeout=2.0, timeout=30.0):
+        self.method = method
+        self.workers = workers
+        # One running and one queued per worker keeps the workers busy
+        self.max_concurrent = max_concurrent or 2 * workers
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.calls = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     initializer=init_worker)
+            return self._executor
+
+    def _reset(self, executor):
+        # A worker died: the pool refuses all further work, so replace it
+        # unless another caller already did
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy('Password hashing is at capacity')
+        with self._lock:
+            self._in_flight += 1
+            self.calls += 1
+        executor = self._pool()
+        future = None
+        try:
+            future = executor.submit(fn, *args)
+            # The slot is freed when the job ends, not when the caller stops
+            # waiting: a timed out job still occupies a worker
+            future.add_done_callback(self._release)
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherUnavailable(f'Password hashing took over {self.timeout}s')
+        except BrokenProcessPool as e:
+            self._reset(executor)
+            raise HasherUnavailable(f'Password hashing worker died: {e}')
+        finally:
+            if future is None:
+                self._release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        return self._run(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        """True if stored was made with other parameters than self.method."""
+        return stored.split('$', 1)[0] != self.method
+
+    def upgrade(self, stored, password):
+        """A new hash of a verified password if stored is outdated, else None.
+
+        Also None when the pool is busy or failing; the next login tries again.
+        """
+        if not self.needs_rehash(stored):
+            return None
+        try:
+            hashed = self.hash(password)
+        except (HasherBusy, HasherUnavailable):
+            return None
+        with self._lock:
+            self.rehashed += 1
+        return hashed
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {'method': self.method, 'workers': self.workers,
+                    'max_concurrent': self.max_concurrent, 'in_flight': self._in_flight,
+                    'calls': self.calls, 'rejected': self.rejected, 'rehashed': self.rehashed}
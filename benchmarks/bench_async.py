@@ -0,0 +1,224 @@
+"""Connection capacity and throughput of one app worker per ASYNC_MODE.
+
+    python benchmarks/bench_async.py --modes threading gevent --sockets 2000
+
+For each mode a single worker is started on a fresh database (gunicorn
+gthread for threading, gunicorn gevent for gevent, socketio.run for
+eventlet), then, from one asyncio load generator on the same box:
+
+  1. connect: open --sockets Socket.IO websockets; report how many were
+     established and how long it took. They stay open and idle, apart
+     from --concurrency of them that authenticate and send in step 3.
+  2. rest: with all of them still open, --requests GET /api/chats from
+     --concurrency parallel clients; report req/s and p50/p99 latency.
+  3. send: --messages send_message events with ack, spread over the open
+     sockets; report messages/s and p50/p99 ack latency.
+
+Only compare runs taken on the same machine with the same flags; the
+numbers mostly show where each mode stops accepting sockets and whether
+DB calls stall everyone else on the event loop. A threading worker holds
+one thread per open websocket, so --threads caps its sockets; gevent is
+capped by --connections.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sioclient import SocketIOClient, http_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = '127.0.0.1'
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, workdir, threads, database=None):
+    """Start one app worker in ASYNC_MODE mode; workdir holds its uploads."""
+    env = dict(os.environ, ASYNC_MODE=mode,
+               CHAT_DB=database or os.path.join(workdir, 'chat_app.db'),
+               MESSAGE_DURABILITY='commit', PYTHONWARNINGS='ignore')
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    if mode == 'eventlet':
+        env['PYTHONPATH'] = ROOT
+        command = [sys.executable, '-c',
+                   'import app; app.socketio.run(app.app, host=%r, port=%d, log_output=False)'
+                   % (HOST, port)]
+    else:
+        concurrency = (['--worker-class', 'gevent', '--worker-connections', str(threads)]
+                       if mode == 'gevent' else
+                       ['--worker-class', 'gthread', '--threads', str(threads)])
+        command = [sys.executable, '-m', 'gunicorn', '--workers', '1', *concurrency,
+                   '--bind', f'{HOST}:{port}', '--pythonpath', ROOT,
+                   '--log-level', 'warning', '--backlog', '4096', 'app:app']
+    proc = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f'{mode} server exited with {proc.returncode}')
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+async def signup(port, email):
+    status, body = await http_request(HOST, port, 'POST', '/api/auth/signup',
+                                      {'email': email, 'password': 'benchmark-password'})
+    if status != 201:
+        raise RuntimeError(f'signup failed: {status} {body}')
+    return body['token'], body['user_id']
+
+
+async def open_sockets(port, count, timeout):
+    clients = []
+
+    async def one():
+        client = SocketIOClient(HOST, port)
+        try:
+            await client.connect(timeout)
+            clients.append(client)
+        except (OSError, asyncio.TimeoutError, ConnectionError):
+            await client.close()
+
+    started = time.perf_counter()
+    # Ramp up in waves so the listen backlog isn't the thing being measured
+    for offset in range(0, count, 200):
+        await asyncio.gather(*(one() for _ in range(min(200, count - offset))))
+    return clients, time.perf_counter() - started
+
+
+async def run_requests(total, concurrency, request):
+    latencies = []
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            try:
+                ok = await request()
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'ok': len(latencies),
+        'errors': errors,
+        'per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+
+async def bench_mode(mode, port, args):
+    token, user_id = await signup(port, 'bench-a@example.com')
+    _, receiver_id = await signup(port, 'bench-b@example.com')
+    await http_request(HOST, port, 'POST', '/api/chats/create',
+                       {'chat_user_id': receiver_id}, token=token)
+
+    clients, connect_time = await open_sockets(port, args.sockets, args.timeout)
+    result = {'mode': mode, 'sockets_requested': args.sockets,
+              'sockets_open': len(clients), 'connect_seconds': round(connect_time, 2)}
+
+    async def get_chats():
+        status, _ = await http_request(HOST, port, 'GET', '/api/chats', token=token,
+                                       timeout=args.timeout)
+        return status == 200
+    result['rest'] = await run_requests(args.requests, args.concurrency, get_chats)
+
+    # Every sender is the same user, so each message is echoed to all of
+    # them; keep that fan-out fixed rather than growing with --sockets
+    senders = clients[:args.concurrency]
+    for client in senders:
+        client.emit('authenticate', {'token': token})
+    await asyncio.sleep(1)
+    counter = iter(range(args.messages))
+
+    async def send():
+        if not senders:
+            return False
+        i = next(counter)
+        ack = await senders[i % len(senders)].call(
+            'send_message', {'receiver_id': receiver_id, 'text': f'bench {i}',
+                             'client_id': str(i)}, timeout=args.timeout)
+        return bool(ack and 'id' in ack)
+    result['send'] = await run_requests(args.messages, len(senders) or 1, send)
+    result['sockets_still_open'] = sum(1 for client in clients if not client.closed)
+
+    await asyncio.gather(*(client.close() for client in clients))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['threading', 'gevent'],
+                        choices=['threading', 'gevent', 'eventlet'])
+    parser.add_argument('--sockets', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=100, help='gthread threads')
+    parser.add_argument('--connections', type=int, default=10000,
+                        help='gevent worker connections')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per mode')
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        workdir = tempfile.mkdtemp(prefix=f'bench_async_{mode}_')
+        port = free_port()
+        threads = args.connections if mode == 'gevent' else args.threads
+        proc = start_server(mode, port, workdir, threads)
+        try:
+            result = asyncio.run(bench_mode(mode, port, args))
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if args.json:
+            print(json.dumps(result))
+            continue
+        rest, send = result['rest'], result['send']
+        print(f"{mode:>9}: {result['sockets_open']}/{result['sockets_requested']} sockets "
+              f"in {result['connect_seconds']}s, {result['sockets_still_open']} still open at the end")
+        print(f"           GET /api/chats: {rest['per_second']} req/s, "
+              f"p50 {rest['p50_ms']} ms, p99 {rest['p99_ms']} ms, {rest['errors']} errors")
+        print(f"           send_message:   {send['per_second']} msg/s, "
+              f"p50 {send['p50_ms']} ms, p99 {send['p99_ms']} ms, {send['errors']} errors")
+
+
+if __name__ == '__main__':
+    main()
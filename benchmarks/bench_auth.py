@@ -0,0 +1,64 @@
+"""Per-request overhead of token_required: full jwt.decode on every call
+(the old decorator) vs the verified-token cache.
+
+    python benchmarks/bench_auth.py --calls 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=100_000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_auth_')
+    os.environ['CHAT_DB'] = os.path.join(workdir, 'chat_app.db')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import jwt
+    from datetime import datetime, timedelta
+    import app
+
+    secret = app.app.config['SECRET_KEY']
+    token = jwt.encode({'user_id': 'bench-user', 'iat': datetime.utcnow(),
+                        'exp': datetime.utcnow() + timedelta(days=30)}, secret)
+
+    def legacy_required(f):
+        # The decorator before the cache: verify the token on every call
+        def decorated(*args, **kwargs):
+            header = app.request.headers.get('Authorization')
+            if header.startswith('Bearer '):
+                header = header[7:]
+            data = jwt.decode(header, secret, algorithms=['HS256'])
+            return f(data['user_id'], *args, **kwargs)
+        return decorated
+
+    def view(current_user_id):
+        return current_user_id
+
+    decorators = [('jwt.decode per call', legacy_required), ('token cache', app.token_required)]
+    with app.app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+        baseline_start = time.perf_counter()
+        for _ in range(args.calls):
+            view('bench-user')
+        baseline = (time.perf_counter() - baseline_start) / args.calls
+
+        print(f'{args.calls} calls, undecorated view: {baseline * 1e6:.2f} us/call')
+        for label, decorator in decorators:
+            wrapped = decorator(view)
+            wrapped()  # warm the cache
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                wrapped()
+            per_call = (time.perf_counter() - start) / args.calls
+            print(f'{label:>20}: {(per_call - baseline) * 1e6:6.2f} us overhead per request')
+
+    print(f'token cache: {app.token_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
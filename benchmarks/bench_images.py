@@ -0,0 +1,82 @@
+"""Image serving throughput: plain send_from_directory (the old get_image)
+vs the cached/conditional get_image, through the Flask test client.
+
+    python benchmarks/bench_images.py --requests 2000
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def make_image(size, seed):
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.frombytes('RGB', size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def run(client, url, count, headers=None):
+    start = time.perf_counter()
+    for _ in range(count):
+        response = client.get(url, headers=headers or {})
+        response.get_data()
+        response.close()
+    return count / (time.perf_counter() - start), response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_images_')
+    os.environ['CHAT_DB'] = os.path.join(workdir, 'chat_app.db')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+    from flask import send_from_directory
+
+    # The handler get_image replaced, for comparison
+    def legacy_get_image(filename):
+        return send_from_directory(os.path.abspath(app.app.config['UPLOAD_FOLDER']), filename)
+    app.app.add_url_rule('/legacy/images/<filename>', 'legacy_get_image', legacy_get_image)
+
+    key = app.image_store.store(make_image((1600, 1200), 1))
+    # A large original-style upload (written as-is, like old uploads were)
+    large_name = 'large-original.jpg'
+    with open(os.path.join(app.app.config['UPLOAD_FOLDER'], large_name), 'wb') as f:
+        f.write(make_image((2400, 1800), 2))
+    app.image_store.shutdown()
+
+    client = app.app.test_client()
+    thumb = app.variant_filename(key, 'thumb')
+
+    def revalidate(url):
+        # Each side is revalidated with the ETag it handed out itself
+        return {'If-None-Match': client.get(url).headers['ETag']}
+
+    cases = []
+    for label, name in (('thumb', thumb), ('large', large_name)):
+        before_url, after_url = f'/legacy/images/{name}', f'/api/images/{name}'
+        cases += [
+            (f'{label}, full GET', before_url, None, after_url, None),
+            (f'{label}, revalidation', before_url, revalidate(before_url), after_url, revalidate(after_url)),
+            (f'{label}, 1KB range', before_url, {'Range': 'bytes=0-1023'}, after_url, {'Range': 'bytes=0-1023'}),
+        ]
+
+    print(f'{"case":<22}{"before req/s":>16}{"after req/s":>16}   status before/after')
+    for label, before_url, before_headers, after_url, after_headers in cases:
+        after, after_status = run(client, after_url, args.requests, after_headers)
+        before, before_status = run(client, before_url, args.requests, before_headers)
+        print(f'{label:<22}{before:>16.0f}{after:>16.0f}   {before_status}/{after_status}')
+    print(f'hot cache: {app.hot_images.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""send_message latency while a login storm runs against the same worker.
+
+    python benchmarks/bench_login_storm.py --mode gevent --logins 300
+
+Starts one worker per hasher setting (pool: PASSWORD_HASH_WORKERS as
+configured; inline: PASSWORD_HASH_WORKERS=0, hashing on the request
+worker as before the pool), signs up --senders users and --logins
+storm accounts, then:
+
+  1. quiet: the senders POST /api/messages/send every --interval ms for
+     --quiet seconds; p50/p99/max latency.
+  2. storm: the same, while --storm-concurrency clients log in as the
+     storm accounts as fast as they can; send latency again, plus how
+     many logins succeeded, were turned away with 429, or failed.
+
+With the pool, send latency should stay near the quiet numbers and the
+excess logins get 429s; inline, every login holds the worker for a full
+KDF run. Only compare runs from the same machine.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sioclient import http_request
+from bench_async import HOST, free_port, percentile, signup, start_server
+
+PASSWORD = 'benchmark-password'
+
+
+async def sender(port, token, receiver_id, interval, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            status, _ = await http_request(HOST, port, 'POST', '/api/messages/send',
+                                           {'receiver_id': receiver_id, 'text': 'ping'}, token=token)
+        except (OSError, asyncio.TimeoutError, ConnectionError):
+            status = None
+        elapsed = time.perf_counter() - started
+        if status == 201:
+            latencies.append(elapsed)
+        else:
+            errors.append(status)
+        await asyncio.sleep(max(0.0, interval - elapsed))
+
+
+async def send_phase(port, senders, interval, seconds, storm=None):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    tasks = [sender(port, token, receiver_id, interval, deadline, latencies, errors)
+             for token, receiver_id in senders]
+    if storm is not None:
+        tasks.append(storm(deadline))
+    await asyncio.gather(*tasks)
+    return {
+        'sends': len(latencies),
+        'send_errors': len(errors),
+        'send_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'send_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'send_max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+def login_storm(port, emails, concurrency, outcomes, latencies):
+    async def storm(deadline):
+        queue = iter(emails)
+
+        async def worker():
+            for email in queue:
+                if time.perf_counter() >= deadline:
+                    return
+                started = time.perf_counter()
+                try:
+                    status, _ = await http_request(HOST, port, 'POST', '/api/auth/login',
+                                                   {'email': email, 'password': PASSWORD})
+                except (OSError, asyncio.TimeoutError, ConnectionError):
+                    status = 'error'
+                outcomes[str(status)] = outcomes.get(str(status), 0) + 1
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return storm
+
+
+async def bench(port, args):
+    users = [await signup(port, f'sender{i}@storm.test') for i in range(args.senders + 1)]
+    senders = [(token, users[-1][1]) for token, _ in users[:-1]]
+    emails = [f'storm{i}@storm.test' for i in range(args.logins)]
+    for email in emails:
+        status, body = await http_request(HOST, port, 'POST', '/api/auth/signup',
+                                          {'email': email, 'password': PASSWORD})
+        if status != 201:
+            raise RuntimeError(f'signup failed: {status} {body}')
+
+    interval = args.interval / 1000
+    quiet = await send_phase(port, senders, interval, args.quiet)
+    outcomes, login_latencies = {}, []
+    storm = await send_phase(port, senders, interval, args.storm,
+                             login_storm(port, emails, args.storm_concurrency, outcomes, login_latencies))
+    storm['logins'] = outcomes
+    storm['login_p50_ms'] = (round(percentile(login_latencies, 50) * 1000, 2)
+                             if login_latencies else None)
+    return {'quiet': quiet, 'storm': storm}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', default='gevent', choices=['threading', 'gevent', 'eventlet'])
+    parser.add_argument('--hashers', nargs='+', default=['pool', 'inline'], choices=['pool', 'inline'])
+    parser.add_argument('--threads', type=int, default=64, help='gthread threads / gevent connections')
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--interval', type=float, default=50, help='ms between sends per sender')
+    parser.add_argument('--logins', type=int, default=300)
+    parser.add_argument('--storm-concurrency', type=int, default=50)
+    parser.add_argument('--quiet', type=float, default=5, help='seconds')
+    parser.add_argument('--storm', type=float, default=10, help='seconds')
+    args = parser.parse_args()
+
+    for hasher in args.hashers:
+        workdir = tempfile.mkdtemp(prefix='bench_login_storm_')
+        port = free_port()
+        saved = os.environ.get('PASSWORD_HASH_WORKERS')
+        if hasher == 'inline':
+            os.environ['PASSWORD_HASH_WORKERS'] = '0'
+        try:
+            proc = start_server(args.mode, port, workdir, args.threads)
+        finally:
+            if saved is None:
+                os.environ.pop('PASSWORD_HASH_WORKERS', None)
+            else:
+                os.environ['PASSWORD_HASH_WORKERS'] = saved
+        try:
+            result = asyncio.run(bench(port, args))
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps(dict({'mode': args.mode, 'hasher': hasher}, **result)))
+
+
+if __name__ == '__main__':
+    main()
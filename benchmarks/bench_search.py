@@ -0,0 +1,105 @@
+"""User search latency: legacy LIKE '%q%' + per-row status lookups vs the
+indexed prefix/trigram search used by /api/users/search.
+
+    python benchmarks/bench_search.py --users 1000000 --queries 500
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'zen', 'dev', 'tor', 'an', 'el', 'qu',
+             'sha', 'vi', 'no', 'pix', 'ju', 'ber', 'os', 'tri', 'wa', 'yo']
+
+
+def make_username(rng, i):
+    word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return f'{word}{i}'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def legacy_search(conn, query, user_id):
+    c = conn.cursor()
+    c.execute('''SELECT id, username, profile_image, bio
+                 FROM users
+                 WHERE username LIKE ? AND id != ? AND username IS NOT NULL
+                 LIMIT 20''', (f'%{query}%', user_id))
+    users = [dict(row) for row in c.fetchall()]
+    for user in users:
+        c.execute('SELECT online, last_seen FROM user_status WHERE user_id = ?', (user['id'],))
+        c.fetchone()
+    return users
+
+
+def timed(fn, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_search_')
+    os.environ['CHAT_DB'] = os.path.join(workdir, 'chat_app.db')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    rng = random.Random(args.seed)
+    conn = app.get_db()
+    names = []
+    start = time.perf_counter()
+    batch = []
+    for i in range(args.users):
+        name = make_username(rng, i)
+        names.append(name)
+        batch.append((f'user-{i}', f'user{i}@example.com', 'x', name))
+        if len(batch) == 50_000 or i == args.users - 1:
+            conn.executemany('INSERT INTO users (id, email, password, username) VALUES (?, ?, ?, ?)', batch)
+            conn.executemany('INSERT INTO user_status (user_id, online, last_seen) VALUES (?, ?, ?)',
+                             [(row[0], rng.random() < 0.1, 0) for row in batch])
+            batch = []
+    conn.commit()
+    conn.execute('ANALYZE')
+    print(f'seeded {args.users} users in {time.perf_counter() - start:.1f}s')
+
+    # What a user types: prefixes of real names and substrings from inside them
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(names)
+        length = rng.randint(2, 6)
+        if rng.random() < 0.5:
+            queries.append(name[:length])
+        else:
+            offset = rng.randint(0, max(0, len(name) - length))
+            queries.append(name[offset:offset + length])
+    queries.append(''.join(rng.choice(string.ascii_lowercase) for _ in range(5)))  # no hits
+
+    results = {
+        'legacy LIKE + N+1': timed(lambda q: legacy_search(conn, q, 'me'), queries),
+        'indexed search': timed(lambda q: app.find_users(conn, q, 'me', app.SEARCH_LIMIT), queries),
+    }
+    conn.close()
+
+    print(f'{len(queries)} queries against {args.users} users')
+    for label, samples in results.items():
+        print(f'{label:>20}: p50 {percentile(samples, 50):8.2f} ms   p99 {percentile(samples, 99):8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
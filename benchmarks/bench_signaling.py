@@ -0,0 +1,235 @@
+"""Relay throughput and latency of the WebRTC signaling server.
+
+    python benchmarks/bench_signaling.py --pairs 50 --bursts 40 --burst 50
+
+Starts "python signaling_server.py" once per relay mode (fast: peek at
+targetUserId and splice in senderUserId; parse: json.loads + json.dumps
+per message) and, from one asyncio client process:
+
+  1. latency: one sender/receiver pair, one message at a time; p50/p99
+     of the one-way relay time (sender and receiver share a clock).
+  2. throughput: --pairs pairs each send --bursts bursts of --burst
+     ICE-candidate-sized messages, waiting for a burst to arrive before
+     sending the next (like candidate trickling during call setup);
+     relayed messages/s, p50/p99 latency, and the server's CPU time per
+     relayed message (from /proc; the client shares the machine, so this
+     is the number that isolates the relay's own cost).
+  3. slow peer: a receiver that stops reading is sent --slow-messages
+     while one healthy pair keeps relaying; reports the healthy pair's
+     rate, then drains the stalled peer to show how many messages it got
+     before the server closed it (1013 once its queue overflowed).
+
+Requires the websockets package. Compare runs from the same machine only.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_async import HOST, ROOT, free_port, percentile
+
+SERVER = os.path.join(ROOT, 'python signaling_server.py')
+# Roughly an ICE candidate message as the web client sends it
+CANDIDATE = {'type': 'candidate', 'candidate': {
+    'candidate': 'candidate:842163049 1 udp 1677729535 203.0.113.7 51234 typ srflx '
+                 'raddr 10.0.0.12 rport 51234 generation 0 ufrag sTyq network-cost 999',
+    'sdpMid': '0', 'sdpMLineIndex': 0, 'usernameFragment': 'sTyq'}}
+
+
+def start_server(port, fast, queue_size):
+    env = dict(os.environ, SIGNALING_HOST=HOST, SIGNALING_PORT=str(port),
+               SIGNALING_FAST_RELAY='1' if fast else '0',
+               SIGNALING_QUEUE_SIZE=str(queue_size), SIGNALING_LOG_LEVEL='WARNING')
+    proc = subprocess.Popen([sys.executable, SERVER], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+
+async def connect(port, user_id):
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            ws = await websockets.connect(f'ws://{HOST}:{port}', max_size=None, compression=None)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+    await ws.send(json.dumps({'type': 'register', 'userId': user_id}))
+    reply = json.loads(await ws.recv())
+    if reply.get('type') != 'register_ok':
+        raise RuntimeError(f'register failed: {reply}')
+    return ws
+
+
+def message_for(target, seq):
+    return json.dumps(dict(CANDIDATE, targetUserId=target, seq=seq, sentAt=time.perf_counter()))
+
+
+class Receiver:
+    """Reads relayed messages, recording latency and waking burst waiters."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.latencies = []
+        self.received = 0
+        self.senders = set()
+        self._waiters = []
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                data = json.loads(raw)
+                self.latencies.append(now - data['sentAt'])
+                self.senders.add(data.get('senderUserId'))
+                self.received += 1
+                for count, future in list(self._waiters):
+                    if self.received >= count and not future.done():
+                        future.set_result(None)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def wait_for(self, count, timeout):
+        if self.received >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((count, future))
+        await asyncio.wait_for(future, timeout)
+
+
+async def latency_phase(port, samples):
+    sender = await connect(port, 'lat-sender')
+    receiver = Receiver(await connect(port, 'lat-receiver'))
+    for seq in range(samples):
+        await sender.send(message_for('lat-receiver', seq))
+        await receiver.wait_for(seq + 1, 10)
+    await sender.close()
+    await receiver.ws.close()
+    return receiver.latencies
+
+
+async def throughput_phase(port, pairs, bursts, burst):
+    senders = [await connect(port, f'tp-sender-{i}') for i in range(pairs)]
+    receivers = [Receiver(await connect(port, f'tp-receiver-{i}')) for i in range(pairs)]
+
+    async def pair(i):
+        for b in range(bursts):
+            for n in range(burst):
+                await senders[i].send(message_for(f'tp-receiver-{i}', b * burst + n))
+            await receivers[i].wait_for((b + 1) * burst, 30)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(pair(i) for i in range(pairs)))
+    elapsed = time.perf_counter() - started
+    latencies = [sample for receiver in receivers for sample in receiver.latencies]
+    senders_ok = all(receiver.senders == {f'tp-sender-{i}'} for i, receiver in enumerate(receivers))
+    for ws in senders + [receiver.ws for receiver in receivers]:
+        await ws.close()
+    return len(latencies) / elapsed, latencies, senders_ok
+
+
+async def slow_peer_phase(port, messages, healthy_messages):
+    # The stalled receiver registers and then never reads again
+    stalled = await connect(port, 'slow-receiver')
+    slow_sender = await connect(port, 'slow-sender')
+    sender = await connect(port, 'ok-sender')
+    receiver = Receiver(await connect(port, 'ok-receiver'))
+
+    async def flood():
+        for seq in range(messages):
+            await slow_sender.send(message_for('slow-receiver', seq))
+
+    async def healthy():
+        started = time.perf_counter()
+        for b in range(0, healthy_messages, 50):
+            for seq in range(b, min(b + 50, healthy_messages)):
+                await sender.send(message_for('ok-receiver', seq))
+            await receiver.wait_for(min(b + 50, healthy_messages), 30)
+        return healthy_messages / (time.perf_counter() - started)
+
+    _, rate = await asyncio.gather(flood(), healthy())
+    # Now read what the stalled peer was sent: if the server gave up on it
+    # the stream ends early with a close, else all messages arrive
+    received = 0
+    try:
+        while received < messages:
+            await asyncio.wait_for(stalled.recv(), 15)
+            received += 1
+    except (websockets.exceptions.ConnectionClosed, asyncio.TimeoutError):
+        pass
+    closed = stalled.close_code
+    for ws in (stalled, slow_sender, sender, receiver.ws):
+        await ws.close()
+    return rate, received, closed
+
+
+def cpu_seconds(pid):
+    # utime + stime of a process, Linux only
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def ms(value):
+    return round(value * 1000, 3) if value is not None else None
+
+
+async def bench(mode, port, pid, args):
+    latencies = await latency_phase(port, args.samples)
+    cpu_before = cpu_seconds(pid)
+    rate, loaded, senders_ok = await throughput_phase(port, args.pairs, args.bursts, args.burst)
+    cpu_after = cpu_seconds(pid)
+    relayed = args.pairs * args.bursts * args.burst
+    slow_rate, stalled_received, close_code = await slow_peer_phase(port, args.slow_messages, args.healthy_messages)
+    return {
+        'mode': mode,
+        'latency_p50_ms': ms(percentile(latencies, 50)),
+        'latency_p99_ms': ms(percentile(latencies, 99)),
+        'throughput_msgs_per_s': round(rate, 1),
+        'loaded_p50_ms': ms(percentile(loaded, 50)),
+        'loaded_p99_ms': ms(percentile(loaded, 99)),
+        'server_cpu_us_per_msg': (round((cpu_after - cpu_before) / relayed * 1e6, 2)
+                                  if cpu_before is not None else None),
+        'sender_ids_correct': senders_ok,
+        'healthy_pair_msgs_per_s_with_stalled_peer': round(slow_rate, 1),
+        'stalled_peer_received': stalled_received,
+        'stalled_peer_close_code': close_code,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['fast', 'parse'], choices=['fast', 'parse'])
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--pairs', type=int, default=50)
+    parser.add_argument('--bursts', type=int, default=40)
+    parser.add_argument('--burst', type=int, default=50)
+    parser.add_argument('--slow-messages', type=int, default=50000)
+    parser.add_argument('--healthy-messages', type=int, default=5000)
+    parser.add_argument('--queue-size', type=int, default=256)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        port = free_port()
+        proc = start_server(port, mode == 'fast', args.queue_size)
+        try:
+            result = asyncio.run(bench(mode, port, proc.pid, args))
+        finally:
+            proc.terminate()
+            proc.wait(10)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Wire size and CPU cost of socket event encodings and REST response encodings.
+
+    python benchmarks/bench_wire.py --events 5000 --page 50 --chats 40
+
+Socket events: a realistic mix (new_message with chat-like texts,
+message_status, messages_status, user_typing, user_online/offline) is
+encoded as the full Socket.IO packet a client receives, for plain JSON
+events and each compact encoding wire.py offers (msgpack rides as a
+binary attachment, so it pays for a placeholder packet and a second
+websocket frame). Reports bytes per event on the wire and encode CPU
+per event.
+
+REST: a --page message history page and a --chats chat list, as Flask's
+default JSON provider and the orjson-backed FastJSONProvider write them,
+then gzip and brotli compressed; bytes and CPU per response.
+
+Nothing goes over a network: these are the server-side costs only.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from socketio import packet
+import wire
+
+WORDS = ('ok sure see you at the station tomorrow morning did you get my last message '
+         'haha yes that works for me running late by ten minutes call me when you are '
+         'free lunch later? sounds good 👍 thanks!! on my way').split()
+
+
+def text(rng):
+    # Mostly short chat lines, now and then a paragraph
+    words = rng.choice((2, 3, 5, 8, 12, 20, 40))
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_users(rng, count):
+    return [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(count)]
+
+
+def message(rng, sender, receiver, timestamp):
+    return {
+        'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'chat_id': f'{min(sender, receiver)}_{max(sender, receiver)}',
+        'sender_id': sender,
+        'receiver_id': receiver,
+        'text': text(rng),
+        'image_url': '' if rng.random() > 0.1 else '/api/images/%064x_full.webp' % rng.getrandbits(256),
+        'timestamp': timestamp,
+        'status': 'sent',
+        'deleted_for_sender': 0,
+        'deleted_for_receiver': 0,
+        'deleted_for_everyone': 0,
+    }
+
+
+def events(rng, count):
+    users = make_users(rng, 50)
+    now = 1_790_000_000_000
+    out = []
+    for n in range(count):
+        sender, receiver = rng.sample(users, 2)
+        kind = rng.random()
+        if kind < 0.4:
+            payload = dict(message(rng, sender, receiver, now + n))
+            for key in ('deleted_for_sender', 'deleted_for_receiver', 'deleted_for_everyone'):
+                del payload[key]
+            out.append(('new_message', payload))
+        elif kind < 0.7:
+            out.append(('user_typing', {'user_id': sender, 'typing': rng.random() < 0.6}))
+        elif kind < 0.85:
+            out.append(('messages_status', {'chat_user_id': sender, 'read_up_to': now + n,
+                                            'delivered_up_to': now + n}))
+        elif kind < 0.9:
+            out.append(('message_status', {'message_id': str(uuid.uuid4()), 'status': 'read'}))
+        elif kind < 0.95:
+            out.append(('user_online', {'user_id': sender, 'online': True}))
+        else:
+            out.append(('user_offline', {'user_id': sender, 'last_seen': now + n}))
+    return out
+
+
+def socketio_frames(event, data):
+    # What goes on the websocket: Engine.IO "4" + Socket.IO packet text,
+    # plus one binary frame per attachment
+    encoded = packet.Packet(packet.EVENT, data=[event, data]).encode()
+    if isinstance(encoded, list):
+        return 1 + len(encoded[0].encode()) + sum(len(part) for part in encoded[1:])
+    return 1 + len(encoded.encode())
+
+
+def bench_events(batch, repeat):
+    rows = []
+    encodings = [None] + list(wire.ENCODINGS)
+    for encoding in encodings:
+        def encode_all():
+            for event, payload in batch:
+                data = payload if encoding is None else wire.pack(payload, encoding)
+                packet.Packet(packet.EVENT, data=[event, data]).encode()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            encode_all()
+        cpu = (time.perf_counter() - started) / repeat / len(batch)
+        size = sum(socketio_frames(event, payload if encoding is None else wire.pack(payload, encoding))
+                   for event, payload in batch) / len(batch)
+        rows.append({'encoding': encoding or 'json', 'bytes_per_event': round(size, 1),
+                     'encode_us_per_event': round(cpu * 1e6, 2)})
+    return rows
+
+
+def bench_rest(name, body, repeat):
+    app = Flask(__name__)
+    rows = []
+    with app.app_context():
+        for label, provider in (('flask-json', DefaultJSONProvider(app)), ('fast-json', wire.FastJSONProvider(app))):
+            data = provider.dumps(body, separators=(',', ':')).encode()
+            started = time.perf_counter()
+            for _ in range(repeat):
+                provider.dumps(body, separators=(',', ':')).encode()
+            serialize = (time.perf_counter() - started) / repeat
+            rows.append({'response': name, 'encoder': label, 'coding': 'identity',
+                         'bytes': len(data), 'us': round(serialize * 1e6, 1)})
+            if label != 'fast-json':
+                continue
+            codings = ['gzip'] + (['br'] if wire.brotli is not None else [])
+            for coding in codings:
+                compressed = wire.compress(data, coding)
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    wire.compress(data, coding)
+                seconds = (time.perf_counter() - started) / repeat
+                rows.append({'response': name, 'encoder': label, 'coding': coding,
+                             'bytes': len(compressed), 'us': round((serialize + seconds) * 1e6, 1)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--page', type=int, default=50, help='messages in a history page')
+    parser.add_argument('--chats', type=int, default=40, help='entries in a chat list')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(json.dumps({'orjson': wire.orjson is not None, 'msgpack': wire.msgpack is not None,
+                      'brotli': wire.brotli is not None}))
+    for row in bench_events(events(rng, args.events), max(1, args.repeat // 4)):
+        print(json.dumps(row))
+
+    users = make_users(rng, args.chats + 1)
+    me = users[0]
+    page = {'messages': [message(rng, rng.choice((me, users[1])), me if n % 2 else users[1],
+                                 1_790_000_000_000 + n) for n in range(args.page)],
+            'next_cursor': 'MTc5MDAwMDAwMDAwMHw5NmQ5', 'has_more': True}
+    chats = {'chats': [{'chat_user_id': user, 'last_message': text(rng),
+                        'last_message_time': 1_790_000_000_000 - n * 60000, 'unread_count': n % 3,
+                        'username': f'user{n}', 'profile_image': '👨‍💻', 'bio': 'Hey there! I am using Chat',
+                        'online': n % 4 == 0, 'last_seen': 1_789_999_000_000} for n, user in enumerate(users[1:])]}
+    for row in bench_rest('messages_page', page, args.repeat * 10) + bench_rest('chat_list', chats, args.repeat * 10):
+        print(json.dumps(row))
+
+
+if __name__ == '__main__':
+    main()
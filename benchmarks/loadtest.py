@@ -0,0 +1,439 @@
+"""Load harness for the REST and Socket.IO hot paths.
+
+Seed a synthetic dataset (users, chats, message history) into a database:
+
+    python benchmarks/loadtest.py seed --db chat_app.db --users 10000 \\
+        --chats-per-user 20 --messages-per-chat 200
+
+Then drive simulated clients against a running server, or let the harness
+start one worker on the seeded database with --serve:
+
+    python benchmarks/loadtest.py run --db chat_app.db --serve gevent \\
+        --clients 200 --duration 60 --output results.json
+
+Each client logs in, loads its chat list, opens a socket and authenticates,
+then loops over a weighted mix of actions (--mix) with --think ms pauses:
+
+    send     send_message over the socket, waiting for the ack
+    history  GET /api/messages/<chat user>
+    chats    GET /api/chats
+    typing   typing start/stop emits
+    read     message_read for the newest message from a chat user
+
+Clients log in as the first --clients seeded users, who chat with each
+other, so end-to-end delivery (send -> receiver's new_message) and read
+receipts (message_read -> sender's message_status) are timed too.
+
+The result is one JSON document: for each endpoint and socket event, its
+count, errors, rate and p50/p95/p99/max latency in ms. Fire-and-forget
+emits (typing) have counts and rates only. Two results can be compared,
+failing if any p95 regressed by more than --tolerance percent:
+
+    python benchmarks/loadtest.py compare baseline.json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sioclient import SocketIOClient, http_request
+from bench_async import HOST, ROOT, free_port, percentile, start_server
+
+PASSWORD = 'loadtest-password'
+DEFAULT_MIX = 'send:3,history:1,chats:1,typing:4,read:2'
+
+
+def email_for(i):
+    return f'user{i}@load.test'
+
+
+def user_id_for(i):
+    return f'load-{i:08d}'
+
+
+# Seeding
+
+def seed(args):
+    # Importing the app creates the schema and runs its migrations
+    os.environ['CHAT_DB'] = os.path.abspath(args.db)
+    os.environ.setdefault('PYTHONWARNINGS', 'ignore')
+    os.chdir(tempfile.mkdtemp(prefix='loadtest_seed_'))
+    sys.path.insert(0, ROOT)
+    import app
+    from transfer import deferred_schema
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    password_hash = generate_password_hash(PASSWORD)  # one KDF run for every user
+    conn = sqlite3.connect(args.db)
+    conn.execute('PRAGMA synchronous=OFF')
+    started = time.perf_counter()
+
+    # Indexes are built once at the end and the per-row triggers (search,
+    # sync change log) stay off; the search index is rebuilt afterwards
+    with deferred_schema(conn, ('users', 'chats', 'messages')):
+        conn.executemany('INSERT OR IGNORE INTO users (id, email, password, username, bio) VALUES (?, ?, ?, ?, ?)',
+                         ((user_id_for(i), email_for(i), password_hash, f'load{i}', 'Load test user')
+                          for i in range(args.users)))
+        conn.commit()
+
+        # Each user chats with the next --chats-per-user users (wrapping around)
+        now = int(time.time() * 1000)
+        span = args.history_days * 24 * 3600 * 1000
+        pairs = {(i, (i + k) % args.users) for i in range(args.users)
+                 for k in range(1, min(args.chats_per_user, args.users - 1) + 1)}
+        pairs = sorted({(min(a, b), max(a, b)) for a, b in pairs})
+
+        messages = 0
+        batch = []
+        chats = []
+        for a, b in pairs:
+            uid_a, uid_b = user_id_for(a), user_id_for(b)
+            chat_id = app.get_chat_id(uid_a, uid_b)
+            timestamp = now - span
+            step = span // max(1, args.messages_per_chat)
+            text = None
+            # Both sides have read all but the last 3 messages: rows stay
+            # 'sent' as the app writes them, and the chat watermarks and
+            # unread counts say what was read
+            read_up_to = 0
+            unread = {uid_a: 0, uid_b: 0}
+            for n in range(args.messages_per_chat):
+                timestamp += rng.randint(1, max(1, step))
+                sender, receiver = (uid_a, uid_b) if rng.random() < 0.5 else (uid_b, uid_a)
+                text = f'message {n} ' + 'x' * rng.randint(0, 80)
+                if n < args.messages_per_chat - 3:
+                    read_up_to = timestamp
+                else:
+                    unread[receiver] += 1
+                batch.append((str(uuid.uuid4()), chat_id, sender, receiver, text, '', timestamp, 'sent'))
+            if text is not None:
+                for user_id, chat_user_id in ((uid_a, uid_b), (uid_b, uid_a)):
+                    chats.append((user_id, chat_user_id, text, timestamp,
+                                  read_up_to, read_up_to, unread[user_id]))
+            if len(batch) >= 50000:
+                messages += flush_messages(conn, batch)
+                batch = []
+        messages += flush_messages(conn, batch)
+        conn.executemany('''INSERT INTO chats (user_id, chat_user_id, last_message, last_message_time,
+                                              read_up_to, delivered_up_to, unread_count)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (user_id, chat_user_id) DO UPDATE SET
+                                last_message = excluded.last_message,
+                                last_message_time = excluded.last_message_time,
+                                read_up_to = excluded.read_up_to,
+                                delivered_up_to = excluded.delivered_up_to,
+                                unread_count = excluded.unread_count''', chats)
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+    print(json.dumps({'users': args.users, 'chats': len(chats), 'messages': messages,
+                      'seconds': round(time.perf_counter() - started, 1)}))
+
+
+def flush_messages(conn, batch):
+    conn.executemany('''INSERT INTO messages
+                        (id, chat_id, sender_id, receiver_id, text, image_url, timestamp, status)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', batch)
+    conn.commit()
+    return len(batch)
+
+
+# Running
+
+class Recorder:
+    """Latency samples and error counts per operation name."""
+
+    def __init__(self):
+        self.samples = {}
+        self.counts = {}
+        self.errors = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def timed(self, name, coro):
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except (OSError, asyncio.TimeoutError, ConnectionError):
+            self.error(name)
+            return None
+        self.record(name, time.perf_counter() - started)
+        return result
+
+    def report(self, elapsed):
+        names = sorted(set(self.samples) | set(self.counts) | set(self.errors))
+        report = {}
+        for name in names:
+            samples = self.samples.get(name, [])
+            count = len(samples) + self.counts.get(name, 0)
+            entry = {'count': count, 'errors': self.errors.get(name, 0),
+                     'per_second': round(count / elapsed, 1) if elapsed else 0}
+            if samples:
+                entry.update({
+                    'p50_ms': round(percentile(samples, 50) * 1000, 2),
+                    'p95_ms': round(percentile(samples, 95) * 1000, 2),
+                    'p99_ms': round(percentile(samples, 99) * 1000, 2),
+                    'max_ms': round(max(samples) * 1000, 2),
+                })
+            report[name] = entry
+        return report
+
+
+class SimulatedClient:
+    def __init__(self, index, port, args, recorder, shared, rng):
+        self.index = index
+        self.port = port
+        self.args = args
+        self.recorder = recorder
+        self.shared = shared  # in-flight sends and reads, keyed across clients
+        self.rng = rng
+        self.token = None
+        self.user_id = None
+        self.partners = []
+        self.latest_from = {}  # partner id -> newest message id they sent us
+        self.socket = None
+        self.sent = 0
+
+    async def rest(self, name, method, path, body=None):
+        async def request():
+            status, payload = await http_request(HOST, self.port, method, path, body,
+                                                 token=self.token, timeout=self.args.timeout)
+            if status >= 400:
+                raise ConnectionError(f'{name}: HTTP {status}')
+            return payload
+        return await self.recorder.timed(name, request())
+
+    def on_event(self, name, data):
+        now = time.perf_counter()
+        if name == 'new_message' and data.get('receiver_id') == self.user_id:
+            self.latest_from[data['sender_id']] = data['id']
+            sent_at = self.shared['sends'].pop(data.get('client_id'), None)
+            if sent_at is not None:
+                self.recorder.record('delivery new_message', now - sent_at)
+        elif name == 'message_status':
+            read_at = self.shared['reads'].pop(data.get('message_id'), None)
+            if read_at is not None:
+                self.recorder.record('delivery message_status', now - read_at)
+
+    async def start(self):
+        login = await self.rest('POST /api/auth/login', 'POST', '/api/auth/login',
+                                {'email': email_for(self.index), 'password': PASSWORD})
+        if not login:
+            return False
+        self.token, self.user_id = login['token'], login['user_id']
+        chats = await self.rest('GET /api/chats', 'GET', '/api/chats')
+        self.partners = [chat['chat_user_id'] for chat in (chats or {}).get('chats', [])]
+
+        self.socket = SocketIOClient(HOST, self.port, on_event=self.on_event)
+        connected = await self.recorder.timed('socket connect', self.socket.connect(self.args.timeout))
+        if connected is None:
+            return False
+        self.socket.emit('authenticate', {'token': self.token})
+        self.recorder.count('socket authenticate')
+        return True
+
+    async def action(self, kind):
+        if not self.partners:
+            return
+        partner = self.rng.choice(self.partners)
+        if kind == 'send':
+            self.sent += 1
+            client_id = f'{self.index}-{self.sent}'
+            self.shared['sends'][client_id] = time.perf_counter()
+            ack = await self.recorder.timed('socket send_message', self.socket.call(
+                'send_message', {'receiver_id': partner, 'client_id': client_id,
+                                 'text': f'load message {self.sent}'}, timeout=self.args.timeout))
+            if not ack or 'id' not in ack:
+                self.shared['sends'].pop(client_id, None)
+                if ack is not None:
+                    self.recorder.error('socket send_message')
+        elif kind == 'history':
+            page = await self.rest('GET /api/messages/<id>', 'GET', f'/api/messages/{partner}?limit=50')
+            for message in (page or {}).get('messages', []):
+                if message['sender_id'] == partner:
+                    self.latest_from.setdefault(partner, message['id'])
+        elif kind == 'chats':
+            await self.rest('GET /api/chats', 'GET', '/api/chats')
+        elif kind == 'typing':
+            for typing in (True, False):
+                self.socket.emit('typing', {'receiver_id': partner, 'sender_id': self.user_id,
+                                            'typing': typing})
+                self.recorder.count('socket typing')
+        elif kind == 'read':
+            message_id = self.latest_from.pop(partner, None)
+            if message_id is None:
+                return
+            self.shared['reads'][message_id] = time.perf_counter()
+            self.socket.emit('message_read', {'message_id': message_id, 'reader_id': self.user_id})
+            self.recorder.count('socket message_read')
+
+    async def run(self, deadline, kinds, weights):
+        think = self.args.think / 1000.0
+        while time.monotonic() < deadline and not self.socket.closed:
+            await self.action(self.rng.choices(kinds, weights)[0])
+            if think:
+                await asyncio.sleep(self.rng.uniform(0, 2 * think))
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+
+
+def parse_mix(text):
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition(':')
+        if kind not in ('send', 'history', 'chats', 'typing', 'read'):
+            raise SystemExit(f'Unknown action in --mix: {kind}')
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+async def drive(port, args):
+    recorder = Recorder()
+    shared = {'sends': {}, 'reads': {}}
+    rng = random.Random(args.seed)
+    kinds, weights = parse_mix(args.mix)
+    clients = [SimulatedClient(i, port, args, recorder, shared, random.Random(rng.random()))
+               for i in range(args.clients)]
+
+    # Log in gradually, like clients coming back after a deploy
+    ramp_started = time.perf_counter()
+    ready = []
+    for offset in range(0, len(clients), args.ramp):
+        wave = clients[offset:offset + args.ramp]
+        results = await asyncio.gather(*(client.start() for client in wave))
+        ready.extend(client for client, ok in zip(wave, results) if ok)
+    ramp_time = time.perf_counter() - ramp_started
+    await asyncio.sleep(0.5)
+
+    # Only the steady-state loop counts towards rates; the ramp is separate
+    steady = Recorder()
+    for client in ready:
+        client.recorder = steady
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(client.run(deadline, kinds, weights) for client in ready))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.5)  # let in-flight deliveries land
+    await asyncio.gather(*(client.close() for client in clients))
+
+    return {
+        'config': {'clients': args.clients, 'duration': args.duration, 'mix': args.mix,
+                   'think_ms': args.think, 'serve': args.serve},
+        'clients_ready': len(ready),
+        'ramp': {'seconds': round(ramp_time, 2), 'operations': recorder.report(ramp_time)},
+        'elapsed': round(elapsed, 2),
+        'operations': steady.report(elapsed),
+    }
+
+
+def run(args):
+    proc = None
+    workdir = None
+    port = args.port
+    if args.serve:
+        workdir = tempfile.mkdtemp(prefix='loadtest_')
+        port = free_port()
+        proc = start_server(args.serve, port, workdir, args.threads, database=os.path.abspath(args.db))
+    try:
+        result = asyncio.run(drive(port, args))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['operations']
+    with open(args.current) as f:
+        current = json.load(f)['operations']
+
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        old, new = baseline.get(name), current.get(name)
+        if old is None or new is None:
+            print(f'{name:<28} only in {"current" if old is None else "baseline"}')
+            continue
+        line = f'{name:<28} {old["per_second"]:>9}/s -> {new["per_second"]:>9}/s'
+        if 'p95_ms' in old and 'p95_ms' in new:
+            change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0
+            line += f'   p95 {old["p95_ms"]:>8} -> {new["p95_ms"]:>8} ms ({change:+.0f}%)'
+            if change > args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if regressions:
+        print(f"p95 regressed by more than {args.tolerance}%: {', '.join(regressions)}", file=sys.stderr)
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='write a synthetic dataset')
+    seed_parser.add_argument('--db', default='chat_app.db')
+    seed_parser.add_argument('--users', type=int, default=1000)
+    seed_parser.add_argument('--chats-per-user', type=int, default=10)
+    seed_parser.add_argument('--messages-per-chat', type=int, default=100)
+    seed_parser.add_argument('--history-days', type=int, default=90)
+    seed_parser.add_argument('--seed', type=int, default=1)
+
+    run_parser = commands.add_parser('run', help='drive simulated clients')
+    run_parser.add_argument('--db', default='chat_app.db', help='seeded database (for --serve)')
+    run_parser.add_argument('--port', type=int, default=5000, help='port of a running server')
+    run_parser.add_argument('--serve', choices=['threading', 'gevent', 'eventlet'],
+                            help='start one worker in this mode instead')
+    run_parser.add_argument('--threads', type=int, default=1000,
+                            help='threads / connections of the --serve worker')
+    run_parser.add_argument('--clients', type=int, default=50)
+    run_parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    run_parser.add_argument('--think', type=float, default=200.0, help='mean pause between actions, ms')
+    run_parser.add_argument('--mix', default=DEFAULT_MIX, help='action:weight,...')
+    run_parser.add_argument('--ramp', type=int, default=20, help='clients logging in at once')
+    run_parser.add_argument('--timeout', type=float, default=10.0)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='also write the JSON result here')
+
+    compare_parser = commands.add_parser('compare', help='compare two run results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=20.0, help='allowed p95 growth, %%')
+
+    args = parser.parse_args()
+    {'seed': seed, 'run': run, 'compare': compare}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
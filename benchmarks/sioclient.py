@@ -0,0 +1,182 @@
+"""Minimal asyncio HTTP and Socket.IO (Engine.IO 4, websocket transport)
+clients for the benchmarks.
+
+Each client is a coroutine-driven socket rather than a thread, so one load
+generator process can hold thousands of connections open against the
+server under test.
+"""
+import asyncio
+import itertools
+import json
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (AcceptConnection, CloseConnection, Ping, RejectConnection,
+                            Request, TextMessage)
+
+
+class HTTPError(Exception):
+    pass
+
+
+async def http_request(host, port, method, path, body=None, token=None, timeout=30.0):
+    """One HTTP/1.1 request on a fresh connection; returns (status, json)."""
+    payload = json.dumps(body).encode() if body is not None else b''
+    headers = [f'{method} {path} HTTP/1.1', f'Host: {host}:{port}', 'Connection: close',
+               f'Content-Length: {len(payload)}']
+    if body is not None:
+        headers.append('Content-Type: application/json')
+    if token:
+        headers.append(f'Authorization: Bearer {token}')
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write('\r\n'.join(headers).encode() + b'\r\n\r\n' + payload)
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, content = raw.partition(b'\r\n\r\n')
+    if not head:
+        raise HTTPError('Empty response')
+    status = int(head.split(b' ', 2)[1])
+    if b'transfer-encoding: chunked' in head.lower():
+        content = _unchunk(content)
+    try:
+        return status, json.loads(content) if content else None
+    except ValueError:
+        return status, None
+
+
+def _unchunk(data):
+    out = bytearray()
+    while data:
+        size_line, _, data = data.partition(b'\r\n')
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            break
+        out += data[:size]
+        data = data[size + 2:]
+    return bytes(out)
+
+
+class SocketIOClient:
+    """One Socket.IO connection on the default namespace.
+
+    emit() sends an event; call() sends it with an ack id and waits for the
+    server's return value. Received events are passed to on_event(name, data).
+    """
+
+    def __init__(self, host, port, on_event=None):
+        self.host = host
+        self.port = port
+        self.on_event = on_event
+        self.sid = None
+        self._ws = WSConnection(ConnectionType.CLIENT)
+        self._writer = None
+        self._reader_task = None
+        self._connected = None
+        self._acks = {}
+        self._ack_ids = itertools.count()
+        self._text = []
+        self.closed = False
+
+    async def connect(self, timeout=30.0):
+        loop = asyncio.get_running_loop()
+        self._connected = loop.create_future()
+        reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout)
+        self._send_raw(self._ws.send(Request(host=f'{self.host}:{self.port}',
+                                             target='/socket.io/?EIO=4&transport=websocket')))
+        self._reader_task = asyncio.ensure_future(self._read_loop(reader))
+        await asyncio.wait_for(self._connected, timeout)
+        return self
+
+    def _send_raw(self, data):
+        if not self.closed:
+            self._writer.write(data)
+
+    def _send_packet(self, packet):
+        self._send_raw(self._ws.send(TextMessage(data=packet)))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self._ws.receive_data(data)
+                for event in self._ws.events():
+                    if isinstance(event, AcceptConnection):
+                        continue
+                    if isinstance(event, RejectConnection):
+                        raise ConnectionError('Websocket upgrade rejected')
+                    if isinstance(event, Ping):
+                        self._send_raw(self._ws.send(event.response()))
+                    elif isinstance(event, CloseConnection):
+                        return
+                    elif isinstance(event, TextMessage):
+                        self._text.append(event.data)
+                        if event.message_finished:
+                            packet, self._text = ''.join(self._text), []
+                            self._handle_packet(packet)
+        except Exception as e:
+            if not self._connected.done():
+                self._connected.set_exception(e)
+        finally:
+            self.closed = True
+            if not self._connected.done():
+                self._connected.set_exception(ConnectionError('Connection closed'))
+            for future in self._acks.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection closed'))
+            self._acks.clear()
+
+    def _handle_packet(self, packet):
+        kind = packet[:1]
+        if kind == '0':  # Engine.IO open: join the default namespace
+            self._send_packet('40')
+        elif kind == '2':  # Engine.IO ping
+            self._send_packet('3')
+        elif packet.startswith('40'):
+            self.sid = json.loads(packet[2:] or '{}').get('sid')
+            if not self._connected.done():
+                self._connected.set_result(True)
+        elif packet.startswith('42'):
+            if self.on_event is not None:
+                name, *args = json.loads(packet[2:])
+                self.on_event(name, args[0] if args else None)
+        elif packet.startswith('43'):
+            body = packet[2:]
+            split = body.index('[')
+            future = self._acks.pop(int(body[:split]), None)
+            if future is not None and not future.done():
+                args = json.loads(body[split:])
+                future.set_result(args[0] if args else None)
+        elif packet.startswith('44'):
+            error = ConnectionError(f'Namespace connect refused: {packet[2:]}')
+            if not self._connected.done():
+                self._connected.set_exception(error)
+
+    def emit(self, event, data):
+        self._send_packet('42' + json.dumps([event, data], separators=(',', ':')))
+
+    async def call(self, event, data, timeout=30.0):
+        ack_id = next(self._ack_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._acks[ack_id] = future
+        self._send_packet(f'42{ack_id}' + json.dumps([event, data], separators=(',', ':')))
+        return await asyncio.wait_for(future, timeout)
+
+    async def close(self):
+        if self._writer is None:
+            return
+        if not self.closed:
+            try:
+                self._send_packet('41')
+                self._send_raw(self._ws.send(CloseConnection(code=1000)))
+                await self._writer.drain()
+            except Exception:
+                pass
+        self.closed = True
+        self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
@@ -0,0 +1,192 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+# Rough bytes for one cached row: the dict, its keys and small values.
+# String values are added on top by length.
+ROW_OVERHEAD = 640
+
+
+def _rows_size(rows):
+    return sum(ROW_OVERHEAD + sum(len(value) for value in row.values() if isinstance(value, str))
+               for row in rows)
+
+
+class ChatListCache:
+    """Each user's chat list (chat rows, newest first) kept in memory.
+
+    A list is loaded on the first request; after that the write paths patch
+    the cached rows in place (a new message moves its chat to the front) or
+    drop the list when it can't be patched, e.g. for a chat it doesn't have
+    yet. Every change gives the list a new version, which /api/chats turns
+    into an ETag. Lists are evicted least recently used first to stay under
+    max_bytes; with ttl set (other processes write to the database too)
+    they are also reloaded after ttl seconds.
+
+    A writer calls cancel_loads() before committing and passes the mark it
+    returns to the patch after the commit: a list loaded in between may
+    already include the change, so it is dropped instead of patched twice.
+
+    Rows are replaced, never mutated, so callers may read a returned list
+    without holding the lock.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> [rows, version, size, loaded_at, load token]
+        self._loading = {}  # user_id -> token of the load in flight (a version number)
+        self._versions = itertools.count(1)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, loader):
+        """(version, rows) for user_id; loader(user_id) returns the rows on a miss."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and (self._ttl is None or time.monotonic() - entry[3] < self._ttl):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1], list(entry[0])
+            self.misses += 1
+            token = self._loading[user_id] = next(self._versions)
+        try:
+            rows = [dict(row) for row in loader(user_id)]
+        except Exception:
+            with self._lock:
+                if self._loading.get(user_id) == token:
+                    del self._loading[user_id]
+            raise
+        with self._lock:
+            version = next(self._versions)
+            # A change that raced with the load cancelled it: don't cache
+            # rows that may predate it
+            if self._loading.get(user_id) == token:
+                del self._loading[user_id]
+                self._store(user_id, rows, version, token)
+        return version, list(rows)
+
+    def _store(self, user_id, rows, version, token):
+        self._discard(user_id)
+        size = _rows_size(rows)
+        if size > self.max_bytes:
+            return
+        self._entries[user_id] = [rows, version, size, time.monotonic(), token]
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted[2]
+            self.evictions += 1
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _changed(self, entry, rows):
+        size = _rows_size(rows)
+        self._bytes += size - entry[2]
+        entry[0], entry[1], entry[2] = rows, next(self._versions), size
+
+    def cancel_loads(self, *user_ids):
+        """Don't cache loads in flight for user_ids; returns a mark for the patch."""
+        with self._lock:
+            for user_id in user_ids:
+                self._loading.pop(user_id, None)
+            return next(self._versions)
+
+    def _find(self, user_id, chat_user_id, since=None):
+        # (entry, index of the chat's row) or (entry, None); callers hold the lock
+        self._loading.pop(user_id, None)
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None, None
+        if since is not None and entry[4] > since:
+            # Loaded after cancel_loads(since): may already include the change
+            self._discard(user_id)
+            return None, None
+        for index, row in enumerate(entry[0]):
+            if row['chat_user_id'] == chat_user_id:
+                return entry, index
+        return entry, None
+
+    def message(self, user_id, chat_user_id, last_message, timestamp, incoming=False, since=None):
+        """A message in user_id's chat with chat_user_id was committed.
+
+        Mirrors the chat upsert: the chat moves to its new place by
+        last_message_time and, for the receiver (incoming), counts as
+        unread unless their read watermark already covers it. A row that
+        is already at or past timestamp may include the message, so the
+        list is dropped rather than counted twice.
+        """
+        with self._lock:
+            entry, index = self._find(user_id, chat_user_id, since)
+            if entry is None:
+                return
+            if index is None or (entry[0][index]['last_message_time'] or 0) >= timestamp:
+                # A new chat (the other user's profile isn't cached) or one
+                # the patch can't be sure about
+                self._discard(user_id)
+                return
+            rows = list(entry[0])
+            row = rows.pop(index)
+            unread = 1 if incoming and timestamp > (row.get('read_up_to') or 0) else 0
+            row = dict(row, last_message=last_message, last_message_time=timestamp,
+                       unread_count=row['unread_count'] + unread)
+            position = 0
+            while position < len(rows) and (rows[position]['last_message_time'] or 0) > timestamp:
+                position += 1
+            rows.insert(position, row)
+            self._changed(entry, rows)
+
+    def read(self, user_id, chat_user_id, read_up_to):
+        """user_id read chat_user_id's messages up to read_up_to."""
+        with self._lock:
+            entry, index = self._find(user_id, chat_user_id)
+            if index is None or read_up_to <= (entry[0][index].get('read_up_to') or 0):
+                return
+            row = entry[0][index]
+            if read_up_to < (row['last_message_time'] or 0) and row['unread_count']:
+                # Some are still unread; only the database can count them
+                self._discard(user_id)
+                return
+            rows = list(entry[0])
+            rows[index] = dict(row, read_up_to=read_up_to, unread_count=0)
+            self._changed(entry, rows)
+
+    def unread_removed(self, user_id, chat_user_id, timestamp, since=None):
+        """An unread message at timestamp is no longer visible to user_id."""
+        with self._lock:
+            entry, index = self._find(user_id, chat_user_id, since)
+            if index is None:
+                return
+            row = entry[0][index]
+            if row['unread_count'] > 0 and (row.get('read_up_to') or 0) < timestamp:
+                rows = list(entry[0])
+                rows[index] = dict(row, unread_count=row['unread_count'] - 1)
+                self._changed(entry, rows)
+
+    def contact_changed(self, user_ids, contact_id, **fields):
+        """Set fields on contact_id's row in each of user_ids' lists."""
+        with self._lock:
+            for user_id in user_ids:
+                entry, index = self._find(user_id, contact_id)
+                if index is not None:
+                    rows = list(entry[0])
+                    rows[index] = dict(rows[index], **fields)
+                    self._changed(entry, rows)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._loading.pop(user_id, None)
+                self._discard(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {'lists': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
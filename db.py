@@ -0,0 +1,461 @@
+import sqlite3
+import threading
+import time
+
+
+def migrate(conn, migrations):
+    """Apply pending schema migrations, tracked in PRAGMA user_version.
+
+    Each migration is a list of SQL statements or callables taking the
+    connection; migration N (1-based) runs once, in its own transaction.
+    sqlite3 only opens transactions for DML by itself, so the BEGIN is
+    explicit: without it DDL autocommits statement by statement and a
+    failed migration would leave part of its schema behind.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, steps in enumerate(migrations[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(migrations)
+
+
+def query_plan(conn, sql, params=None):
+    """Return the EXPLAIN QUERY PLAN detail lines for sql.
+
+    Parameters default to NULL; pass representative values for queries whose
+    plan depends on them (e.g. the LIKE prefix optimisation).
+    """
+    if params is None:
+        params = (None,) * sql.count('?')
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def is_full_scan(line):
+    # A virtual table "SCAN" that carries constraints (e.g. an FTS5 MATCH,
+    # shown as "VIRTUAL TABLE INDEX 0:M1") is an index lookup, not a scan
+    if not line.startswith('SCAN'):
+        return False
+    if ' VIRTUAL TABLE INDEX ' in line:
+        return not line.rsplit(':', 1)[-1].strip()
+    return True
+
+
+def find_scans(conn, queries):
+    """Map query name -> plan lines for every query whose plan contains a SCAN.
+
+    queries maps a name to either an SQL string or an (sql, params) pair.
+    """
+    scans = {}
+    for name, query in queries.items():
+        plan = query_plan(conn, *query) if isinstance(query, tuple) else query_plan(conn, query)
+        if any(is_full_scan(line) for line in plan):
+            scans[name] = plan
+    return scans
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DBExecutor:
+    """Runs blocking SQLite calls on a bounded set of OS threads.
+
+    sqlite3 releases the GIL while a statement runs, but not an eventlet or
+    gevent hub: a query issued from a green thread stalls every connection
+    in the process. In those modes calls are handed to max_workers native
+    threads and the calling green thread yields until the result is back.
+    In threading mode each request already has its own thread, so calls run
+    inline.
+    """
+
+    def __init__(self, mode='threading', max_workers=8):
+        self.mode = mode
+        self.max_workers = max_workers
+        self.inline = mode == 'threading'
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._busy_time = 0.0
+
+        if mode == 'eventlet':
+            from eventlet import tpool
+            tpool.set_num_threads(max_workers)
+            self._submit = tpool.execute
+        elif mode == 'gevent':
+            from gevent.threadpool import ThreadPool
+            pool = ThreadPool(max_workers)
+            self._submit = lambda fn, *args: pool.apply(fn, args)
+        elif not self.inline:
+            raise ValueError(f'Unsupported async mode: {mode}')
+
+    def run(self, fn, *args):
+        if self.inline:
+            return fn(*args)
+        with self._lock:
+            self._calls += 1
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+        started = time.perf_counter()
+        try:
+            return self._submit(fn, *args)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._busy_time += time.perf_counter() - started
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'max_workers': None if self.inline else self.max_workers,
+                'calls': self._calls,
+                'in_flight': self._in_flight,
+                'max_in_flight': self._max_in_flight,
+                'busy_time': round(self._busy_time, 6),
+            }
+
+
+def _run_statement(cursor, method, sql, params):
+    getattr(cursor, method)(sql, params)
+    # Step through the whole result while still on the executor thread
+    return cursor.fetchall() if cursor.description else []
+
+
+class TimedCursor:
+    """Cursor that reports how long each execute() takes to on_query(sql, seconds)."""
+
+    def __init__(self, raw_cursor, on_query):
+        self._cursor = raw_cursor
+        self._on_query = on_query
+
+    def _run(self, method, sql, params):
+        started = time.perf_counter()
+        try:
+            getattr(self._cursor, method)(sql, params)
+        finally:
+            self._on_query(sql, time.perf_counter() - started)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._run('execute', sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run('executemany', sql, seq_of_params)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class OffloadedCursor:
+    """Cursor whose statements run on a DBExecutor.
+
+    The full result is fetched on the executor thread, so fetchone(),
+    fetchall() and iteration only read from memory. Hot queries are all
+    LIMITed, which keeps the buffered results small. Reported query times
+    include waiting for a free executor thread.
+    """
+
+    def __init__(self, executor, raw_cursor, on_query=None):
+        self._executor = executor
+        self._cursor = raw_cursor
+        self._on_query = on_query
+        self._rows = []
+        self._pos = 0
+
+    def _run(self, method, sql, params):
+        started = time.perf_counter()
+        try:
+            self._rows = self._executor.run(_run_statement, self._cursor, method, sql, params)
+        finally:
+            if self._on_query is not None:
+                self._on_query(sql, time.perf_counter() - started)
+        self._pos = 0
+        return self
+
+    def execute(self, sql, params=()):
+        return self._run('execute', sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run('executemany', sql, seq_of_params)
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self._cursor.arraysize if size is None else size
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        # rowcount, lastrowid, description, close, ...
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    """Proxy around a pooled sqlite3 connection.
+
+    Behaves like the connection returned by sqlite3.connect(), except that
+    close() hands the connection back to the pool instead of closing it.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._depth = 1
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+        return False
+
+    def close(self):
+        if self._raw is None:
+            return
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        raw, self._raw = self._raw, None
+        self._pool._release(raw)
+
+
+class TimedConnection(PooledConnection):
+    """PooledConnection that times every statement (see ConnectionPool.on_query)."""
+
+    def cursor(self):
+        if self._raw is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return TimedCursor(self._raw.cursor(), self._pool.on_query)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+class OffloadedConnection(PooledConnection):
+    """PooledConnection whose statements and commits run on a DBExecutor."""
+
+    def cursor(self):
+        if self._raw is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return OffloadedCursor(self._pool.executor, self._raw.cursor(), self._pool.on_query)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self._pool.executor.run(self._raw.commit)
+
+    def rollback(self):
+        self._pool.executor.run(self._raw.rollback)
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections, configured once at creation.
+
+    Each thread (or greenlet, when eventlet/gevent patch threading) holds at
+    most one connection: nested get_db() calls on the same thread share it and
+    it goes back to the pool when the outermost caller closes it.
+    """
+
+    def __init__(self, path, max_size=16, timeout=30.0, busy_timeout=5000,
+                 cached_statements=256, health_check_interval=30.0, executor=None,
+                 on_query=None):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        # With a non-inline executor, connections run statements on it
+        self.executor = executor
+        # on_query(sql, seconds) is called after every statement when set
+        self.on_query = on_query
+        if executor is not None and not executor.inline:
+            self._conn_class = OffloadedConnection
+        elif on_query is not None:
+            self._conn_class = TimedConnection
+        else:
+            self._conn_class = PooledConnection
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(raw_conn, last_used)], used as a LIFO stack
+        self._size = 0
+        self._local = threading.local()
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+
+    def _create(self):
+        raw = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000.0,
+                              check_same_thread=False,
+                              cached_statements=self.cached_statements)
+        raw.row_factory = sqlite3.Row
+        raw.execute('PRAGMA journal_mode=WAL')
+        raw.execute('PRAGMA synchronous=NORMAL')
+        raw.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        return raw
+
+    def _is_healthy(self, raw):
+        try:
+            raw.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _acquire(self):
+        raw = None
+        last_used = None
+        with self._cond:
+            self._checkouts += 1
+            wait_started = None
+            while True:
+                if self._idle:
+                    raw, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                now = time.monotonic()
+                if wait_started is None:
+                    wait_started = now
+                    self._waits += 1
+                remaining = self.timeout - (now - wait_started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._wait_time += now - wait_started
+                    raise PoolTimeout(f'No database connection available after {self.timeout}s')
+                self._cond.wait(remaining)
+            if wait_started is not None:
+                self._wait_time += time.monotonic() - wait_started
+
+        if raw is not None:
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(raw):
+                return raw
+            # Broken connection: close it and reuse its slot for a fresh one
+            try:
+                raw.close()
+            except sqlite3.Error:
+                pass
+            with self._cond:
+                self._discarded += 1
+
+        try:
+            raw = self._create()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+        return raw
+
+    def _release(self, raw):
+        self._local.conn = None
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except sqlite3.Error:
+            self._discard(raw)
+            return
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn._raw is not None:
+            conn._depth += 1
+            return conn
+        conn = self._conn_class(self, self._acquire())
+        self._local.conn = conn
+        return conn
+
+    def release_current(self):
+        """Return this thread's connection to the pool if a caller leaked it."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn._raw is not None:
+            conn._depth = 1
+            conn.close()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for raw, _ in idle:
+            raw.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+            }
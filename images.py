@@ -0,0 +1,180 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from workers import init_worker
+
+# Longest edge in pixels for each stored variant, smallest first
+VARIANTS = {
+    'thumb': 160,
+    'preview': 720,
+    'full': 2048,
+}
+FORMAT = 'WEBP'
+EXTENSION = 'webp'
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class RenderUnavailable(Exception):
+    """The render pool timed out or lost a worker; the upload may be retried."""
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def variant_filename(key, variant):
+    return f'{key}_{variant}.{EXTENSION}'
+
+
+def render_variants(data, quality=80):
+    """Decode an upload and re-encode it once per variant.
+
+    Runs in a worker process. EXIF orientation is applied to the pixels and
+    no metadata (EXIF, GPS, ICC comments) is carried into the output.
+    Returns {variant: bytes}.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImage(str(e))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    rendered = {}
+    for variant, edge in VARIANTS.items():
+        copy = image.copy()
+        copy.thumbnail((edge, edge), Image.LANCZOS)  # only ever shrinks
+        out = io.BytesIO()
+        copy.save(out, FORMAT, quality=quality, method=4)
+        rendered[variant] = out.getvalue()
+    return rendered
+
+
+class ImageStore:
+    """Content-addressed image variants on disk, rendered in a process pool.
+
+    Files are named by the SHA-256 of the uploaded bytes, so the same image
+    uploaded or forwarded many times is decoded and stored once.
+    """
+
+    def __init__(self, folder, workers=None, quality=80, timeout=30.0):
+        self.folder = folder
+        self.workers = workers
+        self.quality = quality
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     initializer=init_worker)
+            return self._executor
+
+    def _path(self, key, variant):
+        return os.path.join(self.folder, variant_filename(key, variant))
+
+    def exists(self, key):
+        # 'full' is written last, so its presence means the set is complete
+        return os.path.exists(self._path(key, 'full'))
+
+    def _reset(self, executor):
+        # A worker died (crash, OOM kill): the pool refuses all further work,
+        # so replace it unless another caller already did
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def store(self, data):
+        """Store an upload; returns its content key.
+
+        Raises InvalidImage, or RenderUnavailable when rendering timed out
+        or its worker process died.
+        """
+        key = content_key(data)
+        if self.exists(key):
+            return key
+
+        executor = self._pool()
+        try:
+            future = executor.submit(render_variants, data, self.quality)
+            rendered = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise RenderUnavailable(f'Rendering took over {self.timeout}s')
+        except BrokenProcessPool as e:
+            self._reset(executor)
+            raise RenderUnavailable(f'Render worker died: {e}')
+
+        for variant in VARIANTS:
+            path = self._path(key, variant)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(rendered[variant])
+            os.replace(tmp, path)
+        return key
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+class HotFileCache:
+    """LRU of small, immutable files kept in memory under a byte budget."""
+
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # name -> (data, etag)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry
+
+    def accepts(self, size):
+        return 0 < size <= self.max_file_bytes and size <= self.max_bytes
+
+    def put(self, name, data, etag):
+        if not self.accepts(len(data)):
+            return
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[name] = (data, etag)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,239 @@
+import json
+import queue
+import threading
+import time
+
+
+class Ticket:
+    """Completion handle for one queued message."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.error = None
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until the message is committed; re-raises a failed commit."""
+        if not self._done.wait(timeout):
+            raise TimeoutError('Message was not committed in time')
+        if self.error is not None:
+            raise self.error
+
+
+class MessageIngestor:
+    """Write-behind queue for new messages.
+
+    Messages are appended to an in-memory queue and a single writer thread
+    commits them in batches: every message collected within batch_interval
+    seconds (up to max_batch) goes into one transaction together with the
+    chat-list upserts, coalesced so each (user, chat) row is written once per
+    batch and the receiver's unread counter goes up by the batch's messages
+    past their read watermark.
+    One fsync then covers the whole batch. If the batch fails, its messages
+    are retried one transaction each, so only the bad ones fail.
+
+    before_commit(messages), if set, runs before the batch is written;
+    after_commit then gets the messages that were committed and, as a
+    second argument, what before_commit returned.
+    """
+
+    def __init__(self, connect, batch_interval=0.005, max_batch=500, after_commit=None,
+                 before_commit=None):
+        self._connect = connect
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self._before_commit = before_commit
+        self._after_commit = after_commit
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._committed = 0
+        self._failed = 0
+        self._batches = 0
+        self._commit_time = 0.0
+        self._max_commit_time = 0.0
+        self._last_commit_time = 0.0
+        self._max_batch_seen = 0
+        self._queue_wait = 0.0
+        self._max_queue_wait = 0.0
+
+    def submit(self, message):
+        """Queue a message dict (as stored in messages); returns a Ticket."""
+        self._ensure_started()
+        ticket = Ticket()
+        with self._stats_lock:
+            self._enqueued += 1
+        self._queue.put((message, ticket, time.perf_counter()))
+        return ticket
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                thread = threading.Thread(target=self._run, name='message-ingestor', daemon=True)
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.batch_interval
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # One bad batch must not end the writer and strand the queue
+                print(f'Message writer failed on a batch of {len(batch)}: {e}')
+                for _, ticket, _ in batch:
+                    if not ticket._done.is_set():
+                        ticket._finish(e)
+            if stop:
+                return
+
+    def _write(self, conn, messages):
+        # One transaction: the messages and their coalesced chat upserts
+        chats = {}
+        unread = {}  # (receiver, sender) -> [timestamps]
+        for message in messages:
+            last_msg = message['text'] if message['text'] else '📷 Image'
+            for user_id, chat_user_id in ((message['sender_id'], message['receiver_id']),
+                                          (message['receiver_id'], message['sender_id'])):
+                current = chats.get((user_id, chat_user_id))
+                if current is None or message['timestamp'] >= current[1]:
+                    chats[(user_id, chat_user_id)] = (last_msg, message['timestamp'])
+            receiver_chat = (message['receiver_id'], message['sender_id'])
+            unread.setdefault(receiver_chat, []).append(message['timestamp'])
+
+        conn.executemany('''INSERT INTO messages
+                            (id, chat_id, sender_id, receiver_id, text, image_url, timestamp, status)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         [(m['id'], m['chat_id'], m['sender_id'], m['receiver_id'],
+                           m['text'], m['image_url'], m['timestamp'], m['status'])
+                          for m in messages])
+        # Upsert rather than REPLACE, which would reset the row's other
+        # columns (read/delivered watermarks). Each message is checked
+        # against the receiver's read watermark, so ones already marked
+        # read (a receipt that raced the commit) are not counted as unread.
+        rows = []
+        for (user_id, chat_user_id), (last_msg, timestamp) in chats.items():
+            timestamps = unread.get((user_id, chat_user_id), ())
+            rows.append((user_id, chat_user_id, last_msg, timestamp, len(timestamps),
+                         json.dumps(timestamps)))
+        conn.executemany('''INSERT INTO chats
+                            (user_id, chat_user_id, last_message, last_message_time, unread_count)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (user_id, chat_user_id) DO UPDATE SET
+                                last_message = excluded.last_message,
+                                last_message_time = excluded.last_message_time,
+                                unread_count = unread_count +
+                                    (SELECT COUNT(*) FROM json_each(?) WHERE value > read_up_to)''',
+                         rows)
+        conn.commit()
+
+    def _commit(self, batch):
+        messages = [message for message, _, _ in batch]
+        started = time.perf_counter()
+        waits = [started - enqueued for _, _, enqueued in batch]
+        errors = [None] * len(batch)
+        context = ()
+        if self._before_commit is not None:
+            try:
+                context = (self._before_commit(messages),)
+            except Exception as e:
+                print(f'before_commit hook failed: {e}')
+        try:
+            conn = self._connect()
+        except Exception as e:
+            # No connection (pool timeout): only this batch fails
+            print(f'Message batch of {len(batch)} failed: {e}')
+            errors = [e] * len(batch)
+        else:
+            try:
+                try:
+                    self._write(conn, messages)
+                except Exception as e:
+                    conn.rollback()
+                    if len(batch) == 1:
+                        errors[0] = e
+                        print(f'Message {messages[0]["id"]} failed: {e}')
+                    else:
+                        # Find the bad rows instead of failing every sender in
+                        # the group; their messages were already emitted
+                        print(f'Message batch of {len(batch)} failed ({e}); retrying one by one')
+                        for index, message in enumerate(messages):
+                            try:
+                                self._write(conn, [message])
+                            except Exception as e:
+                                conn.rollback()
+                                errors[index] = e
+                                print(f'Message {message["id"]} failed: {e}')
+            finally:
+                conn.close()
+        elapsed = time.perf_counter() - started
+        committed = [message for message, error in zip(messages, errors) if error is None]
+
+        with self._stats_lock:
+            self._batches += 1
+            self._committed += len(committed)
+            self._failed += len(batch) - len(committed)
+            self._commit_time += elapsed
+            self._last_commit_time = elapsed
+            self._max_commit_time = max(self._max_commit_time, elapsed)
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            self._queue_wait += sum(waits)
+            self._max_queue_wait = max(self._max_queue_wait, max(waits))
+
+        if committed and self._after_commit is not None:
+            try:
+                self._after_commit(committed, *context)
+            except Exception as e:
+                print(f'after_commit hook failed: {e}')
+        for (_, ticket, _), error in zip(batch, errors):
+            ticket._finish(error)
+
+    def stop(self, timeout=5.0):
+        """Commit what is queued and stop the writer thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        with self._stats_lock:
+            processed = self._committed + self._failed
+            return {
+                'queue_depth': self._queue.qsize(),
+                'enqueued': self._enqueued,
+                'committed': self._committed,
+                'failed': self._failed,
+                'batches': self._batches,
+                'avg_batch_size': round(processed / self._batches, 2) if self._batches else 0,
+                'max_batch_size': self._max_batch_seen,
+                'avg_commit_ms': round(self._commit_time / self._batches * 1000, 3) if self._batches else 0,
+                'last_commit_ms': round(self._last_commit_time * 1000, 3),
+                'max_commit_ms': round(self._max_commit_time * 1000, 3),
+                'avg_queue_wait_ms': round(self._queue_wait / processed * 1000, 3) if processed else 0,
+                'max_queue_wait_ms': round(self._max_queue_wait * 1000, 3),
+            }
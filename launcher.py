@@ -0,0 +1,140 @@
+"""Run several app workers on one box behind a sticky-session proxy.
+
+    python launcher.py --workers 4 --port 5000
+
+Each worker is a single-process gunicorn on its own local port, threaded
+(gthread) or, with --async-mode gevent, a green-thread worker that holds
+thousands of idle sockets (pip install gevent).
+Workers share Socket.IO rooms through the pub/sub broker started here
+(SOCKETIO_MESSAGE_QUEUE), and the proxy pins every client IP to one worker,
+which Socket.IO long-polling requires.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+from pubsub import run_broker
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def spawn_worker(port, threads, env):
+    if env.get('ASYNC_MODE') == 'gevent':
+        concurrency = ['--worker-class', 'gevent', '--worker-connections', str(threads)]
+    else:
+        concurrency = ['--worker-class', 'gthread', '--threads', str(threads)]
+    return subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--workers', '1', *concurrency,
+        '--bind', f'127.0.0.1:{port}', '--pythonpath', HERE,
+        'app:app',
+    ], env=env)
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+def make_proxy(ports):
+    async def handle(client_reader, client_writer):
+        peer = client_writer.get_extra_info('peername')
+        ip = peer[0] if peer else ''
+        # Same client IP -> same worker; fall through to the next if it's down
+        start = zlib.crc32(ip.encode()) % len(ports)
+        for offset in range(len(ports)):
+            port = ports[(start + offset) % len(ports)]
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', port)
+                break
+            except OSError:
+                continue
+        else:
+            client_writer.close()
+            return
+        await asyncio.gather(pipe(client_reader, upstream_writer),
+                             pipe(upstream_reader, client_writer))
+    return handle
+
+
+async def supervise(workers, threads, env):
+    # Restart workers that die; the proxy routes around them meanwhile
+    while True:
+        await asyncio.sleep(1)
+        for port, proc in list(workers.items()):
+            if proc.poll() is not None:
+                print(f'Worker on port {port} exited ({proc.returncode}), restarting')
+                workers[port] = spawn_worker(port, threads, env)
+
+
+async def serve(args, workers, env):
+    server = await asyncio.start_server(make_proxy(sorted(workers)), args.host, args.port)
+    print(f'Proxying {args.host}:{args.port} to {len(workers)} workers')
+    async with server:
+        await asyncio.gather(server.serve_forever(), supervise(workers, args.threads, env))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run N sticky-session app workers on one box')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--base-port', type=int, default=5101, help='first worker port')
+    parser.add_argument('--async-mode', choices=['threading', 'gevent'],
+                        default=os.environ.get('ASYNC_MODE', 'threading'))
+    parser.add_argument('--threads', type=int, default=None,
+                        help='threads (gevent: connections) per worker')
+    parser.add_argument('--broker', default='tcp://127.0.0.1:5555',
+                        help='pub/sub broker address (tcp://host:port or unix:///path)')
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = 10000 if args.async_mode == 'gevent' else 100
+
+    run_broker(args.broker)
+    env = dict(os.environ, SOCKETIO_MESSAGE_QUEUE=args.broker, ASYNC_MODE=args.async_mode)
+
+    # Run migrations and clear stale presence once, before workers start.
+    # The app is imported in threading mode so it doesn't monkey-patch the
+    # proxy's asyncio loop.
+    os.environ['SOCKETIO_MESSAGE_QUEUE'] = args.broker
+    os.environ['ASYNC_MODE'] = 'threading'
+    sys.path.insert(0, HERE)
+    import app
+    conn = app.get_db()
+    app.reset_presence(conn)
+    conn.close()
+
+    workers = {}
+    for i in range(args.workers):
+        port = args.base_port + i
+        workers[port] = spawn_worker(port, args.threads, env)
+
+    try:
+        asyncio.run(serve(args, workers, env))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        deadline = time.monotonic() + 10
+        for proc in workers.values():
+            try:
+                proc.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as Tally
+
+# Seconds; covers a cached token check up to a slow upload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes, 1 KB to 16 MB
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))
+INF_BUCKET = 'le="+Inf"'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with a fixed set of label names.
+
+    Label values arrive as a tuple. A metric keeps at most max_series
+    distinct label sets; further ones are folded into an "other" series so
+    an unexpected label value can't grow memory without bound.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), max_series=500):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        if labels in self._series or len(self._series) < self.max_series:
+            return labels
+        return ('other',) * len(self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = list(self._series.items())
+        return self.header() + [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                                for labels, value in series]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, max_series=500):
+        super().__init__(name, help, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count) in self._series.items()]
+        lines = self.header()
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, INF_BUCKET)} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Gauge(Metric):
+    """A value read from a callback at scrape time.
+
+    The callback returns a number, or a {label values tuple: number} dict
+    for a labelled gauge. kind='counter' exposes a running total kept
+    elsewhere (e.g. a cache's hit count) as a counter.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labelnames=(), kind='gauge'):
+        super().__init__(name, help, labelnames)
+        self.function = function
+        self.kind = kind
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            return [f'# {self.name} unavailable: {_escape(e)}']
+        series = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}'
+                                for labels, v in series]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, function, labelnames=(), kind='gauge'):
+        return self.register(Gauge(name, help, function, labelnames, kind))
+
+    def render(self):
+        """Everything in the Prometheus text exposition format (0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _native_threads():
+    # Under eventlet/gevent the sampler has to be a real OS thread, or it
+    # would only ever see itself. Returns the unpatched
+    # (start_new_thread, get_ident, allocate_lock, sleep).
+    names = ['start_new_thread', 'get_ident', 'allocate_lock']
+    if 'gevent.monkey' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            return (*monkey.get_original('_thread', names), monkey.get_original('time', 'sleep'))
+    if 'eventlet.patcher' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            thread = patcher.original('_thread')
+            return (*(getattr(thread, name) for name in names), patcher.original('time').sleep)
+    import _thread
+    return (*(getattr(_thread, name) for name in names), time.sleep)
+
+
+class SamplingProfiler:
+    """Statistical profiler that can be switched on and off at runtime.
+
+    While running, a background OS thread records the stack of every other
+    thread every `interval` seconds. Costs nothing while stopped. In the
+    green-thread modes all greenlets share one OS thread, so samples show
+    whichever greenlet was on the CPU.
+    """
+
+    # Seconds between samples that start() accepts; shorter would turn the
+    # sampler into a busy loop over every thread's stack
+    MIN_INTERVAL = 0.001
+    MAX_INTERVAL = 1.0
+
+    def __init__(self, interval=0.005, max_stacks=20000, max_depth=64):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self._start_thread, self._get_ident, allocate_lock, self._sleep = _native_threads()
+        self._lock = allocate_lock()
+        self._running = False
+        self._generation = 0
+        self._stacks = Tally()
+        self._samples = 0
+        self._started_at = None
+        self._elapsed = 0.0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, interval=None):
+        """Start sampling; interval is clamped to [MIN_INTERVAL, MAX_INTERVAL].
+
+        Raises ValueError for an interval that isn't a finite number.
+        """
+        if interval is not None:
+            if (isinstance(interval, bool) or not isinstance(interval, (int, float))
+                    or not math.isfinite(interval)):
+                raise ValueError('interval must be a number of seconds')
+            interval = min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
+        with self._lock:
+            if interval is not None:
+                self.interval = interval
+            if self._running:
+                return
+            self._running = True
+            self._generation += 1
+            self._started_at = time.monotonic()
+            generation = self._generation
+        self._start_thread(self._run, (generation,))
+
+    def stop(self):
+        with self._lock:
+            if self._running:
+                self._running = False
+                self._elapsed += time.monotonic() - self._started_at
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+            self._elapsed = 0.0
+            if self._running:
+                self._started_at = time.monotonic()
+
+    def _frame_name(self, code):
+        return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+    def _run(self, generation):
+        try:
+            self._sample(generation)
+        except Exception as e:
+            print(f'Profiler stopped: {e}')
+        finally:
+            # However the thread ends, a later start() must get a new one
+            with self._lock:
+                if generation == self._generation and self._running:
+                    self._running = False
+                    self._elapsed += time.monotonic() - self._started_at
+
+    def _sample(self, generation):
+        me = self._get_ident()
+        while True:
+            self._sleep(self.interval)
+            if not self._running or generation != self._generation:
+                return
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                stacks.append(tuple(reversed(stack)))
+            del frames
+            with self._lock:
+                self._samples += 1
+                for stack in stacks:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                    else:
+                        self._stacks[('(other)',)] += 1
+
+    def report(self, limit=30):
+        """Top functions by self and total samples, plus status."""
+        with self._lock:
+            stacks = list(self._stacks.items())
+            samples = self._samples
+            elapsed = self._elapsed + (time.monotonic() - self._started_at if self._running else 0)
+        own = Tally()
+        total = Tally()
+        for stack, count in stacks:
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        return {
+            'running': self._running,
+            'interval': self.interval,
+            'samples': samples,
+            'seconds': round(elapsed, 3),
+            'self': [{'function': name, 'samples': count} for name, count in own.most_common(limit)],
+            'total': [{'function': name, 'samples': count} for name, count in total.most_common(limit)],
+        }
+
+    def collapsed(self):
+        """Stacks in the "a;b;c count" format read by flamegraph tools."""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
@@ -0,0 +1,333 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class PresenceRegistry:
+    """In-process presence: user_id -> online flag, last_seen and open sockets.
+
+    Reads are answered from memory. last_seen changes are only marked dirty
+    and written to user_status in batches by flush(), so a reconnect storm
+    does not become a write storm on the database.
+
+    Several workers can share the database: each records which users have
+    sockets on it in presence_sessions under its worker_id, and
+    user_status.online is derived from all workers' rows, so closing a tab
+    on one worker doesn't take a user offline who is still connected to
+    another. Workers heartbeat in presence_workers on every flush; one that
+    stops for worker_timeout seconds (crashed) has its sessions removed by
+    the next flush of any other.
+    """
+
+    def __init__(self, worker_id=None, worker_timeout=30.0):
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.worker_timeout = worker_timeout
+        self._lock = threading.Lock()
+        self._users = {}  # user_id -> {'sids': set(), 'last_seen': ms}
+        self._sid_users = {}  # sid -> user_id
+        self._dirty = set()
+        self._pending_offline = {}  # user_id -> ms the last socket closed
+
+    def connect(self, user_id, sid, timestamp):
+        """Register a socket for user_id; True if the user just came online."""
+        with self._lock:
+            previous = self._sid_users.get(sid)
+            if previous == user_id:
+                return False
+            if previous is not None:
+                self._remove_sid(sid, timestamp)
+            entry = self._users.setdefault(user_id, {'sids': set(), 'last_seen': timestamp})
+            came_online = not entry['sids']
+            if came_online and self._pending_offline.pop(user_id, None) is not None:
+                # Back within the grace period: nobody was told they left
+                came_online = False
+            entry['sids'].add(sid)
+            entry['last_seen'] = timestamp
+            self._sid_users[sid] = user_id
+            self._dirty.add(user_id)
+            return came_online
+
+    def disconnect(self, sid, timestamp):
+        """Drop a socket; returns (user_id, went_offline) or (None, False)."""
+        with self._lock:
+            return self._remove_sid(sid, timestamp)
+
+    def _remove_sid(self, sid, timestamp):
+        user_id = self._sid_users.pop(sid, None)
+        if user_id is None:
+            return None, False
+        entry = self._users[user_id]
+        entry['sids'].discard(sid)
+        if entry['sids']:
+            return user_id, False
+        entry['last_seen'] = timestamp
+        self._dirty.add(user_id)
+        self._pending_offline[user_id] = timestamp
+        return user_id, True
+
+    def due_offline(self, now, grace):
+        """Pop users whose last socket closed more than grace ms ago.
+
+        Returns [(user_id, last_seen)] to announce as offline; users who
+        reconnected in the meantime were already removed by connect().
+        Users whose last_seen is already flushed are forgotten here, since
+        flush() kept them while they were pending.
+        """
+        with self._lock:
+            due = [(user_id, ts) for user_id, ts in self._pending_offline.items()
+                   if now - ts >= grace]
+            for user_id, _ in due:
+                del self._pending_offline[user_id]
+                self._forget_if_offline(user_id)
+            return due
+
+    def _forget_if_offline(self, user_id):
+        # Offline users fully described by user_status; callers hold the lock
+        entry = self._users.get(user_id)
+        if (entry is not None and not entry['sids'] and user_id not in self._dirty
+                and user_id not in self._pending_offline):
+            del self._users[user_id]
+
+    def user_for(self, sid):
+        return self._sid_users.get(sid)
+
+    def is_online(self, user_id):
+        entry = self._users.get(user_id)
+        return bool(entry and entry['sids'])
+
+    def status(self, user_id, stored_last_seen=None, stored_online=False):
+        """(online, last_seen), falling back to the persisted values.
+
+        stored_online is only meaningful when several processes share the
+        database: a user this process sees as offline may be connected to
+        another worker.
+        """
+        entry = self._users.get(user_id)
+        if entry is None:
+            return bool(stored_online), stored_last_seen
+        return bool(entry['sids']) or bool(stored_online), entry['last_seen']
+
+    def online_count(self):
+        with self._lock:
+            return sum(1 for entry in self._users.values() if entry['sids'])
+
+    def flush(self, conn, now=None):
+        """Write dirty entries to user_status in one transaction.
+
+        Also heartbeats this worker and drops the sessions of workers that
+        stopped heartbeating.
+        """
+        now = int(time.time() * 1000) if now is None else now
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [(user_id, bool(self._users[user_id]['sids']), self._users[user_id]['last_seen'])
+                    for user_id in dirty]
+        try:
+            conn.execute('''INSERT OR REPLACE INTO presence_workers (worker_id, heartbeat)
+                            VALUES (?, ?)''', (self.worker_id, now))
+            conn.executemany('''INSERT OR IGNORE INTO presence_sessions (user_id, worker_id)
+                                VALUES (?, ?)''',
+                             [(user_id, self.worker_id) for user_id, online, _ in rows if online])
+            conn.executemany('DELETE FROM presence_sessions WHERE user_id = ? AND worker_id = ?',
+                             [(user_id, self.worker_id) for user_id, online, _ in rows if not online])
+            conn.executemany('''INSERT INTO user_status (user_id, online, last_seen)
+                                VALUES (?, EXISTS (SELECT 1 FROM presence_sessions WHERE user_id = ?), ?)
+                                ON CONFLICT (user_id) DO UPDATE SET
+                                    online = excluded.online,
+                                    last_seen = MAX(COALESCE(last_seen, 0), excluded.last_seen)''',
+                             [(user_id, user_id, last_seen) for user_id, _, last_seen in rows])
+            dead = [row[0] for row in conn.execute(
+                'SELECT worker_id FROM presence_workers WHERE heartbeat < ? AND worker_id != ?',
+                (now - int(self.worker_timeout * 1000), self.worker_id))]
+            self._drop_workers(conn, dead)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        with self._lock:
+            for user_id in dirty:
+                self._forget_if_offline(user_id)
+        return len(rows)
+
+    def online_elsewhere(self, conn, user_ids, now=None):
+        """The user_ids with a session on another live worker."""
+        now = int(time.time() * 1000) if now is None else now
+        cutoff = now - int(self.worker_timeout * 1000)
+        online = set()
+        for user_id in user_ids:
+            if conn.execute('''SELECT 1 FROM presence_sessions s
+                               JOIN presence_workers w ON w.worker_id = s.worker_id
+                               WHERE s.user_id = ? AND s.worker_id != ? AND w.heartbeat >= ?''',
+                            (user_id, self.worker_id, cutoff)).fetchone():
+                online.add(user_id)
+        return online
+
+    def retire(self, conn):
+        """Remove this worker's sessions, on a clean shutdown."""
+        self._drop_workers(conn, [self.worker_id])
+        conn.commit()
+
+    @staticmethod
+    def _drop_workers(conn, worker_ids):
+        for worker_id in worker_ids:
+            users = [(row[0],) * 2 for row in conn.execute(
+                'SELECT user_id FROM presence_sessions WHERE worker_id = ?', (worker_id,))]
+            conn.execute('DELETE FROM presence_sessions WHERE worker_id = ?', (worker_id,))
+            conn.execute('DELETE FROM presence_workers WHERE worker_id = ?', (worker_id,))
+            conn.executemany('''UPDATE user_status
+                                SET online = EXISTS (SELECT 1 FROM presence_sessions WHERE user_id = ?)
+                                WHERE user_id = ?''', users)
+
+
+class ContactCache:
+    """Bounded LRU of user_id -> ids of users who have them in their chats.
+
+    Presence changes are fanned out to these watchers only. Entries are
+    loaded on demand and invalidated when a chat between two users may
+    have been created.
+    """
+
+    def __init__(self, loader, max_entries=50000, ttl=None):
+        self._loader = loader
+        self._max_entries = max_entries
+        self._ttl = ttl  # seconds; set when other processes can add chats
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (watchers, loaded_at)
+        self._generation = 0
+
+    def watchers(self, user_id):
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and (self._ttl is None or time.monotonic() - cached[1] < self._ttl):
+                self._entries.move_to_end(user_id)
+                return cached[0]
+            generation = self._generation
+        loaded = frozenset(self._loader(user_id))
+        with self._lock:
+            # Don't cache a result that an invalidation raced with
+            if generation == self._generation:
+                self._entries[user_id] = (loaded, time.monotonic())
+                self._entries.move_to_end(user_id)
+                if len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        return loaded
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+
+class TimerWheel:
+    """Hashed timer wheel: schedule keys for a deadline, pop the expired ones.
+
+    Scheduling and cancelling are O(1); advance() only looks at the slots
+    for the ticks that passed. Rescheduling a key just moves its deadline;
+    the old slot entry is skipped or moved when its tick comes round.
+    """
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = slots
+        self._buckets = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._current = None  # last tick processed
+
+    def _tick_of(self, when):
+        return int(when // self.tick)
+
+    def schedule(self, key, deadline):
+        self._deadlines[key] = deadline
+        self._buckets[self._tick_of(deadline) % self.slots].add(key)
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def advance(self, now):
+        """Pop and return the keys whose deadline is <= now."""
+        target = self._tick_of(now)
+        if self._current is None:
+            self._current = target - self.slots
+        first = max(self._current + 1, target - self.slots + 1)
+        expired = []
+        for tick in range(first, target + 1):
+            bucket = self._buckets[tick % self.slots]
+            for key in list(bucket):
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    bucket.discard(key)  # cancelled
+                elif deadline <= now:
+                    bucket.discard(key)
+                    del self._deadlines[key]
+                    expired.append(key)
+                elif self._tick_of(deadline) % self.slots != tick % self.slots:
+                    bucket.discard(key)  # rescheduled into another slot
+                    self._buckets[self._tick_of(deadline) % self.slots].add(key)
+        self._current = target
+        return expired
+
+
+class TypingThrottle:
+    """Server-side rate control for typing indicators per (sender, receiver).
+
+    The first "typing" is forwarded at once (leading edge). Repeats while
+    typing only push back the expiry, except for one refresh every
+    `refresh` seconds so receivers don't time the indicator out. A "stop"
+    is forwarded only if a start was, and a sender who goes quiet for
+    `timeout` seconds gets one synthetic stop from expire().
+    """
+
+    def __init__(self, timeout=6.0, refresh=3.0, tick=1.0):
+        self.timeout = timeout
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._forwarded_at = {}  # (sender, receiver) -> time the last start was forwarded
+        self._wheel = TimerWheel(tick=tick, slots=int(timeout // tick) + 2)
+        self.counts = {'start_forwarded': 0, 'start_dropped': 0,
+                       'stop_forwarded': 0, 'stop_dropped': 0, 'expired': 0}
+
+    def start(self, sender_id, receiver_id, now=None):
+        """True if this "typing" should be forwarded."""
+        now = time.monotonic() if now is None else now
+        key = (sender_id, receiver_id)
+        with self._lock:
+            self._wheel.schedule(key, now + self.timeout)
+            forwarded_at = self._forwarded_at.get(key)
+            if forwarded_at is not None and now - forwarded_at < self.refresh:
+                self.counts['start_dropped'] += 1
+                return False
+            self._forwarded_at[key] = now
+            self.counts['start_forwarded'] += 1
+            return True
+
+    def stop(self, sender_id, receiver_id):
+        """True if this "stopped typing" should be forwarded."""
+        key = (sender_id, receiver_id)
+        with self._lock:
+            self._wheel.cancel(key)
+            if self._forwarded_at.pop(key, None) is None:
+                self.counts['stop_dropped'] += 1
+                return False
+            self.counts['stop_forwarded'] += 1
+            return True
+
+    def expire(self, now=None):
+        """[(sender, receiver)] that went quiet; forward a stop for each."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = self._wheel.advance(now)
+            for key in expired:
+                self._forwarded_at.pop(key, None)
+            self.counts['expired'] += len(expired)
+            return expired
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, active=len(self._forwarded_at))
@@ -0,0 +1,171 @@
+import socket
+import socketserver
+import threading
+import time
+import queue
+from urllib.parse import urlparse
+
+import socketio
+
+
+class LocalManager(socketio.PubSubManager):
+    """In-process pub/sub backend.
+
+    Every Socket.IO server in the process created with the same channel
+    shares one bus, so several app instances can be wired together in a
+    single test process without any external broker.
+    """
+    name = 'local'
+
+    _lock = threading.Lock()
+    _inboxes = {}  # channel -> [queue.Queue]
+
+    def __init__(self, url='local://', channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._inbox = queue.Queue()
+        if not write_only:
+            with LocalManager._lock:
+                LocalManager._inboxes.setdefault(channel, []).append(self._inbox)
+
+    def _publish(self, data):
+        payload = self.json.dumps(data)
+        with LocalManager._lock:
+            inboxes = list(LocalManager._inboxes.get(self.channel, ()))
+        for inbox in inboxes:
+            inbox.put(payload)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+def parse_address(url):
+    """tcp://host:port or unix:///path -> (socket family, address)."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'unix':
+        return socket.AF_UNIX, parsed.path
+    if parsed.scheme == 'tcp':
+        return socket.AF_INET, (parsed.hostname or '127.0.0.1', parsed.port or 5555)
+    raise ValueError(f'Unsupported broker address: {url}')
+
+
+class SocketManager(socketio.PubSubManager):
+    """Pub/sub backend over a local TCP or Unix socket broker (see run_broker).
+
+    Meant for several workers on one box without Redis. Frames are
+    "<channel> <json>\\n" lines; the broker relays every frame to every
+    connected worker and each worker drops other channels and its own
+    messages.
+    """
+    name = 'socket'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.family, self.address = parse_address(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        return sock
+
+    def _publish(self, data):
+        frame = f'{self.channel} {self.json.dumps(data)}\n'.encode()
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    self._publisher.sendall(frame)
+                    return
+                except OSError as e:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                        self._publisher = None
+                    if attempt:
+                        self._get_logger().error(f'Cannot publish to broker, giving up: {e}')
+
+    def _listen(self):
+        prefix = f'{self.channel} '
+        retry_sleep = 1
+        while True:
+            try:
+                with self._connect() as sock, sock.makefile('r', encoding='utf-8') as lines:
+                    sock.sendall(b'SUB\n')
+                    retry_sleep = 1
+                    for line in lines:
+                        if line.startswith(prefix):
+                            yield line[len(prefix):]
+            except OSError as e:
+                self._get_logger().error(f'Broker connection lost ({e}), retrying in {retry_sleep}s')
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 30)
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    # A connection that opens with "SUB" only receives; any other connection
+    # only publishes, and its lines are relayed to every subscriber.
+    def handle(self):
+        server = self.server
+        first = self.rfile.readline()
+        if first == b'SUB\n':
+            with server.clients_lock:
+                server.clients[self.wfile] = threading.Lock()
+            try:
+                while self.rfile.readline():
+                    pass
+            finally:
+                with server.clients_lock:
+                    server.clients.pop(self.wfile, None)
+            return
+
+        line = first
+        while line:
+            with server.clients_lock:
+                clients = list(server.clients.items())
+            for client, write_lock in clients:
+                try:
+                    with write_lock:
+                        client.write(line)
+                        client.flush()
+                except OSError:
+                    with server.clients_lock:
+                        server.clients.pop(client, None)
+            line = self.rfile.readline()
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def run_broker(url):
+    """Start the fan-out broker for SocketManager in a background thread."""
+    family, address = parse_address(url)
+    server_class = _ThreadingUnixServer if family == socket.AF_UNIX else _ThreadingTCPServer
+    server = server_class(address, _BrokerHandler)
+    server.clients = {}  # wfile -> write lock
+    server.clients_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='pubsub-broker', daemon=True).start()
+    return server
+
+
+def socketio_queue_options(url, channel='flask-socketio'):
+    """SocketIO() keyword arguments for a message queue URL.
+
+    local:// and tcp:// / unix:// use the backends above; anything else
+    (redis://, amqp://, kafka://, zmq+tcp://) goes to Flask-SocketIO's own
+    message_queue support. No URL means a single process.
+    """
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalManager(url, channel=channel)}
+    if url.startswith(('tcp://', 'unix://')):
+        return {'client_manager': SocketManager(url, channel=channel)}
+    return {'message_queue': url, 'channel': channel}
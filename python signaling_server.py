@@ -2,28 +2,136 @@ import asyncio
 import websockets
 import json
 import logging
+import os
+import re
+import time
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get('SIGNALING_LOG_LEVEL', 'INFO'))
 
-# Stores connected users {user_id: websocket_connection}
+HOST = os.environ.get('SIGNALING_HOST', 'localhost')
+PORT = int(os.environ.get('SIGNALING_PORT', 8765))
+# Relay by peeking at "targetUserId" instead of parsing and re-encoding
+# every message; 0 restores the full json.loads/json.dumps path
+FAST_RELAY = os.environ.get('SIGNALING_FAST_RELAY', '1') == '1'
+# Messages buffered per connection for a slow peer. When full, 'close'
+# disconnects that peer (its client reconnects and renegotiates), 'drop'
+# discards the message.
+PEER_QUEUE_SIZE = int(os.environ.get('SIGNALING_QUEUE_SIZE', 256))
+OVERFLOW_POLICY = os.environ.get('SIGNALING_OVERFLOW', 'close')
+LOG_INTERVAL = 10.0  # seconds between relay summaries and repeats of a warning
+
+# Stores connected users {user_id: set of Peer}, one per open session
+# (browser tab, device); messages to a user go to all of them
 connected_users = {}
 
-async def handler(websocket, path):
+stats = {'forwarded': 0, 'delivered': 0, 'dropped': 0, 'unroutable': 0, 'slow_closed': 0}
+
+# "targetUserId" with a plain (escape-free) string value, and JSON strings
+TARGET_RE = re.compile(r'"targetUserId"\s*:\s*"([^"\\]*)"')
+STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+PEEK_LIMIT = 1024
+
+_warnings = {}  # key -> [last logged, suppressed since]
+
+def warn_sampled(key, message):
+    """Log a warning at most once per LOG_INTERVAL per key."""
+    now = time.monotonic()
+    entry = _warnings.get(key)
+    if entry is not None and now - entry[0] < LOG_INTERVAL:
+        entry[1] += 1
+        return
+    suppressed = entry[1] if entry else 0
+    _warnings[key] = [now, 0]
+    logging.warning(message + (f" ({suppressed} similar suppressed)" if suppressed else ""))
+
+class Peer:
+    """One registered connection, written to from its own bounded queue.
+
+    Senders only enqueue, so a peer that reads slowly fills its own queue
+    instead of stalling whoever is sending to it.
+    """
+
+    def __init__(self, user_id, websocket):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.queue = asyncio.Queue(PEER_QUEUE_SIZE)
+        # Appended last so it overrides any senderUserId the client sent
+        self.sender_field = '"senderUserId":' + json.dumps(user_id) + '}'
+        self.closing = False
+        self.writer = asyncio.ensure_future(self._write())
+
+    def offer(self, message):
+        if self.closing:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            stats['dropped'] += 1
+            if OVERFLOW_POLICY == 'close':
+                self.closing = True
+                stats['slow_closed'] += 1
+                warn_sampled('slow_closed', f"Closing slow peer '{self.user_id}': queue full")
+                asyncio.ensure_future(self.websocket.close(1013, 'Signaling queue full'))
+            else:
+                warn_sampled('dropped', f"Dropping message for slow peer '{self.user_id}': queue full")
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send(message)
+                stats['delivered'] += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def close(self):
+        self.closing = True
+        self.writer.cancel()
+
+def route(sender, message):
+    """(target user id, text to forward) for a message from sender."""
+    if FAST_RELAY and isinstance(message, str):
+        match = TARGET_RE.search(message)
+        # Only trust the peek when the message is an object and the key is
+        # unique and at depth 1 (strings removed, one more "{" than "}"
+        # before it); anything else, or a key that comes after a large
+        # payload (checking that costs more than parsing), takes the full
+        # parse below
+        if (match and match.start() < PEEK_LIMIT and message.lstrip().startswith('{')
+                and message.find('"targetUserId"', match.end()) == -1):
+            skeleton = STRING_RE.sub('', message[:match.start()])
+        else:
+            skeleton = None
+        if skeleton is not None and skeleton.count('{') - skeleton.count('}') == 1:
+            body = message.rstrip()
+            if body.endswith('}'):
+                return match.group(1), body[:-1] + ',' + sender.sender_field
+    data = json.loads(message)
+    if not isinstance(data, dict):
+        return None, None
+    # Add sender information so the receiver knows who it's from
+    data['senderUserId'] = sender.user_id
+    return data.get('targetUserId'), json.dumps(data)
+
+async def handler(websocket, path=None):
     """Handles incoming WebSocket connections and messages."""
     user_id = None
+    peer = None
     try:
         # First message should be for registration
         message = await websocket.recv()
         data = json.loads(message)
         if data.get('type') == 'register':
             user_id = data.get('userId')
-            if user_id and user_id not in connected_users:
-                connected_users[user_id] = websocket
-                logging.info(f"User '{user_id}' registered and connected.")
+            if user_id and isinstance(user_id, str):
+                peer = Peer(user_id, websocket)
+                sessions = connected_users.setdefault(user_id, set())
+                sessions.add(peer)
+                logging.info(f"User '{user_id}' registered and connected ({len(sessions)} sessions).")
                 await websocket.send(json.dumps({"type": "register_ok"}))
             else:
                 logging.warning(f"Registration failed for user: {user_id}")
-                await websocket.send(json.dumps({"type": "error", "message": "Invalid or duplicate user ID"}))
+                await websocket.send(json.dumps({"type": "error", "message": "Invalid user ID"}))
                 await websocket.close()
                 return
         else:
@@ -34,23 +142,22 @@ async def handler(websocket, path):
         # Listen for subsequent messages (offer, answer, candidate, etc.)
         async for message in websocket:
             try:
-                data = json.loads(message)
-                target_user_id = data.get('targetUserId')
-                
-                if target_user_id and target_user_id in connected_users:
-                    target_ws = connected_users[target_user_id]
-                    # Forward the message to the target user
-                    # Add sender information so the receiver knows who it's from
-                    data['senderUserId'] = user_id 
-                    await target_ws.send(json.dumps(data))
-                    logging.info(f"Forwarded message from '{user_id}' to '{target_user_id}': {data.get('type')}")
+                target_user_id, outgoing = route(peer, message)
+                targets = connected_users.get(target_user_id) if target_user_id else None
+                if targets:
+                    # Forward the message to every session of the target user
+                    for target in list(targets):
+                        target.offer(outgoing)
+                    stats['forwarded'] += 1
+                    logging.debug(f"Forwarded message from '{user_id}' to '{target_user_id}'")
                 else:
-                    logging.warning(f"Target user '{target_user_id}' not found or not connected for message from '{user_id}'.")
+                    stats['unroutable'] += 1
+                    warn_sampled('unroutable', f"Target user '{target_user_id}' not found or not connected for message from '{user_id}'.")
                     # Optionally send an error back to the sender
                     # await websocket.send(json.dumps({"type": "error", "message": f"User {target_user_id} not available"}))
 
             except json.JSONDecodeError:
-                logging.error(f"Received invalid JSON from {user_id}: {message}")
+                warn_sampled('invalid_json', f"Received invalid JSON from {user_id}: {message[:200]}")
             except Exception as e:
                 logging.error(f"Error processing message from {user_id}: {e}")
 
@@ -61,16 +168,38 @@ async def handler(websocket, path):
     except Exception as e:
         logging.error(f"An unexpected error occurred for user '{user_id}': {e}")
     finally:
-        # Unregister user on disconnect
-        if user_id and user_id in connected_users:
-            del connected_users[user_id]
-            logging.info(f"User '{user_id}' disconnected and unregistered.")
+        # Unregister this session on disconnect; the user stays reachable
+        # through any others
+        if peer is not None:
+            peer.close()
+            sessions = connected_users.get(user_id)
+            if sessions is not None:
+                sessions.discard(peer)
+                if not sessions:
+                    del connected_users[user_id]
+            logging.info(f"User '{user_id}' session disconnected and unregistered.")
+
+async def report_stats():
+    # One summary line per LOG_INTERVAL instead of a line per message
+    last = dict(stats)
+    while True:
+        await asyncio.sleep(LOG_INTERVAL)
+        current = dict(stats)
+        if current != last:
+            delta = {key: current[key] - last[key] for key in current}
+            sessions = sum(len(peers) for peers in connected_users.values())
+            logging.info(f"Relayed {delta['forwarded']} messages in {LOG_INTERVAL:.0f}s "
+                         f"({delta['dropped']} dropped, {delta['unroutable']} unroutable, "
+                         f"{delta['slow_closed']} slow peers closed); "
+                         f"{len(connected_users)} users, {sessions} sessions")
+            last = current
 
 async def main():
     # Start the WebSocket server on localhost, port 8765
-    async with websockets.serve(handler, "localhost", 8765):
-        logging.info("Signaling server started on ws://localhost:8765")
+    async with websockets.serve(handler, HOST, PORT):
+        logging.info(f"Signaling server started on ws://{HOST}:{PORT}")
+        asyncio.ensure_future(report_stats())
         await asyncio.Future() # Run forever
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import threading
+
+
+class ReceiptBuffer:
+    """Read and delivered watermarks waiting to be written to chats.
+
+    A receipt says "user_id has read (or received) everything chat_user_id
+    sent them up to this timestamp". Receipts for the same (user, chat) are
+    coalesced in memory, watermarks only ever move forward, and flush()
+    writes them all in one transaction, so opening a chat with hundreds of
+    unread messages costs one UPDATE instead of one per message. A read
+    watermark past the chat's last message zeroes its unread counter;
+    one that stops short recounts what is left.
+
+    Receipts only update existing chat rows. One for a chat that has no
+    row yet (it beat the message's group commit) is kept for up to
+    max_retries more flushes, then dropped.
+    """
+
+    def __init__(self, max_retries=5):
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pending = {}  # (user_id, chat_user_id) -> [read_up_to, delivered_up_to]
+        self._retries = {}  # (user_id, chat_user_id) -> flushes that found no chat row
+
+    def add(self, user_id, chat_user_id, read_up_to=0, delivered_up_to=0):
+        """Record a receipt; returns the pending (read_up_to, delivered_up_to)."""
+        # Reading a message implies it was delivered
+        delivered_up_to = max(delivered_up_to, read_up_to)
+        with self._lock:
+            entry = self._pending.setdefault((user_id, chat_user_id), [0, 0])
+            entry[0] = max(entry[0], read_up_to)
+            entry[1] = max(entry[1], delivered_up_to)
+            return tuple(entry)
+
+    def pending(self, user_id, chat_user_id):
+        """Unflushed (read_up_to, delivered_up_to), or (0, 0)."""
+        entry = self._pending.get((user_id, chat_user_id))
+        return tuple(entry) if entry is not None else (0, 0)
+
+    def flush(self, conn):
+        """Write pending watermarks to chats in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        missing = set()
+        try:
+            for (user_id, chat_user_id), (read_up_to, delivered_up_to) in pending.items():
+                cursor = conn.execute('''UPDATE chats SET
+                                          read_up_to = MAX(read_up_to, :read),
+                                          delivered_up_to = MAX(delivered_up_to, :delivered),
+                                          unread_count = CASE
+                                              WHEN :read <= read_up_to THEN unread_count
+                                              WHEN :read >= last_message_time THEN 0
+                                              ELSE (SELECT COUNT(*) FROM messages m
+                                                    WHERE m.chat_id = min(user_id, chat_user_id) || '_' ||
+                                                                      max(user_id, chat_user_id)
+                                                      AND m.deleted_for_everyone = 0
+                                                      AND m.timestamp > :read
+                                                      AND m.sender_id = chat_user_id
+                                                      AND m.receiver_id = user_id
+                                                      AND m.deleted_for_receiver = 0)
+                                          END
+                                      WHERE user_id = :user_id AND chat_user_id = :chat_user_id''',
+                                      {'read': read_up_to, 'delivered': delivered_up_to,
+                                       'user_id': user_id, 'chat_user_id': chat_user_id})
+                if cursor.rowcount == 0:
+                    missing.add((user_id, chat_user_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # Put them back, merged with anything that arrived meanwhile
+            for (user_id, chat_user_id), (read_up_to, delivered_up_to) in pending.items():
+                self.add(user_id, chat_user_id, read_up_to, delivered_up_to)
+            raise
+        with self._lock:
+            for key in pending:
+                if key not in missing:
+                    self._retries.pop(key, None)
+            for key in missing:
+                retries = self._retries.get(key, 0) + 1
+                if retries > self.max_retries:
+                    self._retries.pop(key, None)
+                    continue
+                self._retries[key] = retries
+                entry = self._pending.setdefault(key, [0, 0])
+                entry[0] = max(entry[0], pending[key][0])
+                entry[1] = max(entry[1], pending[key][1])
+        return len(pending) - len(missing)
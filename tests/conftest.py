@@ -0,0 +1,30 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def chat_app(tmp_path_factory):
+    """The app module, on a fresh database in a temp directory."""
+    workdir = tmp_path_factory.mktemp('chat')
+    os.environ['CHAT_DB'] = str(workdir / 'chat.db')
+    os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+    return importlib.import_module('app')
+
+
+@pytest.fixture
+def signup(chat_app):
+    """signup(email) -> (auth headers, user id) for a new account."""
+    client = chat_app.app.test_client()
+
+    def signup(email):
+        response = client.post('/api/auth/signup', json={'email': email, 'password': 'password123'})
+        assert response.status_code == 201, response.get_json()
+        body = response.get_json()
+        return {'Authorization': f"Bearer {body['token']}"}, body['user_id']
+    return signup
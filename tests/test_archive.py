@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+from archive import MessageArchive, month_start
+
+
+def messages_db(path, timestamps):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE messages (id TEXT PRIMARY KEY, chat_id TEXT, sender_id TEXT,
+                    receiver_id TEXT, text TEXT, timestamp INTEGER,
+                    deleted_for_sender INTEGER DEFAULT 0, deleted_for_receiver INTEGER DEFAULT 0,
+                    deleted_for_everyone INTEGER DEFAULT 0)''')
+    conn.execute('CREATE TABLE archived_chats (chat_id TEXT, month INTEGER, PRIMARY KEY (chat_id, month))')
+    conn.execute('CREATE TABLE archived_months (month INTEGER PRIMARY KEY)')
+    conn.executemany("INSERT INTO messages VALUES (?, ?, 'a', 'b', 'hi', ?, 0, 0, 0)",
+                     [(f'm{n}', chat_id, timestamp) for n, (chat_id, timestamp) in
+                      enumerate((row if isinstance(row, tuple) else ('a_b', row)) for row in timestamps)])
+    conn.commit()
+    return conn
+
+
+def test_months_are_cached_until_compaction_adds_one(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'archive')
+    archive = MessageArchive(directory)
+    reader = MessageArchive(directory)  # another worker's view
+    assert archive.months() == () and reader.months() == ()
+
+    listed = []
+    real_listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: listed.append(path) or real_listdir(path))
+    reader.horizon()
+    reader.page('a_b', 'a')
+    assert listed == []
+
+    conn = messages_db(str(tmp_path / 'chat.db'), [month_start((2024, 1)), month_start((2024, 2))])
+    stats = archive.compact(conn, older_than=month_start((2024, 3)))
+    assert stats['archived'] == 2
+    assert reader.months() == ((2024, 1), (2024, 2))
+    assert reader.horizon() == month_start((2024, 3))
+    assert len(reader.page('a_b', 'a')) == 2
+
+    listed.clear()
+    reader.find('m0')
+    archive.months()
+    assert listed == []
+
+
+def test_history_only_opens_the_months_a_chat_has(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'archive'))
+    conn = messages_db(str(tmp_path / 'chat.db'), [('a_b', month_start((2024, 1))),
+                                                   ('a_c', month_start((2024, 2))),
+                                                   ('a_c', month_start((2024, 3)))])
+    archive.compact(conn, older_than=month_start((2024, 4)))
+    assert archive.chat_months(conn, 'a_b') == ((2024, 1),)
+    assert archive.chat_months(conn, 'a_c') == ((2024, 2), (2024, 3))
+    assert archive.chat_months(conn, 'new_chat') == ()
+    assert [m['id'] for m in archive.page('a_c', 'a', months=archive.chat_months(conn, 'a_c'))] == ['m2', 'm1']
+
+
+def test_months_archived_before_the_chat_index_are_recorded(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'archive'))
+    conn = messages_db(str(tmp_path / 'chat.db'), [('a_b', month_start((2024, 1)))])
+    archive.compact(conn, older_than=month_start((2024, 2)))
+    conn.execute('DELETE FROM archived_chats')
+    conn.execute('DELETE FROM archived_months')
+    conn.commit()
+    # Not recorded yet: every month may hold the chat
+    assert archive.chat_months(conn, 'x_y') == ((2024, 1),)
+    archive.compact(conn)
+    assert archive.chat_months(conn, 'x_y') == ()
+    assert archive.chat_months(conn, 'a_b') == ((2024, 1),)
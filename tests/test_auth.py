@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import time
+
+import jwt
+import pytest
+
+from auth import HasherBusy, HasherUnavailable, PasswordHasher, TokenCache
+
+
+def revoked_tokens_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE revoked_tokens (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    digest BLOB NOT NULL, expires_at REAL NOT NULL)''')
+    return conn
+
+
+def test_logout_reaches_other_workers():
+    conn = revoked_tokens_db()
+    token = jwt.encode({'user_id': 'u1', 'exp': int(time.time()) + 60}, 'secret')
+    first, second = TokenCache('secret'), TokenCache('secret')
+    assert second.verify(token)['user_id'] == 'u1'
+
+    first.revoke(token, conn)
+    with pytest.raises(jwt.InvalidTokenError):
+        first.verify(token)
+    assert second.verify(token)['user_id'] == 'u1'  # cached until it syncs
+    assert second.sync(conn) == 1
+    with pytest.raises(jwt.InvalidTokenError):
+        second.verify(token)
+    assert second.sync(conn) == 0
+
+
+def test_expired_revocations_are_dropped():
+    conn = revoked_tokens_db()
+    cache = TokenCache('secret')
+    token = jwt.encode({'user_id': 'u1', 'exp': int(time.time()) + 60}, 'secret')
+    cache.revoke(token, conn)
+    TokenCache.trim(conn, now=time.time() + 120)
+    assert conn.execute('SELECT COUNT(*) FROM revoked_tokens').fetchone()[0] == 0
+    cache._prune(time.time() + 120)
+    assert cache.stats()['revoked'] == 0
+
+
+def test_logout_is_recorded(chat_app, signup):
+    client = chat_app.app.test_client()
+    headers, _ = signup('logout@test.example')
+    assert client.post('/api/auth/logout', headers=headers).status_code == 200
+    assert client.get('/api/chats', headers=headers).status_code == 401
+    # A fresh cache (another worker, or after a restart) learns it too
+    cache = TokenCache(chat_app.app.config['SECRET_KEY'])
+    conn = chat_app.get_db()
+    try:
+        assert cache.sync(conn) >= 1
+    finally:
+        conn.close()
+    with pytest.raises(jwt.InvalidTokenError):
+        cache.verify(headers['Authorization'][7:])
+
+
+def test_hasher_timeout_keeps_the_slot_until_the_job_ends():
+    hasher = PasswordHasher(workers=1, max_concurrent=1, queue_timeout=0.1, timeout=0.2)
+    try:
+        with pytest.raises(HasherUnavailable):
+            hasher._run(time.sleep, 1)
+        with pytest.raises(HasherBusy):
+            hasher._run(pow, 2, 3)
+        assert hasher.rejected == 1
+        time.sleep(1.5)
+        assert hasher._run(pow, 2, 3) == 8
+    finally:
+        hasher.shutdown()
+
+
+def test_hasher_replaces_a_dead_worker_pool():
+    hasher = PasswordHasher(workers=1, timeout=10)
+    try:
+        with pytest.raises(HasherUnavailable):
+            hasher._run(os._exit, 1)
+        assert hasher._run(pow, 2, 3) == 8
+        assert hasher.stats()['in_flight'] == 0
+    finally:
+        hasher.shutdown()
+
+
+def test_failing_hasher_is_a_503_not_a_429(chat_app, monkeypatch):
+    client = chat_app.app.test_client()
+
+    def fail(password):
+        raise HasherUnavailable('worker died')
+    monkeypatch.setattr(chat_app.password_hasher, 'hash', fail)
+    response = client.post('/api/auth/signup', json={'email': 'hasher-down@test.example',
+                                                     'password': 'password123'})
+    assert response.status_code == 503
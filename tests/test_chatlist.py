@@ -0,0 +1,46 @@
+from chatlist import ChatListCache
+
+
+def row(chat_user_id, last_message_time, unread_count=0, read_up_to=0):
+    return {'chat_user_id': chat_user_id, 'last_message': 'hi', 'last_message_time': last_message_time,
+            'unread_count': unread_count, 'read_up_to': read_up_to}
+
+
+def test_rows_without_a_last_message_time_are_patched():
+    cache = ChatListCache(1 << 20)
+    cache.get('b', lambda user_id: [row('c', 20), row('a', None, unread_count=1)])
+    cache.read('b', 'a', 5)
+    cache.message('b', 'c', 'later', 30, incoming=True)
+    _, rows = cache.get('b', lambda user_id: [])
+    assert [(r['chat_user_id'], r['unread_count']) for r in rows] == [('c', 1), ('a', 0)]
+
+
+def test_list_loaded_after_the_commit_is_not_counted_twice():
+    cache = ChatListCache(1 << 20)
+    cache.get('b', lambda user_id: [row('a', 10)])
+    mark = cache.cancel_loads('b')
+    cache.invalidate('b')  # evicted meanwhile
+    # Loaded between the commit and the hook: already has the message
+    cache.get('b', lambda user_id: [row('a', 20, unread_count=1)])
+    cache.message('b', 'a', 'new', 20, incoming=True, since=mark)
+    _, rows = cache.get('b', lambda user_id: [row('a', 20, unread_count=1)])
+    assert rows[0]['unread_count'] == 1
+
+
+def test_message_already_in_the_row_is_not_counted_again():
+    cache = ChatListCache(1 << 20)
+    cache.get('b', lambda user_id: [row('a', 20, unread_count=1)])
+    cache.message('b', 'a', 'new', 20, incoming=True)
+    _, rows = cache.get('b', lambda user_id: [row('a', 20, unread_count=1)])
+    assert rows[0]['unread_count'] == 1
+
+
+def test_load_racing_a_commit_is_not_cached():
+    cache = ChatListCache(1 << 20)
+
+    def loader(user_id):
+        cache.cancel_loads('b')  # a writer commits while this load runs
+        return [row('a', 10)]
+
+    cache.get('b', loader)
+    assert cache.stats()['lists'] == 0
@@ -0,0 +1,27 @@
+import sqlite3
+
+import pytest
+
+from db import migrate
+
+
+def tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_migrations_apply_once():
+    conn = sqlite3.connect(':memory:')
+    migrations = [['CREATE TABLE a (x)'], ['CREATE TABLE b (x)', 'INSERT INTO b VALUES (1)']]
+    assert migrate(conn, migrations) == 2
+    assert migrate(conn, migrations) == 2
+    assert tables(conn) == {'a', 'b'}
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 2
+
+
+def test_failed_migration_leaves_no_schema_behind():
+    conn = sqlite3.connect(':memory:')
+    migrations = [['CREATE TABLE a (x)'], ['CREATE TABLE b (x)', 'CREATE INDEX i ON missing (x)']]
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(conn, migrations)
+    assert tables(conn) == {'a'}
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
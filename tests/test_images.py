@@ -0,0 +1,29 @@
+import io
+import os
+import signal
+
+import pytest
+from PIL import Image
+
+from images import ImageStore, RenderUnavailable
+
+
+def png():
+    out = io.BytesIO()
+    Image.new('RGB', (32, 32), 'red').save(out, 'PNG')
+    return out.getvalue()
+
+
+def test_store_recovers_from_a_dead_worker(tmp_path):
+    store = ImageStore(str(tmp_path), workers=1)
+    try:
+        pool = store._pool()
+        pool.submit(os.getpid).result()
+        for pid in list(pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        with pytest.raises(RenderUnavailable):
+            store.store(png())
+        key = store.store(png())
+        assert store.exists(key)
+    finally:
+        store.shutdown()
@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+
+from ingest import MessageIngestor
+
+
+@pytest.fixture
+def connect(tmp_path):
+    path = str(tmp_path / 'ingest.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE messages (id TEXT PRIMARY KEY, chat_id TEXT, sender_id TEXT,
+                    receiver_id TEXT, text TEXT, image_url TEXT, timestamp BIGINT, status TEXT)''')
+    conn.execute('''CREATE TABLE chats (user_id TEXT, chat_user_id TEXT, last_message TEXT,
+                    last_message_time BIGINT, read_up_to BIGINT NOT NULL DEFAULT 0,
+                    unread_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, chat_user_id))''')
+    conn.close()
+    return lambda: sqlite3.connect(path, check_same_thread=False)
+
+
+def message(message_id, timestamp, sender='a', receiver='b'):
+    return {'id': message_id, 'chat_id': 'a_b', 'sender_id': sender, 'receiver_id': receiver,
+            'text': message_id, 'image_url': '', 'timestamp': timestamp, 'status': 'sent'}
+
+
+def test_bad_row_fails_only_its_own_ticket(connect):
+    committed = []
+    ingestor = MessageIngestor(connect, batch_interval=0.2, after_commit=committed.extend)
+    tickets = [ingestor.submit(message(message_id, timestamp))
+               for message_id, timestamp in (('m1', 1), ('m2', 2), ('m1', 3))]
+    ingestor.stop()
+    tickets[0].wait(1)
+    tickets[1].wait(1)
+    with pytest.raises(sqlite3.IntegrityError):
+        tickets[2].wait(1)
+    assert [m['timestamp'] for m in committed] == [1, 2]
+    assert ingestor.stats()['batches'] == 1
+    conn = connect()
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 2
+    assert conn.execute("SELECT unread_count FROM chats WHERE user_id = 'b'").fetchone()[0] == 2
+
+
+def test_unread_counts_each_message_against_the_read_watermark(connect):
+    conn = connect()
+    conn.execute("INSERT INTO chats (user_id, chat_user_id, last_message_time, read_up_to) "
+                 "VALUES ('b', 'a', 10, 15)")
+    conn.commit()
+    ingestor = MessageIngestor(connect, batch_interval=0.2)
+    tickets = [ingestor.submit(message(f'w{timestamp}', timestamp)) for timestamp in (12, 14, 16, 18)]
+    ingestor.stop()
+    for ticket in tickets:
+        ticket.wait(1)
+    assert ingestor.stats()['batches'] == 1
+    counts = dict(conn.execute('SELECT user_id, unread_count FROM chats'))
+    assert counts == {'b': 2, 'a': 0}
+
+
+def test_connection_failure_fails_only_its_batch(connect):
+    failures = [sqlite3.OperationalError('pool timeout')]
+
+    def flaky_connect():
+        if failures:
+            raise failures.pop()
+        return connect()
+
+    ingestor = MessageIngestor(flaky_connect, batch_interval=0.05)
+    with pytest.raises(sqlite3.OperationalError):
+        ingestor.submit(message('f1', 1)).wait(2)
+    ingestor.submit(message('f2', 2)).wait(2)
+    ingestor.stop()
+    assert connect().execute('SELECT id FROM messages').fetchall() == [('f2',)]
+
+
+def test_dead_writer_is_restarted(connect):
+    ingestor = MessageIngestor(connect, batch_interval=0.05)
+    ingestor.submit(message('d1', 1)).wait(2)
+    ingestor._queue.put(None)  # the writer exits as if it had crashed
+    ingestor._thread.join(2)
+    ingestor.submit(message('d2', 2)).wait(2)
+    ingestor.stop()
+    assert connect().execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 2
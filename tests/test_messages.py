@@ -0,0 +1,15 @@
+def test_history_limit_is_clamped(chat_app, signup):
+    client = chat_app.app.test_client()
+    headers, _ = signup('limit-a@test.example')
+    _, other_id = signup('limit-b@test.example')
+    for n in range(3):
+        response = client.post('/api/messages/send', json={'receiver_id': other_id, 'text': f'm{n}'},
+                               headers=headers)
+        assert response.status_code == 201
+
+    response = client.get(f'/api/messages/{other_id}?limit=-2', headers=headers)
+    assert response.status_code == 200
+    assert len(response.get_json()['messages']) == 1
+
+    response = client.get(f'/api/messages/{other_id}?limit=abc', headers=headers)
+    assert response.status_code == 400
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from metrics import SamplingProfiler
+
+
+def test_profiler_interval_is_validated_and_clamped():
+    profiler = SamplingProfiler()
+    for interval in ('fast', float('nan'), True):
+        with pytest.raises(ValueError):
+            profiler.start(interval)
+    assert not profiler.running
+    profiler.start(-1)
+    try:
+        assert profiler.interval == SamplingProfiler.MIN_INTERVAL
+    finally:
+        profiler.stop()
+    profiler.start(60)
+    profiler.stop()
+    assert profiler.interval == SamplingProfiler.MAX_INTERVAL
+
+
+def test_profiler_restarts_after_its_thread_dies():
+    profiler = SamplingProfiler()
+    profiler._sample = lambda generation: 1 / 0
+    profiler.start(0.001)
+    for _ in range(100):
+        if not profiler.running:
+            break
+        time.sleep(0.01)
+    assert not profiler.running
+
+
+def test_profiler_endpoint_needs_metrics_token(chat_app, signup, monkeypatch):
+    client = chat_app.app.test_client()
+    headers, _ = signup('profiler@test.example')
+    body = {'enabled': True, 'interval': 1e-9}
+    assert client.post('/api/debug/profiler', json=body, headers=headers).status_code == 403
+    monkeypatch.setitem(chat_app.app.config, 'METRICS_TOKEN', 'ops-secret')
+    assert client.post('/api/debug/profiler', json=body, headers=headers).status_code == 401
+    ops = {'Authorization': 'Bearer ops-secret'}
+    bad = client.post('/api/debug/profiler', json={'enabled': True, 'interval': 'x'}, headers=ops)
+    assert bad.status_code == 400
+    try:
+        response = client.post('/api/debug/profiler', json=body, headers=ops)
+        assert response.status_code == 200
+        assert response.get_json()['interval'] == SamplingProfiler.MIN_INTERVAL
+    finally:
+        client.post('/api/debug/profiler', json={'enabled': False}, headers=ops)
+
+
+def test_debug_stats_need_metrics_token(chat_app, signup, monkeypatch):
+    client = chat_app.app.test_client()
+    headers, _ = signup('debug-stats@test.example')
+    paths = ['/api/debug/db-pool', '/api/debug/token-cache', '/api/debug/chat-cache',
+             '/api/debug/password-hasher', '/api/debug/ingest']
+    for path in paths:
+        assert client.get(path, headers=headers).status_code == 403
+    monkeypatch.setitem(chat_app.app.config, 'METRICS_TOKEN', 'ops-secret')
+    for path in paths:
+        assert client.get(path, headers=headers).status_code == 401
+        assert client.get(path, headers={'Authorization': 'Bearer ops-secret'}).status_code == 200
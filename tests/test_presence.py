@@ -0,0 +1,77 @@
+import sqlite3
+
+from presence import PresenceRegistry
+
+
+def user_status_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE user_status (user_id TEXT PRIMARY KEY, online BOOLEAN, last_seen BIGINT)')
+    conn.execute('CREATE TABLE presence_workers (worker_id TEXT PRIMARY KEY, heartbeat BIGINT NOT NULL)')
+    conn.execute('''CREATE TABLE presence_sessions (user_id TEXT NOT NULL, worker_id TEXT NOT NULL,
+                    PRIMARY KEY (user_id, worker_id)) WITHOUT ROWID''')
+    return conn
+
+
+def stored_online(conn, user_id):
+    return conn.execute('SELECT online FROM user_status WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def test_offline_user_forgotten_after_flush_and_grace():
+    presence = PresenceRegistry()
+    conn = user_status_db()
+    presence.connect('u1', 'sid1', 1000)
+    presence.disconnect('sid1', 2000)
+    # Flush while the user is still within the offline grace period
+    presence.flush(conn, now=2000)
+    assert 'u1' in presence._users
+    assert presence.due_offline(8000, 5000) == [('u1', 2000)]
+    assert 'u1' not in presence._users
+    assert presence.status('u1', 2000) == (False, 2000)
+
+
+def test_online_while_any_worker_has_a_session():
+    conn = user_status_db()
+    first, second = PresenceRegistry('w1'), PresenceRegistry('w2', worker_timeout=30)
+    first.connect('u1', 'a', 1000)
+    second.connect('u1', 'b', 1000)
+    first.flush(conn, now=1000)
+    second.flush(conn, now=1000)
+
+    first.disconnect('a', 2000)
+    first.flush(conn, now=2000)
+    assert stored_online(conn, 'u1') == 1
+
+    # w1 stops heartbeating (crashed); w2's next flush drops its sessions
+    first.connect('u2', 'c', 3000)
+    first.flush(conn, now=3000)
+    second.disconnect('b', 4000)
+    second.flush(conn, now=4000)
+    assert stored_online(conn, 'u1') == 0
+    assert stored_online(conn, 'u2') == 1
+    second.flush(conn, now=40000)
+    assert stored_online(conn, 'u2') == 0
+
+
+def test_retire_takes_worker_sessions_offline():
+    conn = user_status_db()
+    presence = PresenceRegistry('w1')
+    presence.connect('u1', 'a', 1000)
+    presence.flush(conn, now=1000)
+    presence.retire(conn)
+    assert stored_online(conn, 'u1') == 0
+    assert conn.execute('SELECT COUNT(*) FROM presence_workers').fetchone()[0] == 0
+
+
+def test_reconnect_to_another_worker_is_seen_before_announcing_offline():
+    conn = user_status_db()
+    first, second = PresenceRegistry('w1', worker_timeout=30), PresenceRegistry('w2')
+    first.connect('u1', 'a', 1000)
+    first.flush(conn, now=1000)
+    first.disconnect('a', 2000)
+    second.connect('u1', 'b', 3000)
+    second.flush(conn, now=3000)
+    due = first.due_offline(9000, 5000)
+    assert due == [('u1', 2000)]
+    assert first.online_elsewhere(conn, ['u1'], now=9000) == {'u1'}
+    # Not once the other worker stops heartbeating
+    assert first.online_elsewhere(conn, ['u1'], now=40000) == set()
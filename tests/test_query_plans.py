@@ -0,0 +1,4 @@
+def test_hot_queries_use_indexes(chat_app):
+    result = chat_app.app.test_cli_runner().invoke(args=['check-query-plans'])
+    assert result.exit_code == 0, result.output
+    assert 'OK: no hot query scans a table' in result.output
@@ -0,0 +1,66 @@
+import sqlite3
+
+from receipts import ReceiptBuffer
+
+
+def chats_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE messages (id TEXT PRIMARY KEY, chat_id TEXT, sender_id TEXT,
+                    receiver_id TEXT, timestamp BIGINT, deleted_for_everyone BOOLEAN DEFAULT 0,
+                    deleted_for_receiver BOOLEAN DEFAULT 0)''')
+    conn.execute('''CREATE TABLE chats (user_id TEXT, chat_user_id TEXT, last_message TEXT,
+                    last_message_time BIGINT, read_up_to BIGINT NOT NULL DEFAULT 0,
+                    delivered_up_to BIGINT NOT NULL DEFAULT 0, unread_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, chat_user_id))''')
+    return conn
+
+
+def test_receipt_without_chat_row_creates_nothing_and_expires():
+    conn = chats_db()
+    receipts = ReceiptBuffer(max_retries=2)
+    receipts.add('b', 'a', read_up_to=100)
+    for _ in range(2):
+        assert receipts.flush(conn) == 0
+        assert receipts.pending('b', 'a') == (100, 100)
+    assert receipts.flush(conn) == 0
+    assert receipts.pending('b', 'a') == (0, 0)
+    assert conn.execute('SELECT COUNT(*) FROM chats').fetchone()[0] == 0
+
+
+def test_receipt_applies_once_the_chat_row_exists():
+    conn = chats_db()
+    receipts = ReceiptBuffer()
+    receipts.add('b', 'a', read_up_to=100)
+    assert receipts.flush(conn) == 0
+    conn.execute("INSERT INTO chats (user_id, chat_user_id, last_message_time, unread_count) "
+                 "VALUES ('b', 'a', 100, 1)")
+    conn.commit()
+    assert receipts.flush(conn) == 1
+    row = conn.execute("SELECT read_up_to, delivered_up_to, unread_count FROM chats").fetchone()
+    assert row == (100, 100, 0)
+
+
+def test_receipt_for_unknown_chat_keeps_chat_list_working(chat_app, signup):
+    client = chat_app.app.test_client()
+    headers, _ = signup('receipt-a@test.example')
+    _, other_id = signup('receipt-b@test.example')
+    response = client.post(f'/api/chats/{other_id}/receipts', json={'read_up_to': 1}, headers=headers)
+    assert response.status_code == 200
+    chat_app.flush_receipts()
+    response = client.get('/api/chats', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['chats'] == []
+
+
+def test_unauthenticated_message_read_moves_nothing(chat_app, signup):
+    _, sender_id = signup('receipt-c@test.example')
+    _, receiver_id = signup('receipt-d@test.example')
+    conn = chat_app.get_db()
+    conn.execute('''INSERT INTO messages (id, chat_id, sender_id, receiver_id, text, image_url, timestamp, status)
+                    VALUES ('anon-read', 'x', ?, ?, 'hi', '', 500, 'sent')''', (sender_id, receiver_id))
+    conn.commit()
+    conn.close()
+    client = chat_app.socketio.test_client(chat_app.app)
+    client.emit('message_read', {'message_id': 'anon-read'})
+    client.disconnect()
+    assert chat_app.receipts.pending(receiver_id, sender_id) == (0, 0)
@@ -0,0 +1,97 @@
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from transfer import deferred_schema, restore_deferred_schema
+
+
+def indexed_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE messages (id TEXT, chat_id TEXT)')
+    conn.execute('CREATE INDEX idx_messages_chat ON messages(chat_id)')
+    conn.commit()
+    return conn
+
+
+def indexes(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def set_owner(conn, pid):
+    conn.execute('UPDATE _deferred_owner SET pid = ?, host = ?', (pid, socket.gethostname()))
+    conn.commit()
+
+
+def test_running_import_is_left_alone(tmp_path):
+    conn = indexed_db(str(tmp_path / 'chat.db'))
+    importer = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        with deferred_schema(conn, ('messages',)):
+            set_owner(conn, importer.pid)
+            other = sqlite3.connect(str(tmp_path / 'chat.db'))
+            assert restore_deferred_schema(other) == 0
+            assert 'idx_messages_chat' not in indexes(other)
+            with pytest.raises(RuntimeError):
+                with deferred_schema(other, ('messages',)):
+                    pass
+            set_owner(conn, os.getpid())
+    finally:
+        importer.kill()
+        importer.wait()
+    assert 'idx_messages_chat' in indexes(conn)
+
+
+def test_dead_import_is_restored(tmp_path):
+    conn = indexed_db(str(tmp_path / 'chat.db'))
+    importer = subprocess.Popen([sys.executable, '-c', 'pass'])
+    importer.wait()
+    with deferred_schema(conn, ('messages',)):
+        set_owner(conn, importer.pid)
+        other = sqlite3.connect(str(tmp_path / 'chat.db'))
+        assert restore_deferred_schema(other) == 1
+        assert 'idx_messages_chat' in indexes(other)
+
+
+def test_exports_include_archived_messages(tmp_path):
+    from archive import MessageArchive, month_start
+    from transfer import export_all, export_user
+    path = str(tmp_path / 'chat.db')
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (id TEXT PRIMARY KEY, email TEXT, password TEXT);
+        CREATE TABLE chats (user_id TEXT, chat_user_id TEXT, PRIMARY KEY (user_id, chat_user_id));
+        CREATE TABLE messages (id TEXT PRIMARY KEY, chat_id TEXT, sender_id TEXT, receiver_id TEXT,
+                               timestamp INTEGER, deleted_for_sender INTEGER DEFAULT 0,
+                               deleted_for_receiver INTEGER DEFAULT 0, deleted_for_everyone INTEGER DEFAULT 0);
+        CREATE TABLE archived_chats (chat_id TEXT, month INTEGER, PRIMARY KEY (chat_id, month));
+        CREATE TABLE archived_months (month INTEGER PRIMARY KEY);
+        INSERT INTO users VALUES ('a', 'a@x', 'h'), ('b', 'b@x', 'h');
+        INSERT INTO chats VALUES ('a', 'b'), ('b', 'a');
+    ''')
+    conn.executemany("INSERT INTO messages (id, chat_id, sender_id, receiver_id, timestamp) VALUES (?, 'a_b', 'a', 'b', ?)",
+                     [('old1', month_start((2024, 1))), ('old2', month_start((2024, 2))), ('new', month_start((2024, 6)))])
+    conn.commit()
+    archive = MessageArchive(str(tmp_path / 'archive'))
+    assert archive.compact(conn, older_than=month_start((2024, 5)))['archived'] == 2
+
+    def connect():
+        db = sqlite3.connect(path)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def message_ids(lines):
+        return [record['id'] for record in map(json.loads, lines) if record['type'] == 'message']
+
+    assert message_ids(export_user(connect, 'a', page_size=1, archive=archive)) == ['old1', 'old2', 'new']
+    assert sorted(message_ids(export_all(connect, page_size=1, archive=archive))) == ['new', 'old1', 'old2']
+    # A compaction cut short leaves a row in both places: exported once
+    conn.execute("INSERT INTO messages (id, chat_id, sender_id, receiver_id, timestamp) VALUES ('old2', 'a_b', 'a', 'b', ?)",
+                 (month_start((2024, 2)),))
+    conn.commit()
+    assert message_ids(export_user(connect, 'a', page_size=1, archive=archive)) == ['old1', 'old2', 'new']
+    assert sorted(message_ids(export_all(connect, page_size=1, archive=archive))) == ['new', 'old1', 'old2']
@@ -0,0 +1,276 @@
+import heapq
+import itertools
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+# Record types in export order: users before the chats and messages that
+# refer to them
+TABLES = {'user': 'users', 'chat': 'chats', 'message': 'messages'}
+
+
+def _record(kind, row, drop=()):
+    record = {'type': kind}
+    record.update((key, row[key]) for key in row.keys() if key not in drop)
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def _pages(connect, sql, params, key, page_size):
+    """Yield the rows of a keyset-paginated query, one page per connection.
+
+    sql ends in "... > (?) ORDER BY <key> LIMIT ?" style conditions taking
+    the last key of the previous page; key(row) returns that key as a
+    tuple. The connection goes back to the pool between pages, so a slow
+    reader never pins one or holds a read snapshot open.
+    """
+    last = None
+    while True:
+        conn = connect()
+        try:
+            rows = conn.execute(sql(last is not None), params + (last or ()) + (page_size,)).fetchall()
+        finally:
+            conn.close()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last = key(rows[-1])
+
+
+def _by_rowid(after, table='messages'):
+    where = 'WHERE rowid > ?' if after else ''
+    return f'SELECT rowid AS _rowid, * FROM {table} {where} ORDER BY rowid LIMIT ?'
+
+
+def export_all(connect, page_size=1000, archive=None):
+    """NDJSON lines for every user, chat and message, password hashes included.
+
+    With archive (a MessageArchive), archived messages follow the hot
+    ones. Hot first: a row compaction moves meanwhile is exported twice
+    (the import skips it) rather than not at all.
+    """
+    for kind, table in TABLES.items():
+        def sql(after, table=table):
+            return _by_rowid(after, table)
+        for row in _pages(connect, sql, (), lambda row: (row['_rowid'],), page_size):
+            yield _record(kind, row, drop=('_rowid',))
+    if archive is None:
+        return
+    for month in archive.months():
+        rows = _pages(lambda month=month: archive.connect(month), _by_rowid, (),
+                      lambda row: (row['_rowid'],), page_size)
+        while True:
+            page = list(itertools.islice(rows, page_size))
+            if not page:
+                break
+            # A compaction cut short leaves rows in both; those went out above
+            ids = [row['id'] for row in page]
+            conn = connect()
+            try:
+                hot = {row[0] for row in conn.execute(
+                    f"SELECT id FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids)}
+            finally:
+                conn.close()
+            for row in page:
+                if row['id'] not in hot:
+                    yield _record('message', row, drop=('_rowid',))
+
+
+def export_user(connect, user_id, page_size=1000, archive=None):
+    """NDJSON lines for one user: their profile, chats and visible messages.
+
+    With archive (a MessageArchive), each chat's archived messages are
+    merged in.
+    """
+    conn = connect()
+    try:
+        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    finally:
+        conn.close()
+    if user is None:
+        return
+    yield _record('user', user, drop=('password',))
+
+    def chats_sql(after):
+        return f'''SELECT * FROM chats WHERE user_id = ? {'AND chat_user_id > ?' if after else ''}
+                   ORDER BY chat_user_id LIMIT ?'''
+    chat_user_ids = []
+    for row in _pages(connect, chats_sql, (user_id,), lambda row: (row['chat_user_id'],), page_size):
+        chat_user_ids.append(row['chat_user_id'])
+        yield _record('chat', row)
+
+    # Oldest first per chat, in (timestamp, id) order like the history API
+    def messages_sql(after):
+        return f'''SELECT * FROM messages
+                   WHERE chat_id = ?
+                   AND deleted_for_everyone = 0
+                   AND ((sender_id = ? AND deleted_for_sender = 0)
+                        OR (receiver_id = ? AND deleted_for_receiver = 0))
+                   {'AND (timestamp, id) > (?, ?)' if after else ''}
+                   ORDER BY timestamp, id
+                   LIMIT ?'''
+    def key(row):
+        return row['timestamp'], row['id']
+
+    for chat_user_id in chat_user_ids:
+        chat_id = f'{min(user_id, chat_user_id)}_{max(user_id, chat_user_id)}'
+        params = (chat_id, user_id, user_id)
+        streams = [_pages(connect, messages_sql, params, key, page_size)]
+        if archive is not None:
+            conn = connect()
+            try:
+                months = archive.chat_months(conn, chat_id)
+            finally:
+                conn.close()
+            streams += [_pages(lambda month=month: archive.connect(month), messages_sql, params, key, page_size)
+                        for month in months]
+        last = None
+        for row in heapq.merge(*streams, key=key):
+            # A compaction cut short leaves a row in both
+            if row['id'] != last:
+                last = row['id']
+                yield _record('message', row)
+
+
+def _schema_objects(conn, tables):
+    marks = ','.join('?' * len(tables))
+    # Indexes before triggers, so recreating them restores lookups first
+    return conn.execute(f'''SELECT type, name, sql FROM sqlite_master
+                            WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+                            AND tbl_name IN ({marks})
+                            ORDER BY type, name''', tuple(tables)).fetchall()
+
+
+def import_running(conn):
+    """True while another live process on this host holds deferred_schema().
+
+    Its pid is recorded with the dropped schema. An import from another
+    host can't be checked, so it counts as running.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = '_deferred_owner'").fetchone():
+        return False
+    owner = conn.execute('SELECT pid, host FROM _deferred_owner').fetchone()
+    if owner is None or tuple(owner) == (os.getpid(), socket.gethostname()):
+        return False
+    pid, host = owner
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def restore_deferred_schema(conn):
+    """Recreate indexes and triggers left dropped by an interrupted import.
+
+    Does nothing while the import is still running (see import_running).
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = '_deferred_schema'").fetchone():
+        return 0
+    if import_running(conn):
+        print('Bulk import in progress: leaving its indexes and triggers for it to restore')
+        return 0
+    # DDL is transactional in SQLite: all of it is back, or none
+    conn.execute('BEGIN')
+    rows = conn.execute('SELECT name, sql FROM _deferred_schema ORDER BY position').fetchall()
+    for name, sql in rows:
+        conn.execute(sql)
+    conn.execute('DROP TABLE _deferred_schema')
+    conn.execute('DROP TABLE IF EXISTS _deferred_owner')
+    if rows and conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_search'").fetchone():
+        # The search triggers were off, so the FTS index may be behind users
+        conn.execute("INSERT INTO users_search(users_search) VALUES ('rebuild')")
+    conn.commit()
+    return len(rows)
+
+
+@contextmanager
+def deferred_schema(conn, tables):
+    """Drop the indexes and triggers on tables for a bulk load.
+
+    Each index is then built once, sorted, at the end instead of being
+    updated row by row, and no trigger fires per row (so imported rows are
+    not in the /api/sync change log). The dropped definitions are saved in
+    _deferred_schema in the same transaction as the drops, so if the load
+    dies halfway restore_deferred_schema() (run by init_db) puts them back.
+    The importing process is recorded in _deferred_owner, so an app
+    started meanwhile leaves the schema alone.
+    """
+    restore_deferred_schema(conn)
+    if import_running(conn):
+        raise RuntimeError('Another bulk import is running on this database')
+    conn.execute('BEGIN')
+    objects = _schema_objects(conn, tables)
+    conn.execute('CREATE TABLE _deferred_schema (position INTEGER, name TEXT, sql TEXT)')
+    conn.execute('CREATE TABLE _deferred_owner (pid INTEGER, host TEXT, started_at REAL)')
+    conn.execute('INSERT INTO _deferred_owner VALUES (?, ?, ?)',
+                 (os.getpid(), socket.gethostname(), time.time()))
+    conn.executemany('INSERT INTO _deferred_schema VALUES (?, ?, ?)',
+                     [(position, name, sql) for position, (_, name, sql) in enumerate(objects)])
+    for kind, name, _ in objects:
+        conn.execute(f'DROP {kind.upper()} "{name}"')
+    conn.commit()
+    try:
+        yield
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        restore_deferred_schema(conn)
+
+
+def import_ndjson(conn, lines, batch_size=10000, commit_rows=500000):
+    """Bulk-load exported NDJSON lines; returns {type: [inserted, skipped]}.
+
+    Rows go in with executemany in batches of batch_size, committing every
+    commit_rows rows, with indexes and triggers deferred. Rows whose key
+    already exists are skipped (INSERT OR IGNORE), so an import can be
+    re-run; so are users without a password, as in per-user exports.
+    Columns the database doesn't have are ignored.
+    """
+    columns = {table: {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+               for table in TABLES.values()}
+    counts = {kind: [0, 0] for kind in TABLES}
+    pending = {}  # (kind, column names) -> [row tuples]
+    uncommitted = 0
+
+    def flush(key):
+        kind, names = key
+        rows = pending.pop(key)
+        inserted = conn.executemany(f'''INSERT OR IGNORE INTO {TABLES[kind]} ({', '.join(names)})
+                                        VALUES ({', '.join('?' * len(names))})''', rows).rowcount
+        counts[kind][0] += inserted
+        counts[kind][1] += len(rows) - inserted
+
+    # Bigger page cache for the index builds at the end
+    conn.execute('PRAGMA cache_size = -262144')
+    with deferred_schema(conn, tuple(TABLES.values())):
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record.pop('type')
+                table_columns = columns[TABLES[kind]]
+            except (ValueError, KeyError, AttributeError):
+                raise ValueError(f'Line {number}: not an exported record')
+            names = tuple(name for name in record if name in table_columns)
+            key = (kind, names)
+            batch = pending.setdefault(key, [])
+            batch.append(tuple(record[name] for name in names))
+            if len(batch) >= batch_size:
+                flush(key)
+            uncommitted += 1
+            if uncommitted >= commit_rows:
+                for key in list(pending):
+                    flush(key)
+                conn.commit()
+                uncommitted = 0
+        for key in list(pending):
+            flush(key)
+        conn.commit()
+    return counts
@@ -0,0 +1,144 @@
+import gzip
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # standard json, same output
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # compact sockets fall back to short-key JSON
+    msgpack = None
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Short keys for the fields of socket event payloads. Clients that ask for
+# a compact encoding expand them with the same table (sent back in the
+# 'authenticated' event).
+KEYS = {
+    'id': 'i',
+    'chat_id': 'c',
+    'sender_id': 's',
+    'receiver_id': 'r',
+    'text': 't',
+    'image_url': 'u',
+    'timestamp': 'ts',
+    'status': 'st',
+    'client_id': 'ci',
+    'user_id': 'ui',
+    'message_id': 'mi',
+    'chat_user_id': 'cu',
+    'typing': 'ty',
+    'online': 'o',
+    'last_seen': 'ls',
+    'read_up_to': 'ru',
+    'delivered_up_to': 'du',
+    'type': 'y',
+}
+LONG_KEYS = {short: key for key, short in KEYS.items()}
+
+# Fields holding a user/message UUID (or a chat id, two joined by "_"),
+# which msgpack carries as 16 (32) raw bytes instead of 36 (73) characters
+ID_KEYS = {'id', 'chat_id', 'sender_id', 'receiver_id', 'user_id', 'message_id', 'chat_user_id'}
+
+# Socket encodings a client may ask for, best first
+ENCODINGS = ('msgpack', 'json-compact') if msgpack is not None else ('json-compact',)
+
+
+def negotiate(requested, enabled=ENCODINGS):
+    """The first encoding in the client's list that the server has, or None (plain JSON)."""
+    if isinstance(requested, str):
+        requested = [requested]
+    for encoding in requested or ():
+        if encoding in enabled and encoding in ENCODINGS:
+            return encoding
+    return None
+
+
+def _id_bytes(value):
+    if isinstance(value, str):
+        try:
+            if len(value) == 36:
+                return uuid.UUID(value).bytes
+            if len(value) == 73 and value[36] == '_':
+                return uuid.UUID(value[:36]).bytes + uuid.UUID(value[37:]).bytes
+        except ValueError:
+            pass
+    return value
+
+
+def _shorten(value, binary_ids):
+    if isinstance(value, dict):
+        return {KEYS.get(key, key): (_id_bytes(item) if binary_ids and key in ID_KEYS
+                                     else _shorten(item, binary_ids))
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten(item, binary_ids) for item in value]
+    return value
+
+
+def pack(payload, encoding):
+    """An event payload in a compact encoding.
+
+    msgpack gives bytes (sent as a Socket.IO binary attachment);
+    json-compact gives the payload with short keys, which Socket.IO
+    serializes as usual.
+    """
+    if encoding == 'msgpack':
+        return msgpack.packb(_shorten(payload, True))
+    return _shorten(payload, False)
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        expanded = {}
+        for short, item in value.items():
+            key = LONG_KEYS.get(short, short)
+            if key in ID_KEYS and isinstance(item, bytes):
+                item = '_'.join(str(uuid.UUID(bytes=item[i:i + 16])) for i in range(0, len(item), 16))
+            expanded[key] = _expand(item)
+        return expanded
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def unpack(data, encoding):
+    """Inverse of pack(), for Python clients and benchmarks."""
+    if encoding == 'msgpack':
+        return _expand(msgpack.unpackb(data))
+    return _expand(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, serializing with orjson when it is installed.
+
+    Same output apart from key order (orjson keeps insertion order);
+    anything orjson can't encode natively, datetimes included, goes
+    through Flask's usual default().
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('indent') is not None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
+
+def content_coding(accept_encodings):
+    """'br' or 'gzip' from a request's Accept-Encoding, or None."""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, coding, level=None):
+    if coding == 'br':
+        return brotli.compress(data, quality=4 if level is None else level)
+    return gzip.compress(data, 6 if level is None else level, mtime=0)
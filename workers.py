@@ -0,0 +1,23 @@
+import os
+import stat
+
+
+def init_worker():
+    """ProcessPoolExecutor initializer for pools created inside a server."""
+    # Forked from a live server: let go of its sockets (clients, listener),
+    # or a client reading to EOF would never see its connection close.
+    # The pool's own pipes are not sockets. closerange, because gevent's
+    # patched os.close doesn't close the descriptor here.
+    try:
+        fds = [int(name) for name in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = []
+    for fd in fds:
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.closerange(fd, fd + 1)
+        except OSError:
+            pass
+    # Then yield the CPU to request handling when both want it
+    if hasattr(os, 'nice'):
+        os.nice(10)